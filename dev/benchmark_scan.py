@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Benchmark the scan pipeline against the SANE test backend.
+
+Pages are scanned with SaneThread.scan_pages(), imported into a Document and
+post-processed as in the GUI. Reports sheets per minute, per-stage latency
+percentiles, peak RSS and the time the main loop was stalled.
+
+Stages, per page:
+  scan     time since the previous page arrived (or since the scan started)
+  queue    page arrived -> document thread started importing it
+  process  import started -> import and post-processing chain finished
+  total    page arrived -> import and post-processing chain finished
+
+Usage:
+  python3 dev/benchmark_scan.py
+  python3 dev/benchmark_scan.py --pages 50 --mode Color --resolution 300
+  python3 dev/benchmark_scan.py --width 210 --height 297 --depth 8
+  python3 dev/benchmark_scan.py --rotate 90 --unpaper --ocr
+  python3 dev/benchmark_scan.py --json results.json
+"""
+
+from pathlib import Path
+import argparse
+import json
+import logging
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+root = Path(__file__).resolve().parents[1] / "scantpaper"
+sys.path.insert(0, str(root))
+import gi  # pylint: disable=wrong-import-position
+
+gi.require_version("Gtk", "3.0")
+from gi.repository import GLib  # pylint: disable=wrong-import-position
+from document import Document  # pylint: disable=wrong-import-position,import-error
+from frontend.image_sane import (  # pylint: disable=wrong-import-position,import-error
+    SaneThread,
+)
+from unpaper import Unpaper  # pylint: disable=wrong-import-position,import-error
+
+PERCENTILES = (50, 90, 99)
+
+
+class StallMonitor:
+    "Measure how long the main loop fails to service a periodic timeout"
+
+    def __init__(self, interval=10, threshold=50):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = []
+        self._last = None
+        self._source = None
+
+    def start(self):
+        "start monitoring"
+        self._last = time.perf_counter()
+        self._source = GLib.timeout_add(self.interval, self._tick)
+
+    def stop(self):
+        "stop monitoring"
+        if self._source is not None:
+            GLib.source_remove(self._source)
+            self._source = None
+
+    def _tick(self):
+        now = time.perf_counter()
+        gap = (now - self._last) * 1000
+        self._last = now
+        if gap > self.threshold:
+            self.stalls.append(gap - self.interval)
+        return GLib.SOURCE_CONTINUE
+
+    def summary(self):
+        "return the total, maximum and number of stalls in ms"
+        return {
+            "total_ms": sum(self.stalls),
+            "max_ms": max(self.stalls, default=0.0),
+            "count": len(self.stalls),
+        }
+
+
+def run_in_mainloop(function, timeout, **kwargs):
+    """Call function with finished and error callbacks that quit a main loop,
+    and run it until one of them fires"""
+    loop = GLib.MainLoop()
+    result = {}
+
+    def finished_callback(response):
+        result["response"] = response
+        loop.quit()
+
+    def error_callback(response):
+        result["error"] = response.status
+        loop.quit()
+
+    def timeout_callback():
+        result["error"] = "timed out"
+        loop.quit()
+
+    source = GLib.timeout_add_seconds(timeout, timeout_callback)
+    function(
+        finished_callback=finished_callback, error_callback=error_callback, **kwargs
+    )
+    loop.run()
+    if "error" not in result:
+        GLib.source_remove(source)
+    if "error" in result:
+        raise RuntimeError(f"{function.__name__}: {result['error']}")
+    return result["response"]
+
+
+def percentiles(values):
+    "return the configured percentiles of the values"
+    if len(values) < 2:
+        return {f"p{p}": values[0] if values else None for p in PERCENTILES}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {f"p{p}": cuts[p - 1] for p in PERCENTILES}
+
+
+def setup_device(thread, args):
+    "open the device and set the frame options"
+    run_in_mainloop(thread.open_device, args.timeout, device_name=args.device)
+    options = {
+        "mode": args.mode,
+        "depth": args.depth,
+        "resolution": args.resolution,
+        "tl-x": 0,
+        "tl-y": 0,
+        "br-x": args.width,
+        "br-y": args.height,
+    }
+    for name, value in options.items():
+        run_in_mainloop(thread.set_option, args.timeout, name=name, value=value)
+
+
+def run_benchmark(args, session):
+    "scan and process the pages, returning the per-page timings"
+    thread = SaneThread()
+    thread.start()
+    slist = Document(dir=session)
+    setup_device(thread, args)
+
+    pages = []
+    loop = GLib.MainLoop()
+    errors = []
+    scan_done = False
+
+    def maybe_quit():
+        "quit once the scan and the processing of every page have finished"
+        if errors or (scan_done and all("finished" in page for page in pages)):
+            loop.quit()
+
+    def new_page_callback(image_bytes):
+        arrived = time.perf_counter()
+        previous = pages[-1]["arrived"] if pages else start
+        timing = {"arrived": arrived, "scan": arrived - previous}
+        pages.append(timing)
+
+        def started_callback(_response):
+            timing.setdefault("started", time.perf_counter())
+
+        def finished_callback(_response):
+            timing["finished"] = time.perf_counter()
+            maybe_quit()
+
+        def error_callback(response):
+            errors.append(response.status)
+            maybe_quit()
+
+        import_kwargs = {
+            "dir": session,
+            "image_bytes": image_bytes,
+            "resolution": (args.resolution, args.resolution, "PixelsPerInch"),
+            "rotate": args.rotate,
+            "ocr": args.ocr,
+            "engine": "tesseract",
+            "language": args.language,
+            "started_callback": started_callback,
+            "finished_callback": finished_callback,
+            "error_callback": error_callback,
+        }
+        if args.unpaper:
+            import_kwargs["unpaper"] = Unpaper()
+        slist.import_scan(**import_kwargs)
+
+    def scan_finished_callback(_response):
+        nonlocal scan_done
+        scan_done = True
+        maybe_quit()
+
+    def scan_error_callback(response):
+        errors.append(response.status)
+        maybe_quit()
+
+    monitor = StallMonitor(args.stall_interval, args.stall_threshold)
+    monitor.start()
+    start = time.perf_counter()
+    thread.scan_pages(
+        num_pages=args.pages,
+        encode=True,
+        new_page_callback=new_page_callback,
+        finished_callback=scan_finished_callback,
+        error_callback=scan_error_callback,
+    )
+    loop.run()
+    elapsed = time.perf_counter() - start
+    monitor.stop()
+    thread.quit()
+    slist.thread.quit()
+    if errors:
+        raise RuntimeError("; ".join(str(e) for e in errors))
+    return pages, elapsed, monitor.summary()
+
+
+def report(pages, elapsed, stalls):
+    "collate the timings"
+    stages = {"scan": [], "queue": [], "process": [], "total": []}
+    for page in pages:
+        started = page.get("started", page["arrived"])
+        stages["scan"].append(page["scan"] * 1000)
+        stages["queue"].append((started - page["arrived"]) * 1000)
+        stages["process"].append((page["finished"] - started) * 1000)
+        stages["total"].append((page["finished"] - page["arrived"]) * 1000)
+    return {
+        "pages": len(pages),
+        "elapsed_s": elapsed,
+        "sheets_per_minute": len(pages) / elapsed * 60 if elapsed else None,
+        "latency_ms": {name: percentiles(values) for name, values in stages.items()},
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_child_rss_mib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        / 1024,
+        "main_loop_stalls": stalls,
+    }
+
+
+def print_report(result):
+    "print the results as a table"
+    print(f"pages:              {result['pages']}")
+    print(f"elapsed:            {result['elapsed_s']:.2f} s")
+    print(f"sheets per minute:  {result['sheets_per_minute']:.1f}")
+    print(f"peak RSS:           {result['peak_rss_mib']:.1f} MiB")
+    print(f"peak child RSS:     {result['peak_child_rss_mib']:.1f} MiB")
+    stalls = result["main_loop_stalls"]
+    print(
+        f"main loop stalls:   {stalls['count']} totalling {stalls['total_ms']:.0f} ms"
+        f" (max {stalls['max_ms']:.0f} ms)"
+    )
+    print("latency (ms):      " + "".join(f"{f'p{p}':>10}" for p in PERCENTILES))
+    for name, values in result["latency_ms"].items():
+        print(
+            f"  {name:<17}"
+            + "".join(f"{values[f'p{p}'] or 0:>10.1f}" for p in PERCENTILES)
+        )
+
+
+def main():
+    "main"
+    p = argparse.ArgumentParser(description="Benchmark the scan pipeline")
+    p.add_argument("--device", default="test", help="SANE device (default: test)")
+    p.add_argument("--pages", type=int, default=20, help="Pages to scan (default: 20)")
+    p.add_argument("--mode", default="Gray", help="Scan mode (default: Gray)")
+    p.add_argument("--depth", type=int, default=8, help="Bit depth (default: 8)")
+    p.add_argument(
+        "--resolution", type=int, default=300, help="Resolution in dpi (default: 300)"
+    )
+    p.add_argument(
+        "--width", type=float, default=200, help="Frame width in mm (default: 200)"
+    )
+    p.add_argument(
+        "--height", type=float, default=200, help="Frame height in mm (default: 200)"
+    )
+    p.add_argument(
+        "--rotate", type=int, default=0, help="Rotate pages by this angle (default: 0)"
+    )
+    p.add_argument("--unpaper", action="store_true", help="Clean up pages with unpaper")
+    p.add_argument("--ocr", action="store_true", help="OCR pages with tesseract")
+    p.add_argument("--language", default="eng", help="OCR language (default: eng)")
+    p.add_argument(
+        "--stall-interval",
+        type=int,
+        default=10,
+        help="Main loop monitoring interval in ms (default: 10)",
+    )
+    p.add_argument(
+        "--stall-threshold",
+        type=int,
+        default=50,
+        help="Gap in ms counted as a main loop stall (default: 50)",
+    )
+    p.add_argument(
+        "--timeout",
+        type=int,
+        default=60,
+        help="Timeout in s for opening the device and setting options (default: 60)",
+    )
+    p.add_argument("--json", help="Also write the results to this file")
+    p.add_argument("--debug", action="store_true", help="Log debug output")
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+    with tempfile.TemporaryDirectory() as session:
+        try:
+            pages, elapsed, stalls = run_benchmark(args, session)
+        except RuntimeError as err:
+            print(err, file=sys.stderr)
+            sys.exit(1)
+    result = report(pages, elapsed, stalls)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"args": vars(args), "result": result}, fh, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -129,6 +129,9 @@ class ApplicationWindow(
     _scan_udt_cmbx = None
     _scan_udt_hbox = None
     _scan_udt_button = None
+    _hot_folder = None
+    _hot_folder_queue = None
+    _hot_folder_busy = False
     slist = None
 
     # Temp::File object for PDF to be emailed
@@ -158,11 +161,13 @@ class ApplicationWindow(
         self.add_action(self._actions["tooltype"])
         self.add_action(self._actions["viewtype"])
         self.add_action(self._actions["editmode"])
+        self.add_action(self._actions["watch-folder"])
 
         # connect the action callback for tools and view
         self._actions["tooltype"].connect("activate", self._change_image_tool_cb)
         self._actions["viewtype"].connect("activate", self._change_view_cb)
         self._actions["editmode"].connect("activate", self._edit_mode_callback)
+        self._actions["watch-folder"].connect("activate", self.watch_folder)
 
         self._dependencies = {}
         self._ocr_engine = []
@@ -170,6 +175,7 @@ class ApplicationWindow(
         self.print_settings = None
         self._message_dialog = None
         self._windows = None
+        self._extra_scan_windows = []
         self._windowc = None
         self._windowo = None
         self._windowu = None
@@ -209,6 +215,7 @@ class ApplicationWindow(
             ("open", self.open_dialog),
             ("open-session", self._open_session_action),
             ("scan", self.scan_dialog),
+            ("scan-another-device", self.scan_another_device_dialog),
             ("save", self.save_dialog),
             ("email", self.email),
             ("print", self.print_dialog),
@@ -268,6 +275,9 @@ class ApplicationWindow(
         self._actions["editmode"] = Gio.SimpleAction.new_stateful(
             "editmode", GLib.VariantType("s"), GLib.Variant("s", "text")
         )
+        self._actions["watch-folder"] = Gio.SimpleAction.new_stateful(
+            "watch-folder", None, GLib.Variant("b", False)
+        )
 
     def _window_state_event_callback(self, _w, event):
         "Note when the window is maximised or not"
@@ -306,7 +316,9 @@ class ApplicationWindow(
             Gtk.get_micro_version(),
         )
         logger.info("sane.__version__ %s", sane.__version__)
-        logger.info("sane.init() %s", sane.init())
+        sane_version = sane.init()
+        logger.info("sane.init() %s", sane_version)
+        self.settings["SANE version"] = ".".join(str(x) for x in sane_version[1:])
         logger.info("SQLite C library version: %s", sqlite3.sqlite_version)
         logger.info("SQLite thread safety level: %s", sqlite3.threadsafety)
         logger.info("ocrmypdf.__version__ %s", ocrmypdf.__version__)
@@ -547,9 +559,6 @@ class ApplicationWindow(
                 logger.warning(lang_msg)
                 msg += lang_msg
 
-        if not self._dependencies["qpdf"]:
-            msg += _("PDF encryption requires qpdf") + "\n"
-
         # Put up warning if needed
         if msg != EMPTY:
             msg = _("Warning: missing packages") + f"\n{msg}"
@@ -152,46 +152,49 @@ class BaseDocument(SimpleList):
         "Set the paper sizes in the manager and worker threads"
         self.paper_sizes = paper_sizes
         self.thread.send("set_paper_sizes", paper_sizes)
+        self.thread.exporter.send("set_paper_sizes", paper_sizes)
 
     def cancel(self, cancel_callback, process_callback=None):
         "Kill all running processes"
-        with self.thread.lock:  # FIXME: move most of this to basethread.py
-            # Empty process queue first to stop any new process from starting
-            logger.info("Emptying process queue")
-            try:
-                while self.thread.requests.get(False):
+        for thread in (self.thread, self.thread.exporter):
+            with thread.lock:  # FIXME: move most of this to basethread.py
+                # Empty process queue first to stop any new process from starting
+                logger.info("Emptying process queue")
+                try:
+                    while thread.requests.get(False):
+                        pass
+                except queue.Empty:
                     pass
-            except queue.Empty:
-                pass
-            try:
-                while self.thread.responses.get(False):
+                try:
+                    while thread.responses.get(False):
+                        pass
+                except queue.Empty:
                     pass
-            except queue.Empty:
-                pass
 
-            # jobs_completed = 0
-            # jobs_total = 0
+                # jobs_completed = 0
+                # jobs_total = 0
 
-            # Then send the thread a cancel signal
-            # to stop it going beyond the next break point
-            self.thread.cancel = True
+                # Then send the thread a cancel signal
+                # to stop it going beyond the next break point
+                thread.cancel = True
 
-            # Kill all running processes in the thread
-            for pidfile in list(self.thread.running_pids):
-                pid = slurp(pidfile)
-                if pid != "":
-                    if pid == 1:
-                        continue
-                    if process_callback is not None:
-                        process_callback(pid)
+                # Kill all running processes in the thread
+                for pidfile in list(thread.running_pids):
+                    pid = slurp(pidfile)
+                    if pid != "":
+                        if pid == 1:
+                            continue
+                        if process_callback is not None:
+                            process_callback(pid)
 
-                    logger.info("Killing PID %s", pid)
+                        logger.info("Killing PID %s", pid)
 
-                    os.killpg(os.getpgid(pid), signal.SIGKILL)
-                    del self.thread.running_pids[pidfile]
+                        os.killpg(os.getpgid(pid), signal.SIGKILL)
+                        del thread.running_pids[pidfile]
 
         # Add a cancel request to ensure the reply is not blocked
         logger.info("Requesting cancel")
+        self.thread.exporter.send("cancel")
         self.thread.send("cancel", finished_callback=cancel_callback)
 
     def create_pidfile(self, options):
@@ -632,6 +635,7 @@ for method_name_ in [
     "save_image",
     "save_text",
     "save_hocr",
+    "save_multiple",
 ]:
     setattr(BaseDocument, method_name_, _save_method_generator(method_name_))
 
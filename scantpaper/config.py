@@ -49,6 +49,7 @@ DEFAULTS = {
     "cache": None,
     "restore window": True,
     "set_timestamp": True,
+    "pdfa": False,
     "use_time": False,
     "use_timezone": True,
     "datetime offset": datetime.timedelta(seconds=0),
@@ -97,6 +98,9 @@ DEFAULTS = {
     "auto-open-scan-dialog": True,
     "available-tmp-warning": 10,
     "close_dialog_on_save": True,
+    "hot folder": None,
+    "hot folder post-processing": True,
+    "hot folder save dir": None,
     "Paper": {
         _("A3"): {
             "x": 297,
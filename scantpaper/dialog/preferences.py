@@ -225,6 +225,19 @@ All document date codes use strftime codes with a leading D, e.g.:
         self._cbts.set_active(self.settings["set_timestamp"])
         vbox.pack_start(self._cbts, True, True, 0)
 
+        # Identify saved PDFs as PDF/A
+        self._cbpdfa = Gtk.CheckButton.new_with_label(
+            _("Identify saved PDFs as PDF/A-2B")
+        )
+        self._cbpdfa.set_tooltip_text(
+            _(
+                "Encrypted PDFs, PDFs prepended to another "
+                "and PDFs with CMYK images are never identified as PDF/A"
+            )
+        )
+        self._cbpdfa.set_active(self.settings["pdfa"])
+        vbox.pack_start(self._cbpdfa, True, True, 0)
+
         # Temporary directory settings
         hbox = Gtk.Box()
         vbox.pack_start(hbox, True, True, 0)
@@ -412,6 +425,7 @@ The other variable available is:
         self.settings["use_timezone"] = self._cbtz.get_active()
         self.settings["use_time"] = self._cbtm.get_active()
         self.settings["set_timestamp"] = self._cbts.get_active()
+        self.settings["pdfa"] = self._cbpdfa.get_active()
         self.settings["convert whitespace to underscores"] = self._cbb.get_active()
         self.settings["available-tmp-warning"] = self._spinbuttonw.get_value()
         self.settings["Blank threshold"] = self._spinbuttonb.get_value()
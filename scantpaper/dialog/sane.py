@@ -7,7 +7,7 @@ from frontend import enums
 from frontend.image_sane import SaneThread
 from gi.repository import GObject, Gtk
 from i18n import _, d_sane
-from scanner.options import Options
+from scanner.options import Options, options_from_cache
 
 from dialog.scan import Scan, _geometry_option, make_progress_string
 
@@ -32,6 +32,16 @@ class SaneScanDialog(Scan):
         blurb="Otherwise, some Brother scanners report out of documents, "
         "despite scanning from flatbed.",
     )
+    option_cache = GObject.Property(
+        type=object,
+        nick="Option cache",
+        blurb="Dict of option descriptors and values, keyed by device name",
+    )
+    sane_version = GObject.Property(
+        type=str,
+        nick="SANE version",
+        blurb="Version of SANE used to populate the option cache",
+    )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -91,14 +101,26 @@ class SaneScanDialog(Scan):
         if device is None:
             device = self.device
 
-        # Remove any existing pages
-        while self.notebook.get_n_pages() > 2:
-            self.notebook.remove_page(LAST_PAGE)
-
-        # Remove lookups to geometry boxes and option widgets
-        self.geometry_boxes = None
-        self.option_widgets = {}
-        self._option_info = {}
+        self._remove_option_widgets()
+
+        # Build the widgets from the cache, if possible, whilst the device is
+        # opened and the options validated in the background
+        cached = self._read_option_cache(device)
+        if cached is not None:
+            options, values = cached
+            logger.info("Building scan options for '%s' from cache", device)
+            self.thread.cached_option_values = values
+            self._initialise_options(options)
+
+            # Don't use the available_scan_options setter until the cache has
+            # been validated, as it fires the reloaded-scan-options signal
+            self._available_scan_options = options
+            num = options.num_options()
+            self.reload_recursion_limit = num * (num + 1) // 2
+            self._set_paper_formats(self.paper_formats)
+
+            # Ghost the scan button until the options have been validated
+            self.set_response_sensitive(Gtk.ResponseType.OK, False)
 
         def started_callback(_data):
             self.cursor = "wait"
@@ -120,7 +142,21 @@ class SaneScanDialog(Scan):
                 self.emit("changed-progress", None, None)
 
             def finished_callback(response):
+                self.thread.cached_option_values = None
                 options = Options(response.info)
+                self._write_option_cache(device, options)
+                if cached is not None and cached[0].has_same_layout(options):
+                    logger.info("Cached scan options for '%s' are valid", device)
+                    self.num_reloads = 0  # num-reloads is read-only
+                    self._update_options(options)
+                    self.set_response_sensitive(Gtk.ResponseType.OK, True)
+                    self.emit("finished-process", "find_scan_options")
+                    self.cursor = "default"
+                    return
+
+                if cached is not None:
+                    logger.info("Cached scan options for '%s' are stale", device)
+                    self._remove_option_widgets()
                 self._initialise_options(options)
                 self.emit("finished-process", "find_scan_options")
 
@@ -131,6 +167,7 @@ class SaneScanDialog(Scan):
                 self.cursor = "default"
 
             def error_callback(response):
+                self.thread.cached_option_values = None
                 self.emit(
                     "process-error",
                     "find_scan_options",
@@ -146,6 +183,10 @@ class SaneScanDialog(Scan):
             )
 
         def error_callback(response):
+            self.thread.cached_option_values = None
+            if cached is not None:
+                del self.option_cache[device]
+                self._remove_option_widgets()
             self.emit(
                 "process-error",
                 "open_device",
@@ -161,6 +202,46 @@ class SaneScanDialog(Scan):
             error_callback=error_callback,
         )
 
+    def _remove_option_widgets(self):
+        # Remove any existing pages
+        while self.notebook.get_n_pages() > 2:
+            self.notebook.remove_page(LAST_PAGE)
+
+        # Remove lookups to geometry boxes and option widgets
+        self.geometry_boxes = None
+        self.option_widgets = {}
+        self._option_info = {}
+
+    def _read_option_cache(self, device):
+        "return the cached options and values for the device, if still valid"
+        if self.option_cache is None or device not in self.option_cache:
+            return None
+        entry = self.option_cache[device]
+        if entry.get("version") != self.sane_version:
+            logger.info(
+                "Ignoring option cache for '%s' from other SANE version", device
+            )
+            return None
+        try:
+            return options_from_cache(entry["options"]), entry["values"]
+        except (KeyError, TypeError, ValueError) as err:
+            logger.warning("Ignoring corrupt option cache for '%s': %s", device, err)
+            return None
+
+    def _write_option_cache(self, device, options):
+        "store the option descriptors and their default values in the cache"
+        if self.option_cache is None:
+            return
+
+        def finished_callback(response):
+            self.option_cache[device] = {
+                "version": self.sane_version,
+                "options": options.to_cache(),
+                "values": response.info,
+            }
+
+        self.thread.get_option_values(finished_callback=finished_callback)
+
     def _initialise_options(self, options):
         logger.debug("sane.get_option_descriptor() returned: %s", options)
         vbox, hboxp = None, None
@@ -495,13 +576,13 @@ class SaneScanDialog(Scan):
                 signal = self.connect("reloaded-scan-options", reloaded_scan_options_cb)
                 self.scan_options(self.device)
 
-        def new_page_callback(image_ob):
+        def new_page_callback(image_bytes):
             nonlocal i
             nonlocal xresolution
             nonlocal yresolution
             insert_after, side = self._insert_target(i)
             self.emit(
-                "new-scan", image_ob, insert_after, side, xresolution, yresolution
+                "new-scan", image_bytes, insert_after, side, xresolution, yresolution
             )
             i += 1
             self.emit(
@@ -517,6 +598,7 @@ class SaneScanDialog(Scan):
         self.thread.scan_pages(
             dir=self.dir,
             num_pages=num_pages,
+            encode=True,
             cancel_between_pages=(
                 self.cancel_between_pages
                 and self.available_scan_options.flatbed_selected(
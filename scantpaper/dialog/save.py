@@ -14,6 +14,18 @@ gi.require_version("Gtk", "3.0")
 from gi.repository import GLib, GObject, Gtk  # pylint: disable=wrong-import-position
 
 MAX_DPI = 2400
+# ms to wait for the options to stop changing before estimating the size
+ESTIMATE_DELAY = 500
+# Options affecting the size of the saved file
+ESTIMATE_OPTIONS = [
+    "page-range",
+    "image-type",
+    "tiff-compression",
+    "jpeg-quality",
+    "downsample-dpi",
+    "downsample",
+    "pdf-compression",
+]
 ENTRY_WIDTH_DATE = 10
 ENTRY_WIDTH_DATETIME = 19
 IMAGE_TYPES = [
@@ -42,6 +54,14 @@ PDF_COMPRESSION_ALGS = [
     ("g4", _("G4"), _("Compress output with CCITT Group 4 encoding.")),
     ("png", _("Flate"), _("Compress output with flate encoding.")),
     ("jpg", _("JPEG"), _("Compress output with JPEG (DCT) encoding.")),
+    (
+        "mrc",
+        _("MRC"),
+        _(
+            "Separate text from background, compressing the text losslessly "
+            "with CCITT Group 4 and the background as low resolution JPEG."
+        ),
+    ),
     ("none", _("None"), _("Use no compression algorithm on output.")),
 ]
 PS_BACKENDS = [
@@ -77,10 +97,19 @@ TIFF_COMPRESSION_ALGS = [
 
 
 class Save(Dialog):
-    "subclass dialog for save options"
-
+    """subclass dialog for save options. Whilst the options are changing, the
+    changed-save-options signal is emitted, debounced, with a serial number, in
+    response to which the estimated size should be passed to
+    set_estimated_size() with the same serial number."""
+
+    __gsignals__ = {
+        "changed-save-options": (GObject.SignalFlags.RUN_FIRST, None, (int,)),
+    }
     _meta_datetime = None
     _meta_datetime_widget = None
+    _estimate_label = None
+    _estimate_serial = 0
+    _estimate_source = None
 
     @GObject.Property(type=object)
     def meta_datetime(self):
@@ -274,7 +303,7 @@ class Save(Dialog):
     image_types = GObject.Property(
         type=object,
         nick="Array of available image types",
-        blurb="To allow djvu, pdfunite dependencies to be optional",
+        blurb="To allow the djvu dependency to be optional",
     )
     image_type = GObject.Property(
         type=str,
@@ -407,6 +436,9 @@ class Save(Dialog):
         self._add_metadata_widgets(grid, row)
         self._on_toggle_include_time(self.include_time)
 
+        for name in ESTIMATE_OPTIONS:
+            self.connect(f"notify::{name}", lambda *_args: self.update_estimate())
+
         # set this after self._meta_specify_widget.set_active() to prevent
         # meta_now_widget overwriting it
         if self.meta_datetime is not None and self.meta_datetime != "":
@@ -620,11 +652,18 @@ class Save(Dialog):
                 hboxps,
             ],
         )
+        # Estimated size
+        self._estimate_label = Gtk.Label()
+        self._estimate_label.set_halign(Gtk.Align.START)
+        vbox.pack_start(self._estimate_label, False, False, 0)
+
         self.show_all()
         hboxc.set_no_show_all(True)
         hboxtq.set_no_show_all(True)
         hboxps.set_no_show_all(True)
+        self._estimate_label.set_no_show_all(True)
         combobi.set_active_index(self.image_type)
+        self.update_estimate()
 
     def _image_type_changed_callback(self, widget, data):
         (
@@ -695,11 +734,39 @@ class Save(Dialog):
         else:  # don't show metadata for pre-/append to pdf
             self._meta_box_widget.hide()
 
-        if self.pdf_compression == "jpg":
+        if self.pdf_compression in ("jpg", "mrc"):
             hboxpq.show()
         else:
             hboxpq.hide()
 
+    def update_estimate(self):
+        """estimate the size of the saved file again, once the options have
+        stopped changing, e.g. because the pages have changed"""
+        if self._estimate_source is not None:
+            GLib.source_remove(self._estimate_source)
+        self._estimate_source = GLib.timeout_add(
+            ESTIMATE_DELAY, self._emit_changed_save_options
+        )
+
+    def _emit_changed_save_options(self):
+        self._estimate_source = None
+        self._estimate_serial += 1
+        if self._estimate_label is not None:
+            self._estimate_label.set_text(_("Estimating size..."))
+        self.emit("changed-save-options", self._estimate_serial)
+        return GLib.SOURCE_REMOVE
+
+    def set_estimated_size(self, serial, size):
+        """display the estimated size in bytes of the saved file, unless the
+        options have changed since the given serial number. None hides it."""
+        if serial != self._estimate_serial or self._estimate_label is None:
+            return
+        if size is None:
+            self._estimate_label.hide()
+            return
+        self._estimate_label.set_text(_("Estimated size: %s") % GLib.format_size(size))
+        self._estimate_label.show()
+
     def add_quality_spinbutton(self, vbox):
         """Set up quality spinbutton here so that it can be shown or hidden by callback"""
         hbox = Gtk.Box()
@@ -777,7 +844,7 @@ class Save(Dialog):
 
     def _pdf_compression_changed_callback(self, widget, hboxq):
         self.pdf_compression = widget.get_active_index()
-        if self.pdf_compression == "jpg":
+        if self.pdf_compression in ("jpg", "mrc"):
             hboxq.show()
         else:
             hboxq.hide()
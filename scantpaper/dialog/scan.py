@@ -36,7 +36,7 @@ class Scan(PageControls):
             GObject.SignalFlags.RUN_FIRST,
             None,
             (
-                object,  # Image object
+                object,  # Image, encoded in the storage format
                 object,  # insert_after - page id, INSERT_AT_START, or None to append
                 str,  # side to scan - "facing" or "reverse"
                 float,  # x-resolution
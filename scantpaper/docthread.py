@@ -12,10 +12,12 @@ import sqlite3
 import subprocess
 import tempfile
 import threading
+import urllib.parse
 from pathlib import Path
 
 import gi
 import tesserocr
+from basethread import Request
 from bboxtree import Bboxtree
 from const import APPLICATION_ID, THUMBNAIL, USER_VERSION
 from i18n import _
@@ -33,6 +35,18 @@ logger = logging.getLogger(__name__)
 # the document (before position 1), where no existing page precedes it.
 INSERT_AT_START = "<start>"
 
+# Requests that are run on the ExportThread rather than the DocThread
+EXPORTS = [
+    "save_pdf",
+    "save_djvu",
+    "save_tiff",
+    "save_image",
+    "save_text",
+    "save_hocr",
+    "save_multiple",
+    "estimate_size",
+]
+
 
 def _loggerise(variables):
     logger_vars = None
@@ -86,6 +100,7 @@ class DocThread(SaveThread):
         self._con = {}
         self._cur = {}
         self._write_tid = None
+        self.exporter = ExportThread(self)
         self.start()
         mlp = GLib.MainLoop()
         success = False
@@ -167,6 +182,36 @@ class DocThread(SaveThread):
         else:
             self._write_tid = tid
 
+    def do_quit(self, _request):
+        "quit the export thread with the document thread"
+        self._cleanup_thread(self.exporter.requests)
+
+    def snapshot(self):
+        """return a read-only connection to the database with a read transaction
+        started on it, so that reads through it see the database as it is now,
+        whatever the write thread does in the meantime. The connection may be
+        handed to another thread with open_snapshot()."""
+        logger.debug("Opening snapshot of database %s", self._db)
+        con = sqlite3.connect(
+            f"file:{urllib.parse.quote(str(self._db))}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+        )
+        cur = con.cursor()
+        cur.execute("BEGIN")
+        cur.execute("SELECT MAX(action_id) FROM page_order")
+        cur.fetchone()
+        return con
+
+    def open_snapshot(self, con=None):
+        """read the database in the current thread from the given snapshot, or
+        otherwise from a new one. The snapshot is released with close()."""
+        tid = threading.get_native_id()
+        if con is None:
+            con = self.snapshot()
+        self._con[tid] = con
+        self._cur[tid] = con.cursor()
+
     def do_create(self, request):
         "open a saved database"
         self._check_write_tid()
@@ -519,7 +564,10 @@ class DocThread(SaveThread):
         return result[0]
 
     def get_page(self, **kwargs):
-        "get a page from the database"
+        "get a page from the database, optionally as it was at the given action_id"
+        action_id = kwargs.get("action_id")
+        if action_id is None:
+            action_id = self._action_id
         if "id" in kwargs:
             self._execute(
                 """SELECT
@@ -529,7 +577,7 @@ class DocThread(SaveThread):
                     AND image_id = image.id
                     AND initial_page_id = ?
                     AND action_id = ?""",
-                (kwargs["id"], self._action_id),
+                (kwargs["id"], action_id),
             )
         else:
             raise ValueError("Please specify the page id")
@@ -547,6 +595,29 @@ class DocThread(SaveThread):
             image_id=row[8],
         )
 
+    def do_get_export_snapshot(self, _request):
+        """return the current action_id, which, as requests are processed in
+        order, reflects all the requests sent before this one, and a snapshot
+        of the database at that point. The snapshot is taken here, rather than
+        when the export thread reaches the export, as in the meantime the
+        action_id could be undone and reused by a later edit."""
+        return self._action_id, self.snapshot()
+
+    def export(self, process, **kwargs):
+        """run the given export on the export thread, from the state of the
+        document once the requests already sent have been processed"""
+        callbacks = _note_callbacks(kwargs)
+
+        def got_snapshot(response):
+            action_id, snapshot = response.info
+            self.exporter.send(process, kwargs, action_id, snapshot, **callbacks)
+
+        return self.send(
+            "get_export_snapshot",
+            finished_callback=got_snapshot,
+            error_callback=callbacks.get("error_callback"),
+        )
+
     def do_get_page(self, request):
         "get a page from the database on the worker thread"
         kwargs = request.args[0]
@@ -787,9 +858,14 @@ class DocThread(SaveThread):
         self._con[threading.get_native_id()].commit()
 
     def do_set_saved(self, request):
-        "mark given page as saved"
+        """mark given page as saved. If an action_id is given, only the versions
+        of the pages at that action_id are marked, so that pages edited since an
+        export started are not marked as saved."""
         self._check_write_tid()
-        if len(request.args) > 1:
+        action_id = self._action_id
+        if len(request.args) > 2:
+            page_id, saved, action_id = request.args
+        elif len(request.args) > 1:
             page_id, saved = request.args
         else:
             page_id = request.args[0]
@@ -805,7 +881,7 @@ class DocThread(SaveThread):
             (
                 saved,
                 *page_id,
-                self._action_id,
+                action_id,
             ),
         )
         self._con[threading.get_native_id()].commit()
@@ -1494,6 +1570,49 @@ class DocThread(SaveThread):
         request.data(data)
 
 
+class ExportThread(SaveThread):
+    """Save documents on a thread of their own, reading the pages from a
+    snapshot of the database, so that long exports do not hold up scanning, OCR
+    and editing on the DocThread"""
+
+    def __init__(self, doc):
+        super().__init__()
+        self._doc = doc
+        self._action_id = None
+        self.start()
+
+    def handler_wrapper(self, request, handler):
+        """run exports in the read transaction opened by the DocThread when they
+        were requested, pinned to the action_id at that point"""
+        if request.process not in EXPORTS:
+            return super().handler_wrapper(request, handler)
+        self._action_id = request.args[1]
+        self._doc.open_snapshot(request.args[2])
+        try:
+            return super().handler_wrapper(request, handler)
+        finally:
+            self._doc.close()
+            self._action_id = None
+
+    def get_page(self, **kwargs):
+        "get a page from the snapshot being exported"
+        return self._doc.get_page(action_id=self._action_id, **kwargs)
+
+    def do_set_saved(self, request):
+        "mark the exported pages as saved on the DocThread, which owns the writes"
+        self._doc.requests.put(
+            Request("set_saved", (*request.args, self._action_id), None)
+        )
+
+
+def _export_method_generator(method_name):
+    return lambda self, **kwargs: self.export(method_name, **kwargs)
+
+
+for method_name_ in EXPORTS:
+    setattr(DocThread, method_name_, _export_method_generator(method_name_))
+
+
 def _calculate_crop_tuples(options, image):
     if options["direction"] == "v":
         width = options["position"]
@@ -177,6 +177,10 @@ class Document(BaseDocument):
             kwargs["dir"] = self.dir
         kwargs["first"] = kwargs.pop("first_page")
         kwargs["last"] = kwargs.pop("last_page")
+        post_process = kwargs.pop("post_process", None)
+        if post_process is not None:
+            post_process = self._post_process_imported_pages(post_process, kwargs)
+        added_page_callback = kwargs.pop("added_page_callback", None)
 
         def _import_file_data_callback(response):
             try:
@@ -184,10 +188,57 @@ class Document(BaseDocument):
             except (AttributeError, TypeError):
                 if "logger_callback" in kwargs:
                     kwargs["logger_callback"](response)
+                return
+            if added_page_callback is not None:
+                added_page_callback(response.info["row"][2])
+            if post_process is not None:
+                post_process(response.info["row"][2])
 
         kwargs["data_callback"] = _import_file_data_callback
         self.thread.import_file(**kwargs)
 
+    def _post_process_imported_pages(self, post_process, kwargs):
+        """return a function that runs the post-processing chain on an imported
+        page, deferring the finished callback of the import until the chain has
+        finished or failed for every page"""
+        finished_callback = kwargs.get("finished_callback")
+        error_callback = kwargs.get("error_callback")
+        state = {"imported": False, "pending": 0, "response": None}
+
+        def _maybe_finished():
+            if state["imported"] and not state["pending"] and finished_callback:
+                finished_callback(state["response"])
+
+        def _import_finished_callback(response):
+            state["imported"] = True
+            state["response"] = response
+            _maybe_finished()
+
+        def _post_process_page(page_id):
+            done = []
+
+            def _page_finished_callback(*args, failed=False):
+                if failed and error_callback:
+                    error_callback(*args)
+                if not done:
+                    done.append(True)
+                    state["pending"] -= 1
+                    _maybe_finished()
+
+            options = post_process.copy()
+            options["finished_callback"] = _page_finished_callback
+            options["error_callback"] = lambda *args: _page_finished_callback(
+                *args, failed=True
+            )
+            for key in ["queued_callback", "started_callback"]:
+                if key in kwargs and key not in options:
+                    options[key] = kwargs[key]
+            state["pending"] += 1
+            self._post_process_scan(page_id, options)
+
+        kwargs["finished_callback"] = _import_finished_callback
+        return _post_process_page
+
     def _post_process_rotate(self, page_id, options):
 
         def updated_page_callback(response):
@@ -282,7 +333,7 @@ class Document(BaseDocument):
             "resolution": kwargs["resolution"],
             "format": "Portable anymap",
         }
-        for key in ["image_object", "filename", "dir"]:
+        for key in ["image_object", "image_bytes", "filename", "dir"]:
             if key in kwargs:
                 page_kwargs[key] = kwargs[key]
 
@@ -347,13 +347,14 @@ class EditMenuMixins:
         old_tmpdir = self.settings["TMPDIR"]
         self.settings = settings
 
-        if self._windows:
-            self._windows.cycle_sane_handle = self.settings["cycle sane handle"]
-            self._windows.cancel_between_pages = self.settings["cancel-between-pages"]
-            self._windows.allow_batch_flatbed = self.settings["allow-batch-flatbed"]
-            self._windows.ignore_duplex_capabilities = self.settings[
-                "ignore-duplex-capabilities"
-            ]
+        for dialog in [self._windows] + self._extra_scan_windows:
+            if dialog:
+                dialog.cycle_sane_handle = self.settings["cycle sane handle"]
+                dialog.cancel_between_pages = self.settings["cancel-between-pages"]
+                dialog.allow_batch_flatbed = self.settings["allow-batch-flatbed"]
+                dialog.ignore_duplex_capabilities = self.settings[
+                    "ignore-duplex-capabilities"
+                ]
 
         if self._windowi:
             self._windowi.include_time = self.settings["use_time"]
@@ -1,5 +1,6 @@
 "provide methods called from file menu"
 
+import collections
 import datetime
 import fcntl
 import glob
@@ -15,7 +16,9 @@ from comboboxtext import ComboBoxText
 from const import ASTERISK, EMPTY, EMPTY_LIST
 from dialog.save import Save as SaveDialog
 from helpers import collate_metadata, expand_metadata_pattern
+from hot_folder import HotFolder
 from i18n import _
+from importthread import IMPORT_WARNING
 from print_operation import PrintOperation
 
 gi.require_version("Gtk", "3.0")
@@ -286,9 +289,228 @@ class FileMenuMixins:
             db=db, delete=False, error_callback=self._error_callback
         )
 
+    def watch_folder(self, action, _param):
+        "Start or stop importing the files dropped into a folder"
+        if self._hot_folder is not None:
+            self._hot_folder.stop()
+            self._hot_folder = None
+            action.set_state(GLib.Variant("b", False))
+            return
+
+        if not self._watch_folder_dialog():
+            return
+        self._hot_folder_queue = collections.deque()
+        self._hot_folder_busy = False
+        self._hot_folder = HotFolder(
+            self.settings["hot folder"], self._hot_folder_files_callback
+        )
+        try:
+            self._hot_folder.start()
+        except GLib.Error as err:
+            logger.error("Error watching %s: %s", self.settings["hot folder"], err)
+            self._hot_folder = None
+            self._show_message_dialog(
+                parent=self,
+                message_type="error",
+                buttons=Gtk.ButtonsType.CLOSE,
+                text=_("Error watching folder %s") % (self.settings["hot folder"],),
+            )
+            return
+        action.set_state(GLib.Variant("b", True))
+
+    def _watch_folder_dialog(self):
+        "Ask which folder to watch and what to do with the files dropped into it"
+        dialog = Gtk.Dialog(
+            title=_("Watch folder"),
+            transient_for=self,
+            modal=True,
+            destroy_with_parent=True,
+        )
+        dialog.add_buttons(
+            Gtk.STOCK_OK,
+            Gtk.ResponseType.OK,
+            Gtk.STOCK_CANCEL,
+            Gtk.ResponseType.CANCEL,
+        )
+        vbox = dialog.get_content_area()
+        hbox = Gtk.Box()
+        vbox.pack_start(hbox, True, True, 0)
+        label = Gtk.Label(label=_("Folder to watch"))
+        hbox.pack_start(label, False, False, 0)
+        folder = Gtk.FileChooserButton(
+            title=_("Folder to watch"), action=Gtk.FileChooserAction.SELECT_FOLDER
+        )
+        folder.set_filename(self.settings["hot folder"] or self.settings["cwd"])
+        hbox.pack_end(folder, True, True, 0)
+
+        pbutton = Gtk.CheckButton(label=_("Post-process pages as new scans"))
+        pbutton.set_tooltip_text(
+            _(
+                "Rotate, clean up and OCR the imported pages as set in the scan "
+                "dialog"
+            )
+        )
+        pbutton.set_active(self.settings["hot folder post-processing"])
+        vbox.pack_start(pbutton, True, True, 0)
+
+        hbox = Gtk.Box()
+        vbox.pack_start(hbox, True, True, 0)
+        sbutton = Gtk.CheckButton(label=_("Save each file as PDF in"))
+        sbutton.set_tooltip_text(
+            _(
+                "Once the pages of a file have been imported and post-processed, "
+                "save them as a PDF with the same name"
+            )
+        )
+        hbox.pack_start(sbutton, False, False, 0)
+        save_dir = Gtk.FileChooserButton(
+            title=_("Save each file as PDF in"),
+            action=Gtk.FileChooserAction.SELECT_FOLDER,
+        )
+        save_dir.set_filename(
+            self.settings["hot folder save dir"] or self.settings["cwd"]
+        )
+        hbox.pack_end(save_dir, True, True, 0)
+        sbutton.connect(
+            "toggled", lambda button: save_dir.set_sensitive(button.get_active())
+        )
+        sbutton.set_active(self.settings["hot folder save dir"] is not None)
+        save_dir.set_sensitive(sbutton.get_active())
+
+        dialog.show_all()
+        response = dialog.run()
+        path = folder.get_filename()
+        if response == Gtk.ResponseType.OK and path is not None:
+            self.settings["hot folder"] = path
+            self.settings["hot folder post-processing"] = pbutton.get_active()
+            self.settings["hot folder save dir"] = (
+                save_dir.get_filename() if sbutton.get_active() else None
+            )
+        dialog.destroy()
+        return response == Gtk.ResponseType.OK and path is not None
+
+    def _hot_folder_files_callback(self, paths):
+        """Import the files that have been dropped into the watched folder.
+        If each is to be saved as a PDF, they are imported one at a time, so that
+        the pages of each file can be identified once it has been processed."""
+        if self.settings["hot folder save dir"] is None:
+            for path in paths:
+                self._import_hot_folder_file(path, self._hot_folder_file_done)
+            return
+        self._hot_folder_queue.extend(paths)
+        if not self._hot_folder_busy:
+            self._import_next_hot_folder_file()
+
+    def _import_next_hot_folder_file(self):
+        "Import the next file from the watched folder, saving it as a PDF"
+        if not self._hot_folder_queue or self._hot_folder is None:
+            self._hot_folder_busy = False
+            return
+        self._hot_folder_busy = True
+        path = self._hot_folder_queue.popleft()
+        # the pages of the file, rather than those added in the meantime, e.g.
+        # by scanning, but without any deleted since
+        page_ids = set()
+
+        def file_imported_callback(path, failed):
+            uuids = [row[2] for row in self.slist.data if row[2] in page_ids]
+            if failed or not uuids:
+                self._hot_folder_file_done(path, failed)
+                self._import_next_hot_folder_file()
+                return
+            self._save_hot_folder_file(path, uuids)
+
+        self._import_hot_folder_file(path, file_imported_callback, page_ids.add)
+
+    def _import_hot_folder_file(
+        self, path, finished_callback, added_page_callback=None
+    ):
+        """Import all the pages of a file from the watched folder, running the
+        post-processing chain on them. finished_callback(path, failed) is called
+        once, when all the pages have been processed or the import has failed.
+        added_page_callback(page_id) is called for each page imported."""
+        done = []
+
+        def file_finished(failed):
+            if not done:
+                done.append(True)
+                finished_callback(path, failed)
+
+        def import_finished_callback(response):
+            self.post_process_progress.finish(response)
+            file_finished(False)
+
+        def import_error_callback(response, *_args):
+            if response is not None and response.info == IMPORT_WARNING:
+                # the pages have been imported, and the import carries on
+                logger.warning("Warning importing %s from watched folder", path)
+                self._error_callback(response)
+                return
+            logger.error("Error importing %s from watched folder", path)
+            if response is not None:
+                self._error_callback(response)
+                if response.request.process in ["get_file_info", "import_file"]:
+                    file_finished(True)
+
+        options = {
+            "paths": [path],
+            "password_callback": lambda _path: file_finished(True),
+            "pagerange_callback": lambda info: (1, info["pages"]),
+            "queued_callback": self.post_process_progress.queued,
+            "started_callback": self.post_process_progress.update,
+            "running_callback": self.post_process_progress.update,
+            "finished_callback": import_finished_callback,
+            "error_callback": import_error_callback,
+            "added_page_callback": added_page_callback,
+        }
+        if self.settings["hot folder post-processing"]:
+            options["post_process"] = self._post_processing_options(self.settings)
+        self.slist.import_files(**options)
+
+    def _save_hot_folder_file(self, path, uuids):
+        "Save the pages of a file from the watched folder as a PDF"
+        stem = os.path.splitext(os.path.basename(path))[0]
+        filename = os.path.join(self.settings["hot folder save dir"], f"{stem}.pdf")
+        i = 1
+        while os.path.exists(filename):
+            filename = os.path.join(
+                self.settings["hot folder save dir"], f"{stem}-{i}.pdf"
+            )
+            i += 1
+
+        def save_finished_callback(response):
+            self.post_process_progress.finish(response)
+            logger.info("Saved %s from watched folder as %s", path, filename)
+            self._hot_folder_file_done(path, False)
+            self._import_next_hot_folder_file()
+
+        def save_error_callback(response):
+            self._error_callback(response)
+            self._hot_folder_file_done(path, True)
+            self._import_next_hot_folder_file()
+
+        self.slist.save_pdf(
+            path=filename,
+            list_of_pages=uuids,
+            metadata=collate_metadata(self.settings, datetime.datetime.now()),
+            options=self._pdf_options(),
+            queued_callback=self.post_process_progress.queued,
+            started_callback=self.post_process_progress.update,
+            running_callback=self.post_process_progress.update,
+            data_callback=self.post_process_progress.update,
+            finished_callback=save_finished_callback,
+            error_callback=save_error_callback,
+        )
+
+    def _hot_folder_file_done(self, path, failed):
+        "Move a file out of the watched folder once it has been processed"
+        if self._hot_folder is not None:
+            self._hot_folder.archive(path, failed)
+
     def save_dialog(self, _action, _param):
         "Display page selector and on save a fileselector."
         if self._windowi is not None:
+            self._windowi.update_estimate()
             self._windowi.present()
             return
 
@@ -303,10 +525,9 @@ class FileMenuMixins:
             "txt",
             "hocr",
             "sdb",
+            "prependpdf",
+            "appendpdf",
         ]
-        if self._dependencies["pdfunite"]:
-            image_types.extend(["prependpdf", "appendpdf"])
-
         if self._dependencies["djvu"]:
             image_types.append("djvu")
         ps_backends = []
@@ -337,10 +558,12 @@ class FileMenuMixins:
             downsample_dpi=self.settings["downsample dpi"],
             downsample=self.settings["downsample"],
             pdf_compression=self.settings["pdf compression"],
-            can_encrypt_pdf="qpdf" in self._dependencies,
+            can_encrypt_pdf=True,
             tiff_compression=self.settings["tiff compression"],
         )
 
+        self._windowi.connect("changed-save-options", self._estimate_save_size)
+
         # Frame for page range
         self._windowi.add_page_range()
         self._windowi.add_image_type()
@@ -437,6 +660,34 @@ class FileMenuMixins:
                 self.settings["quality"] = self._windowi.jpeg_quality
             self._save_image(uuids)
 
+    def _estimate_save_size(self, dialog, serial):
+        "Estimate the size of the file with the options in the save dialog"
+        pagelist = self.slist.get_page_index(dialog.page_range, lambda *_args: None)
+        if re.search(r"pdf", dialog.image_type):
+            options = {
+                "compression": dialog.pdf_compression,
+                "downsample": dialog.downsample,
+                "downsample dpi": dialog.downsample_dpi,
+                "quality": dialog.jpeg_quality,
+            }
+        else:
+            options = {
+                "compression": dialog.tiff_compression,
+                "quality": dialog.jpeg_quality,
+            }
+
+        def estimate_finished_callback(response):
+            dialog.set_estimated_size(serial, response.info)
+
+        self.slist.thread.estimate_size(
+            format=dialog.image_type,
+            list_of_pages=[self.slist.data[i][2] for i in pagelist],
+            options=options,
+            dir=self.slist.dir,
+            finished_callback=estimate_finished_callback,
+            error_callback=lambda _response: dialog.set_estimated_size(serial, None),
+        )
+
     def _save_file_chooser(self, uuids):
 
         # cd back to cwd to save
@@ -586,21 +837,26 @@ class FileMenuMixins:
 
         return True
 
-    def _save_pdf(self, filename, list_of_page_uuids, option):
-        "Save selected pages as PDF under given name."
-
-        # Compile options
-        options = {
+    def _pdf_options(self):
+        "Compile the options for saving a PDF from the settings"
+        return {
             "compression": self.settings["pdf compression"],
             "downsample": self.settings["downsample"],
             "downsample dpi": self.settings["downsample dpi"],
             "quality": self.settings["quality"],
-            "user-password": self._windowi.pdf_user_password,
             "set_timestamp": self.settings["set_timestamp"],
             "convert whitespace to underscores": self.settings[
                 "convert whitespace to underscores"
             ],
+            "pdfa": self.settings["pdfa"],
         }
+
+    def _save_pdf(self, filename, list_of_page_uuids, option):
+        "Save selected pages as PDF under given name."
+
+        # Compile options
+        options = self._pdf_options()
+        options["user-password"] = self._windowi.pdf_user_password
         if option == "prependpdf":
             options["prepend"] = filename
 
@@ -619,7 +875,6 @@ class FileMenuMixins:
 
         def save_pdf_finished_callback(response):
             self.post_process_progress.finish(response)
-            self.slist.thread.send("set_saved", list_of_page_uuids)
             if (
                 "view files toggle" in self.settings
                 and self.settings["view files toggle"]
@@ -664,7 +919,6 @@ class FileMenuMixins:
         def save_djvu_finished_callback(response):
             filename = response.request.args[0]["path"]
             self.post_process_progress.finish(response)
-            self.slist.thread.send("set_saved", uuids)
             if (
                 "view files toggle" in self.settings
                 and self.settings["view files toggle"]
@@ -697,7 +951,6 @@ class FileMenuMixins:
         def save_tiff_finished_callback(response):
             filename = response.request.args[0]["path"]
             self.post_process_progress.finish(response)
-            self.slist.thread.send("set_saved", uuids)
             file = ps if ps is not None else filename
             if (
                 "view files toggle" in self.settings
@@ -726,7 +979,6 @@ class FileMenuMixins:
 
         def save_text_finished_callback(response):
             self.post_process_progress.finish(response)
-            self.slist.thread.send("set_saved", uuids)
             if (
                 "view files toggle" in self.settings
                 and self.settings["view files toggle"]
@@ -753,7 +1005,6 @@ class FileMenuMixins:
             options["post_save_hook"] = self.settings["current_psh"]
 
         def save_hocr_finished_callback(response):
-            self.slist.thread.send("set_saved", uuids)
             self.post_process_progress.finish(response)
             if (
                 "view files toggle" in self.settings
@@ -848,7 +1099,6 @@ class FileMenuMixins:
             def save_image_finished_callback(response):
                 filename = response.request.args[0]["path"]
                 self.post_process_progress.finish(response)
-                self.slist.thread.send("set_saved", uuids)
                 if (
                     "view files toggle" in self.settings
                     and self.settings["view files toggle"]
@@ -937,6 +1187,8 @@ class FileMenuMixins:
             ) = self._windows.get_size()
             logger.info("Killing Sane thread(s)")
             self._windows.thread.quit()
+        for dialog in self._extra_scan_windows:
+            dialog.thread.quit()
 
         # Write config file
         config.write_config(self._configfile, self.settings)
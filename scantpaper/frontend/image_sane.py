@@ -9,9 +9,14 @@ from types import SimpleNamespace
 import sane
 from basethread import BaseThread
 from frontend import enums
+from page import encode_for_storage
 
 logger = logging.getLogger(__name__)
 
+# Values of the compression option offered by backends such as fujitsu,
+# epjitsu and canon_dr for uncompressed frames
+UNCOMPRESSED = ("None", "none")
+
 # Global flag to track if sane.init() has been called
 # Using a list so we can modify it from within functions
 _sane_initialized = [False]
@@ -36,6 +41,9 @@ class SaneThread(BaseThread):
     device_name = None
     num_pages_scanned = 0
     num_pages = 0
+    # Whilst the scan dialog is built from the option cache, option values are
+    # served from here, so that the GUI does not block behind open_device
+    cached_option_values = None
 
     def handler_wrapper(self, request, handler):
         "override the handler wrapper logic to deal with SANE_STATUS_NO_DOCS"
@@ -126,6 +134,24 @@ class SaneThread(BaseThread):
         finally:
             event.set()
 
+    def do_get_option_values(self, _request):
+        "read the values of all readable options, e.g. to populate the option cache"
+        values = {}
+        for option in self.device_handle.get_options():
+            name, opt_type, cap = option[1], option[4], option[7]
+            if (
+                not name
+                or opt_type in (enums.TYPE_GROUP, enums.TYPE_BUTTON)
+                or cap & enums.CAP_INACTIVE
+                or not cap & enums.CAP_SOFT_DETECT
+            ):
+                continue
+            try:
+                values[name] = getattr(self.device_handle, name.replace("-", "_"))
+            except AttributeError:
+                pass
+        return values
+
     def do_set_option(self, request):
         """Until sane.__setattr__() returns the INFO, put its functionality
         here to return it ourselves"""
@@ -174,7 +200,9 @@ class SaneThread(BaseThread):
         if self.device_handle is None:
             raise ValueError("must open device before starting scan")
         cancel_between_pages = request.args[0] if request.args else False
+        encode = request.args[1] if len(request.args) > 1 else False
         self.scan_page_progress = 0.0
+        self._ensure_uncompressed_frames()
         logger.debug("calling sane_start() on device %s", self.device_name)
         self.device_handle.start()
         logger.debug("sane_start() returned successfully")
@@ -188,9 +216,39 @@ class SaneThread(BaseThread):
                 self.scan_page_progress = min(1.0, current_line / total_lines)
 
         self._scan_progress_cb = _progress_cb
-        return self.device_handle.snap(
+        image = self.device_handle.snap(
             no_cancel=not cancel_between_pages, progress=self._scan_progress_cb
         )
+        if encode:
+            # Encode here, so that only the compact bytes cross threads, and the
+            # uncompressed frame is freed as soon as the worker is done with it
+            return encode_for_storage(image)
+        return image
+
+    def _ensure_uncompressed_frames(self):
+        """python-sane can only read grey and RGB frames, and fails with
+        'Invalid frame format' if the backend delivers compressed (e.g. JPEG)
+        ones, so fall back to uncompressed frames. The page is then encoded once,
+        in do_scan_page(), and that encoding is passed through to PDFs."""
+        opt = self.device_handle.opt.get("compression")
+        if (
+            opt is None
+            or not isinstance(opt.constraint, list)
+            or not enums.OPTION_IS_ACTIVE(opt.cap)
+        ):
+            return
+        value = self.device_handle.compression
+        if value in UNCOMPRESSED:
+            return
+        for raw in opt.constraint:
+            if raw in UNCOMPRESSED:
+                logger.warning(
+                    "Unable to read %s-compressed frames. Setting compression to %s",
+                    value,
+                    raw,
+                )
+                self.device_handle.compression = raw
+                return
 
     def do_cancel(self, _request):
         "cancel"
@@ -223,12 +281,22 @@ class SaneThread(BaseThread):
         "get option"
         return self.send("get_option", name, **kwargs)
 
+    def get_option_values(self, **kwargs):
+        "get option values"
+        return self.send("get_option_values", **kwargs)
+
     def set_option(self, name, value, **kwargs):
         "set option"
+        if self.cached_option_values is not None:
+            self.cached_option_values[name] = value
         return self.send("set_option", name, value, **kwargs)
 
     def get_option_value(self, name, timeout=10):
         "synchronously fetch a single option value via the worker thread"
+        if self.cached_option_values is not None:
+            if name not in self.cached_option_values:
+                raise AttributeError(f"Option '{name}' not in cache")
+            return self.cached_option_values[name]
         holder = []
         event = threading.Event()
         self.send("get_option_blocking", name, holder, event)
@@ -239,13 +307,15 @@ class SaneThread(BaseThread):
             raise result
         return result
 
-    def scan_page(self, cancel_between_pages=False, **kwargs):
-        "scan page"
-        return self.send("scan_page", cancel_between_pages, **kwargs)
+    def scan_page(self, cancel_between_pages=False, encode=False, **kwargs):
+        """scan page. If encode is True, return the page encoded in the storage
+        format, rather than as a PIL image"""
+        return self.send("scan_page", cancel_between_pages, encode, **kwargs)
 
     def _scan_pages_finished_callback(self, response, **kwargs):
         _set_default_callbacks(kwargs)
         cancel_between_pages = kwargs.get("cancel_between_pages", False)
+        encode = kwargs.get("encode", False)
         if response.info is not None:
             self.num_pages_scanned += 1
             if kwargs["new_page_callback"] is not None:
@@ -259,12 +329,14 @@ class SaneThread(BaseThread):
             return
         self.scan_page(
             cancel_between_pages=cancel_between_pages,
+            encode=encode,
             started_callback=kwargs["started_callback"],
             running_callback=kwargs["running_callback"],
             error_callback=kwargs["error_callback"],
             finished_callback=lambda response: self._scan_pages_finished_callback(
                 response,
                 cancel_between_pages=cancel_between_pages,
+                encode=encode,
                 running_callback=kwargs["running_callback"],
                 finished_callback=kwargs["finished_callback"],
                 error_callback=kwargs["error_callback"],
@@ -272,19 +344,21 @@ class SaneThread(BaseThread):
             ),
         )
 
-    def scan_pages(self, cancel_between_pages=False, **kwargs):
+    def scan_pages(self, cancel_between_pages=False, encode=False, **kwargs):
         "scan pages"
         self.num_pages_scanned = 0
         self.num_pages = kwargs["num_pages"]
         _set_default_callbacks(kwargs)
         return self.scan_page(
             cancel_between_pages=cancel_between_pages,
+            encode=encode,
             started_callback=kwargs["started_callback"],
             running_callback=kwargs["running_callback"],
             error_callback=kwargs["error_callback"],
             finished_callback=lambda response: self._scan_pages_finished_callback(
                 response,
                 cancel_between_pages=cancel_between_pages,
+                encode=encode,
                 running_callback=kwargs["running_callback"],
                 finished_callback=kwargs["finished_callback"],
                 error_callback=kwargs["error_callback"],
@@ -0,0 +1,159 @@
+"Watch a folder for new files to import"
+
+import logging
+import os
+import shutil
+import time
+
+from gi.repository import Gio, GLib
+
+logger = logging.getLogger(__name__)
+
+IMPORTABLE_EXTENSIONS = {
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".pnm",
+    ".ppm",
+    ".pgm",
+    ".pbm",
+    ".gif",
+    ".tif",
+    ".tiff",
+    ".pdf",
+    ".djvu",
+}
+IMPORTED_DIR = "imported"
+FAILED_DIR = "failed"
+CHECK_INTERVAL = 1  # s
+SETTLE_TIME = 2  # s
+RESCAN_INTERVAL = 30  # s
+
+
+class HotFolder:
+    """Watch a folder with a Gio.FileMonitor, and pass new files to a callback
+    once they have stopped growing. Files are checked for completeness on the
+    main loop, and those found complete at the same time are passed together,
+    sorted by name. The folder is also rescanned periodically, in case events
+    are missed, e.g. on network filesystems."""
+
+    def __init__(self, path, callback, settle_time=SETTLE_TIME):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.settle_time = settle_time
+        self._monitor = None
+        self._source = None
+        self._last_rescan = 0
+        self._pending = {}  # path -> (size, mtime) at the last check
+        self._seen = set()
+
+    def start(self):
+        "start watching the folder, queuing the files already in it"
+        gfile = Gio.File.new_for_path(self.path)
+        self._monitor = gfile.monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+        self._monitor.connect("changed", self._changed_callback)
+        self._rescan()
+        self._source = GLib.timeout_add_seconds(CHECK_INTERVAL, self._check_pending)
+        logger.info("Watching %s for new files", self.path)
+
+    def stop(self):
+        "stop watching the folder"
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        if self._source is not None:
+            GLib.source_remove(self._source)
+            self._source = None
+        self._pending = {}
+        logger.info("Stopped watching %s", self.path)
+
+    @property
+    def running(self):
+        "whether the folder is being watched"
+        return self._monitor is not None
+
+    def archive(self, path, failed=False):
+        """move a file that has been passed to the callback into the imported or
+        failed subfolder, so that it is not imported again"""
+        subdir = os.path.join(self.path, FAILED_DIR if failed else IMPORTED_DIR)
+        os.makedirs(subdir, exist_ok=True)
+        target = os.path.join(subdir, os.path.basename(path))
+        stem, ext = os.path.splitext(target)
+        i = 1
+        while os.path.exists(target):
+            target = f"{stem}-{i}{ext}"
+            i += 1
+        try:
+            shutil.move(path, target)
+        except OSError as err:
+            logger.error("Error moving %s to %s: %s", path, subdir, err)
+            return None
+        self._seen.discard(path)
+        return target
+
+    def _changed_callback(self, _monitor, gfile, other_file, event_type):
+        if event_type == Gio.FileMonitorEvent.MOVED_IN:
+            self._queue(gfile.get_path())
+        elif event_type == Gio.FileMonitorEvent.RENAMED:
+            self._queue(other_file.get_path())
+        elif event_type in (
+            Gio.FileMonitorEvent.CREATED,
+            Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+        ):
+            self._queue(gfile.get_path())
+
+    def _queue(self, path):
+        "note a file to be checked for completeness"
+        if (
+            path is None
+            or path in self._seen
+            or path in self._pending
+            or os.path.dirname(path) != self.path
+        ):
+            return
+        name = os.path.basename(path)
+        if name.startswith(".") or os.path.splitext(name)[1].lower() not in (
+            IMPORTABLE_EXTENSIONS
+        ):
+            return
+        self._pending[path] = None
+
+    def _rescan(self):
+        "queue any files in the folder that were missed"
+        self._last_rescan = time.monotonic()
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        self._queue(entry.path)
+        except OSError as err:
+            logger.error("Error reading %s: %s", self.path, err)
+
+    def _check_pending(self):
+        "pass on the files whose size and mtime have settled"
+        if time.monotonic() - self._last_rescan > RESCAN_INTERVAL:
+            self._rescan()
+        now = time.time()
+        ready = []
+        for path, previous in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime)
+            if (
+                stat.st_size
+                and current == previous
+                and now - stat.st_mtime >= self.settle_time
+            ):
+                del self._pending[path]
+                ready.append(path)
+            else:
+                self._pending[path] = current
+        if ready:
+            ready.sort()
+            self._seen.update(ready)
+            logger.info("New files in %s: %s", self.path, ready)
+            self.callback(ready)
+        return GLib.SOURCE_CONTINUE
@@ -1,7 +1,12 @@
 "Threading model for the Document class"
 
+import collections
+import concurrent.futures
 import glob
+import io
+import itertools
 import logging
+import math
 import os
 import pathlib
 import re
@@ -10,18 +15,25 @@ import tempfile
 import threading
 
 from basethread import BaseThread
+from const import POINTS_PER_INCH
 from helpers import exec_command
 from i18n import _
-from page import Page
-from PIL import Image
+from page import Page, encode_for_storage
+from PIL import Image, ImageSequence
+import pikepdf
+from pikepdf.models.metadata import decode_pdf_date
 
 logger = logging.getLogger(__name__)
-
-image_format = {
-    "pnm": "Portable anymap",
-    "ppm": "Portable pixmap format (color)",
-    "pgm": "Portable graymap format (gray scale)",
-    "pbm": "Portable bitmap format (black and white)",
+MAGIC_LENGTH = 16
+# The info of errors reported for imports that nevertheless carry on, so that
+# they can be told apart from failures
+IMPORT_WARNING = "warning"
+DOCINFO_KEYS = {
+    "/Title": "title",
+    "/Subject": "subject",
+    "/Keywords": "keywords",
+    "/Author": "author",
+    "/CreationDate": "datetime",
 }
 
 
@@ -29,6 +41,30 @@ class CancelledError(RuntimeError):
     "Raised when a job is cancelled"
 
 
+class ExtractionError(RuntimeError):
+    "Raised when the images cannot be extracted from a page"
+
+
+class _DeferredRequest:
+    "Collects the responses of a job run ahead of its request, to replay onto it"
+
+    def __init__(self):
+        self.responses = []
+
+    def data(self, info, status=None):
+        "data notification"
+        self.responses.append(("data", info, status))
+
+    def error(self, info, status=None):
+        "error notification"
+        self.responses.append(("error", info, status))
+
+    def replay(self, request):
+        "send the collected responses on the request"
+        for name, info, status in self.responses:
+            getattr(request, name)(info, status)
+
+
 class Importhread(BaseThread):
     "subclass basethread for document"
 
@@ -40,6 +76,7 @@ class Importhread(BaseThread):
         self.progress = None
         self.cancel = False
         self.paper_sizes = {}
+        self._probe_executor = None
 
     def do_cancel(self, _request):
         "cancel running tasks"
@@ -52,46 +89,52 @@ class Importhread(BaseThread):
 
     def do_get_file_info(self, request):
         "get file info"
-        path, password = request.args
+        path, password, *probe = request.args
+        if probe:
+            deferred, future = probe[0]
+            try:
+                return future.result()
+            finally:
+                deferred.replay(request)
+        return self._probe_file(path, password, request)
+
+    def _probe_file(self, path, password, request):
+        "identify the file from its magic bytes and read its page count and sizes"
         info = {}
         if not pathlib.Path(path).exists():
             raise FileNotFoundError(_("File %s not found") % (path,))
 
         logger.info("Getting info for %s", path)
-        proc = exec_command(["file", "-Lb", path])
-        if proc.stdout is None:
-            raise RuntimeError(
-                _("Error getting file info for %s: %s") % (path, proc.stderr)
-            )
-        proc.stdout = proc.stdout.rstrip()
-        logger.info("Format: '%s'", proc.stdout)
-        if proc.stdout in ["very short file (no magic)", "empty"]:
+        with open(path, "rb") as fhd:
+            header = fhd.read(MAGIC_LENGTH)
+        if not header:
             raise RuntimeError(_("Error importing zero-length file %s.") % (path,))
+        file_format = _sniff_format(header)
+        logger.info("Format: '%s'", file_format)
 
-        if re.search(r"SQLite[ ]3.x[ ]database", proc.stdout):
+        if file_format == "session file":
             info["path"] = path
-            info["format"] = "session file"
+            info["format"] = file_format
 
-        elif re.search(r"DjVu", proc.stdout):
+        elif file_format == "DJVU":
             self._get_djvu_info(info, path)
 
-        elif re.search(r"PDF[ ]document", proc.stdout):
+        elif file_format == "Portable Document Format":
             self._get_pdf_info(info, path, password, request)
 
-        elif re.search(r"^TIFF[ ]image[ ]data", proc.stdout):
+        elif file_format == "Tagged Image File Format":
             self._get_tif_info(info, path, request)
 
         else:
             # Get file type
-            image = Image.open(path)
-
-            self.check_cancelled()
-            info["format"] = image.format
+            with Image.open(path) as image:
+                self.check_cancelled()
+                info["format"] = image.format
 
-            logger.info("Format %s", info["format"])
-            info["width"] = [image.width]
-            info["height"] = [image.height]
-            info["pages"] = 1
+                logger.info("Format %s", info["format"])
+                info["width"] = [image.width]
+                info["height"] = [image.height]
+                info["pages"] = 1
 
         info["path"] = path
         return info
@@ -158,95 +201,43 @@ class Importhread(BaseThread):
     def _get_pdf_info(self, info, path, password, request):
         "get PDF info"
         info["format"] = "Portable Document Format"
-        args = ["pdfinfo", "-isodates", path]
-        if password is not None:
-            args.insert(2, "-upw")
-            args.insert(3, password)
-
         try:
-            process = subprocess.run(args, capture_output=True, text=True, check=True)
-        except subprocess.CalledProcessError as err:
-            logger.info("stdout: %s", err.stdout)
-            logger.info("stderr: %s", err.stderr)
-            if err.stderr is not None and re.search(
-                r"Incorrect[ ]password",
-                err.stderr,
-                re.MULTILINE | re.DOTALL | re.VERBOSE,
-            ):
-                info["encrypted"] = True
-                return
-            request.error(err.stderr)
+            pdf = pikepdf.open(path, password="" if password is None else password)
+        except pikepdf.PasswordError:
+            info["encrypted"] = True
+            return
+        except pikepdf.PdfError as err:
+            logger.info("Error opening %s: %s", path, err)
+            request.error(str(err))
             return
 
-        info["pages"] = 1
-        regex = re.search(
-            r"Pages:\s+(\d+)",
-            process.stdout,
-            re.MULTILINE | re.DOTALL | re.VERBOSE,
-        )
-        if regex:
-            info["pages"] = int(regex.group(1))
-
-        logger.info("%s pages", info["pages"])
-        floatr = r"\d+(?:[.]\d*)?"
-        regex = re.search(
-            rf"Page\ssize:\s+({floatr})\s+x\s+({floatr})\s+(\w+)",
-            process.stdout,
-            re.MULTILINE | re.DOTALL | re.VERBOSE,
-        )
-        if regex:
-            info["page_size"] = [
-                float(regex.group(1)),
-                float(regex.group(2)),
-                regex.group(3),
-            ]
-            logger.info(
-                "Page size: %s x %s %s",
-                regex.group(1),
-                regex.group(2),
-                regex.group(3),
-            )
+        with pdf:
+            info["pages"] = len(pdf.pages)
+            logger.info("%s pages", info["pages"])
+            if info["pages"]:
+                info["page_size"] = _pdf_page_size(pdf.pages[0])
+                logger.info("Page size: %s x %s %s", *info["page_size"])
 
-        self.check_cancelled()
+            self.check_cancelled()
 
-        # extract the metadata from the file
-        _add_metadata_to_info(info, process.stdout, r":\s+([^\n]+)")
+            # extract the metadata from the file
+            _add_docinfo_to_info(info, pdf.docinfo)
 
     def _get_tif_info(self, info, path, request):
         "get TIFF info"
         info["format"] = "Tagged Image File Format"
-        proc = exec_command(["tiffinfo", path])
-        if proc.stdout is None:
-            raise RuntimeError(
-                _("Please install libtiff-tools in order to open TIFF files: %s")
-                % (proc.stderr,)
-            )
-
-        self.check_cancelled()
-        logger.info(info)
-
-        # Count number of pages
-        info["pages"] = len(
-            re.findall(
-                r"TIFF[ ]Directory[ ]at[ ]offset",
-                proc.stdout,
-                re.MULTILINE | re.DOTALL | re.VERBOSE,
-            )
-        )
-        logger.info("%s pages", info["pages"])
 
         # Dig out the size of each page
         width, height = [], []
-        regex = re.findall(
-            r"Image\sWidth:\s(\d+)\sImage\sLength:\s(\d+)",
-            proc.stdout,
-            re.MULTILINE | re.DOTALL | re.VERBOSE,
-        )
-        for _w, _h in regex:
-            width.append(int(_w))
-            height.append(int(_h))
-            request.data(f"Page {len(width)} is {width[-1]}x{height[-1]}")
-
+        with Image.open(path) as image:
+            for frame in ImageSequence.Iterator(image):
+                self.check_cancelled()
+                width.append(frame.width)
+                height.append(frame.height)
+                request.data(f"Page {len(width)} is {width[-1]}x{height[-1]}")
+
+        info["pages"] = len(width)
+        logger.info("%s pages", info["pages"])
         info["width"] = width
         info["height"] = height
 
@@ -278,36 +269,47 @@ class Importhread(BaseThread):
                     }
                 )
 
-            # Split the tiff into its pages and import them individually
+            # Decode the frames of the tiff and import them individually,
+            # falling back to splitting out any that PIL cannot decode with
+            # tiffcp. PIL images must not be shared between threads, so each
+            # worker opens the file itself.
             elif args["last"] >= args["first"] and args["first"] > 0:
-                for i in range(args["first"] - 1, args["last"] - 1 + 1):
-                    self.progress = i / (args["last"] - args["first"] + 1)
-                    self.message = _("Importing page %i of %i") % (
-                        i,
-                        args["last"] - args["first"] + 1,
-                    )
-                    tif = None
+                local = threading.local()
+                opened = []
+
+                def prepare(i):
+                    kwargs = {
+                        "dir": args["dir"],
+                        "format": args["info"]["format"],
+                        "width": args["info"]["width"][i - 1],
+                        "height": args["info"]["height"][i - 1],
+                    }
+                    if not hasattr(local, "tiff"):
+                        local.tiff = Image.open(args["info"]["path"])
+                        opened.append(local.tiff)
+                    try:
+                        local.tiff.seek(i - 1)
+                        return [_page_from_image(local.tiff, **kwargs)]
+                    except (OSError, ValueError, EOFError) as err:
+                        logger.warning("Falling back to tiffcp for page %s: %s", i, err)
+                        del local.tiff
                     with tempfile.NamedTemporaryFile(
                         dir=args["dir"], suffix=".tif"
                     ) as tif:
                         subprocess.run(
-                            ["tiffcp", f"{args['info']['path']},{i}", tif.name],
+                            ["tiffcp", f"{args['info']['path']},{i - 1}", tif.name],
                             check=True,
                         )
                         self.check_cancelled()
-                        page = Page(
-                            filename=tif.name,
-                            dir=args["dir"],
-                            format=args["info"]["format"],
-                            width=args["info"]["width"][i - 1],
-                            height=args["info"]["height"][i - 1],
-                        )
-                        request.data(
-                            {
-                                "type": "page",
-                                "row": self.add_page(page),
-                            }
-                        )
+                        return [_page_from_file(tif.name, **kwargs)]
+
+                try:
+                    self._import_pages(
+                        request, range(args["first"], args["last"] + 1), prepare
+                    )
+                finally:
+                    for image in opened:
+                        image.close()
 
         else:
             page = Page(
@@ -326,66 +328,91 @@ class Importhread(BaseThread):
             )
 
     def get_file_info(self, path, password, **kwargs):
-        "get file info"
-        return self.send("get_file_info", path, password, **kwargs)
+        """get file info. The file is probed straight away on a pool of worker
+        threads, so that files dropped together are probed concurrently, rather
+        than one after the other as their requests reach the thread."""
+        request = _DeferredRequest()
+        if self._probe_executor is None:
+            self._probe_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count(), thread_name_prefix="probe"
+            )
+        future = self._probe_executor.submit(self._probe_file, path, password, request)
+        return self.send("get_file_info", path, password, (request, future), **kwargs)
 
     def import_file(self, **kwargs):
         "import file"
         callbacks = _note_callbacks(kwargs)
         return self.send("import_file", kwargs, **callbacks)
 
+    def _import_pages(self, request, numbers, prepare):
+        """call prepare() for each page number on a pool of worker threads, and
+        add the pages that it returns to the document in order. Only a few pages
+        are prepared ahead of the one being added, to limit memory use."""
+        numbers = list(numbers)
+        workers = max(1, min(os.cpu_count() or 1, len(numbers)))
+        remaining = iter(numbers)
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for i in itertools.islice(remaining, 2 * workers):
+                    pending.append(executor.submit(prepare, i))
+                for n, i in enumerate(numbers, start=1):
+                    self.progress = (n - 1) / len(numbers)
+                    self.message = _("Importing page %i of %i") % (n, len(numbers))
+                    pages = pending.popleft().result()
+                    for j in itertools.islice(remaining, 1):
+                        pending.append(executor.submit(prepare, j))
+                    self.check_cancelled()
+                    for page in pages:
+                        request.data(
+                            {
+                                "type": "page",
+                                "row": self.add_page(page),
+                            }
+                        )
+            finally:
+                for future in pending:
+                    future.cancel()
+
     def _do_import_djvu(self, request):
         args = request.args[0]
         # Extract images from DjVu
         if args["last"] >= args["first"] and args["first"] > 0:
-            for i in range(args["first"], args["last"] + 1):
-                self.progress = (i - 1) / (args["last"] - args["first"] + 1)
-                self.message = _("Importing page %i of %i") % (
-                    i,
-                    args["last"] - args["first"] + 1,
+            # Extract the text and annotation layers of the whole range
+            # alongside the images
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                layers = executor.submit(
+                    self._extract_text_from_djvu, request, args["first"], args["last"]
                 )
-                with tempfile.NamedTemporaryFile(dir=args["dir"], suffix=".tif") as tif:
-                    subprocess.run(
-                        [
-                            "ddjvu",
-                            "-format=tiff",
-                            f"-page={i}",
-                            args["info"]["path"],
+
+                def prepare(i):
+                    with tempfile.NamedTemporaryFile(
+                        dir=args["dir"], suffix=".tif"
+                    ) as tif:
+                        subprocess.run(
+                            [
+                                "ddjvu",
+                                "-format=tiff",
+                                f"-page={i}",
+                                args["info"]["path"],
+                                tif.name,
+                            ],
+                            check=True,
+                        )
+                        self.check_cancelled()
+                        page = _page_from_file(
                             tif.name,
-                        ],
-                        check=True,
-                    )
-                    txt = subprocess.check_output(
-                        [
-                            "djvused",
-                            args["info"]["path"],
-                            "-e",
-                            f"select {i}; print-txt",
-                        ],
-                        text=True,
-                    )
-                    ann = subprocess.check_output(
-                        [
-                            "djvused",
-                            args["info"]["path"],
-                            "-e",
-                            f"select {i}; print-ant",
-                        ],
-                        text=True,
-                    )
-                    self.check_cancelled()
-                    page = Page(
-                        filename=tif.name,
-                        dir=args["dir"],
-                        format="Tagged Image File Format",
-                        resolution=(
-                            args["info"]["ppi"][i - 1],
-                            args["info"]["ppi"][i - 1],
-                            "PixelsPerInch",
-                        ),
-                        width=args["info"]["width"][i - 1],
-                        height=args["info"]["height"][i - 1],
-                    )
+                            dir=args["dir"],
+                            format="Tagged Image File Format",
+                            resolution=(
+                                args["info"]["ppi"][i - 1],
+                                args["info"]["ppi"][i - 1],
+                                "PixelsPerInch",
+                            ),
+                            width=args["info"]["width"][i - 1],
+                            height=args["info"]["height"][i - 1],
+                        )
+                    txt, ann = layers.result()[i - args["first"]]
                     try:
                         page.import_djvu_txt(txt)
                     except (PermissionError, IOError, ValueError) as err:
@@ -400,69 +427,98 @@ class Importhread(BaseThread):
                             "Caught error parsing DjVU annotation layer: %s", err
                         )
                         request.error("Error: parsing DjVU annotation layer")
+                    return [page]
 
-                    request.data(
-                        {
-                            "type": "page",
-                            "row": self.add_page(page),
-                        }
+                self._import_pages(
+                    request, range(args["first"], args["last"] + 1), prepare
+                )
+
+    def _extract_text_from_djvu(self, request, first, last):
+        """return the text and annotation layers of each page in the range as a
+        list of (print-txt, print-ant) output, from a single djvused run. The
+        output of each command is terminated by that of n, the number of pages,
+        which cannot otherwise appear on a line of its own."""
+        args = request.args[0]
+        marker = str(args["info"]["pages"])
+        script = "; ".join(
+            f"select {i}; print-txt; n; print-ant; n" for i in range(first, last + 1)
+        )
+        try:
+            out = subprocess.check_output(
+                ["djvused", args["info"]["path"], "-e", script], text=True
+            )
+            chunks = _split_on_marker(out, marker)
+        except subprocess.CalledProcessError as err:
+            logger.warning("Falling back to djvused per page: %s", err)
+            chunks = []
+        if len(chunks) != 2 * (last - first + 1):
+            chunks = []
+            for i in range(first, last + 1):
+                for command in ("print-txt", "print-ant"):
+                    chunks.append(
+                        subprocess.check_output(
+                            [
+                                "djvused",
+                                args["info"]["path"],
+                                "-e",
+                                f"select {i}; {command}",
+                            ],
+                            text=True,
+                        )
                     )
+        self.check_cancelled()
+        return list(zip(chunks[0::2], chunks[1::2]))
 
     def _do_import_pdf(self, request):
         args = request.args[0]
 
-        # Extract images from PDF
-        warning_flag = False
-        for i in range(args["first"], args["last"] + 1):
-            # Remove any extraction files left over from a previous page
-            for fname in glob.glob("x-*"):
-                os.remove(fname)
-
-            out = subprocess.check_output(
-                _pdf_cmd_with_password(
-                    [
-                        "pdfimages",
-                        "-f",
-                        str(i),
-                        "-l",
-                        str(i),
-                        "-list",
-                        args["info"]["path"],
-                    ],
-                    args["password"],
-                ),
-                text=True,
-            )
-            entries = _parse_pdfimages_list(out)
+        # Extract the images in-process, only falling back to pdfimages for
+        # pages with images that pikepdf cannot decode. pikepdf objects must
+        # not be shared between threads, so each worker opens the PDF itself.
+        local = threading.local()
+        opened = []
+        warnings = []
+        # Extract the text layer of the whole range alongside the images
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        texts = executor.submit(
+            self._extract_text_from_pdf, request, args["first"], args["last"]
+        )
 
-            try:
-                subprocess.run(
-                    _pdf_cmd_with_password(
-                        [
-                            "pdfimages",
-                            "-f",
-                            str(i),
-                            "-l",
-                            str(i),
-                            args["info"]["path"],
-                            "x",
-                        ],
-                        args["password"],
-                    ),
-                    check=True,
-                )
-            except subprocess.CalledProcessError:
-                request.error(_("Error extracting images from PDF"))
-                return
+        def prepare(i):
+            if not hasattr(local, "pdf"):
+                local.pdf = _open_pdf(args["info"]["path"], args["password"])
+                if local.pdf is not None:
+                    opened.append(local.pdf)
+            images = None
+            if local.pdf is not None:
+                images = _extract_pdf_page_images(local.pdf.pages[i - 1])
+            if images is None:
+                try:
+                    images = self._extract_images_with_pdfimages(request, i)
+                except subprocess.CalledProcessError as err:
+                    raise ExtractionError(
+                        _("Error extracting images from PDF")
+                    ) from err
             self.check_cancelled()
+            if len(images) != 1:
+                warnings.append(i)
+            return self._pages_from_pdf_images(
+                request, images, texts.result()[i - args["first"]]
+            )
 
-            images_and_resolution, warning = _correlate_pdf_images(entries)
-            warning_flag = warning_flag or warning
-            self._import_pdf_images(request, i, images_and_resolution)
+        try:
+            self._import_pages(request, range(args["first"], args["last"] + 1), prepare)
+        except ExtractionError as err:
+            request.error(str(err))
+            return
+        finally:
+            executor.shutdown()
+            for pdf in opened:
+                pdf.close()
 
-        if warning_flag:
+        if warnings:
             request.error(
-                None,
+                IMPORT_WARNING,
                 _(
                     "Warning: scantpaper expects one image per page, but "
                     "this was not satisfied. It is probable that the PDF "
@@ -472,61 +528,204 @@ class Importhread(BaseThread):
                 ),
             )
 
-    def _import_pdf_images(self, request, i, images_and_resolution):
-        "import the images extracted from a PDF page"
-        for fname, xresolution, yresolution, mask_fname in images_and_resolution:
-            if mask_fname is not None:
-                _composite_over_white(fname, mask_fname)
-                os.remove(mask_fname)
-            regex = re.search(r"([^.]+)$", fname, re.MULTILINE | re.DOTALL | re.VERBOSE)
-            if regex:
-                ext = regex.group(1)
-                try:
-                    page = Page(
-                        filename=fname,
-                        dir=request.args[0]["dir"],
-                        format=image_format[ext],
-                        resolution=(xresolution, yresolution, "PixelsPerInch"),
-                    )
-                    page.import_pdftotext(self._extract_text_from_pdf(request, i))
-                    request.data(
-                        {
-                            "type": "page",
-                            "row": self.add_page(page),
-                        }
-                    )
-                    os.remove(fname)
-                except (PermissionError, IOError) as err:
-                    logger.error("Caught error importing PDF: %s", err)
-                    request.error(_("Error importing PDF"))
-
-    def _extract_text_from_pdf(self, request, i):
+    def _extract_images_with_pdfimages(self, request, i):
+        """extract the images from page i with pdfimages into a temporary
+        directory, returning them as for _extract_pdf_page_images(). DCT
+        streams are written as JPEGs with -j and kept as they are."""
         args = request.args[0]
-        with tempfile.NamedTemporaryFile(
-            mode="w+t", dir=args["dir"], suffix=".html"
-        ) as html:
-            spo = subprocess.run(
+        out = subprocess.check_output(
+            _pdf_cmd_with_password(
+                [
+                    "pdfimages",
+                    "-f",
+                    str(i),
+                    "-l",
+                    str(i),
+                    "-list",
+                    args["info"]["path"],
+                ],
+                args["password"],
+            ),
+            text=True,
+        )
+        entries = _parse_pdfimages_list(out)
+        with tempfile.TemporaryDirectory(dir=args["dir"]) as tmpdir:
+            subprocess.run(
                 _pdf_cmd_with_password(
                     [
-                        "pdftotext",
-                        "-bbox",
+                        "pdfimages",
+                        "-j",
                         "-f",
                         str(i),
                         "-l",
                         str(i),
                         args["info"]["path"],
-                        html.name,
+                        os.path.join(tmpdir, "x"),
                     ],
                     args["password"],
                 ),
                 check=True,
-                capture_output=True,
-                text=True,
             )
-            self.check_cancelled()
-            if spo.returncode != 0:
-                request.error(_("Error extracting text layer from PDF"))
-            return html.read()
+            images = []
+            for fname, xresolution, yresolution, mask_fname in _correlate_pdf_images(
+                sorted(glob.glob(os.path.join(tmpdir, "x-??*.???"))), entries
+            ):
+                if mask_fname is None and fname.endswith(".jpg"):
+                    with open(fname, "rb") as fhd:
+                        images.append((fhd.read(), xresolution, yresolution))
+                    continue
+                with Image.open(fname) as image:
+                    image.load()
+                    if mask_fname is not None:
+                        with Image.open(mask_fname) as mask:
+                            image = _composite_over_white(image, mask) or image
+                    images.append((image, xresolution, yresolution))
+        return images
+
+    def _pages_from_pdf_images(self, request, images, text):
+        """return the pages for the images extracted from a PDF page, encoded
+        in the storage format, with the text layer of the page"""
+        args = request.args[0]
+        pages = []
+        for image, xresolution, yresolution in images:
+            if not isinstance(image, bytes):
+                image = encode_for_storage(image)
+            try:
+                page = Page(
+                    image_bytes=image,
+                    dir=args["dir"],
+                    format=args["info"]["format"],
+                    resolution=(xresolution, yresolution, "PixelsPerInch"),
+                )
+                page.import_pdftotext(text)
+                pages.append(page)
+            except (PermissionError, IOError) as err:
+                logger.error("Caught error importing PDF: %s", err)
+                request.error(_("Error importing PDF"))
+        return pages
+
+    def _extract_text_from_pdf(self, request, first, last):
+        """return the text layer of each page in the range as pdftotext -bbox
+        HTML, from a single pdftotext run"""
+        args = request.args[0]
+        spo = subprocess.run(
+            _pdf_cmd_with_password(
+                [
+                    "pdftotext",
+                    "-bbox",
+                    "-f",
+                    str(first),
+                    "-l",
+                    str(last),
+                    args["info"]["path"],
+                    "-",
+                ],
+                args["password"],
+            ),
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        self.check_cancelled()
+        if spo.returncode != 0:
+            request.error(_("Error extracting text layer from PDF"))
+        return _split_pdftotext_pages(spo.stdout, last - first + 1)
+
+
+def _page_from_image(image, **kwargs):
+    """return a page with the image already encoded in the storage format. The
+    resolution is taken from the image, as the encoded image may not record
+    it."""
+    if "resolution" not in kwargs and image.info.get("dpi", (0, 0))[0] > 1:
+        xresolution, yresolution = image.info["dpi"]
+        kwargs["resolution"] = (
+            float(xresolution),
+            float(yresolution),
+            "PixelsPerInch",
+        )
+    return Page(image_bytes=encode_for_storage(image), **kwargs)
+
+
+def _page_from_file(filename, **kwargs):
+    """return a page with the image from the file already encoded in the storage
+    format, so that the file can be removed"""
+    with Image.open(filename) as image:
+        return _page_from_image(image, **kwargs)
+
+
+def _split_pdftotext_pages(html, count):
+    """split the pdftotext -bbox HTML for several pages into one document per
+    page, padding with empty strings to the given number of pages"""
+    pages = re.findall(r"<page\b.*?</page>", html, re.DOTALL)
+    documents = []
+    if pages:
+        head = html[: html.index(pages[0])]
+        tail = html[html.rindex(pages[-1]) + len(pages[-1]) :]
+        documents = [head + page + tail for page in pages]
+    return (documents + [""] * count)[:count]
+
+
+def _split_on_marker(text, marker):
+    "return the text between lines consisting of the marker"
+    chunks, lines = [], []
+    for line in text.splitlines(keepends=True):
+        if line.rstrip("\n") == marker:
+            chunks.append("".join(lines))
+            lines = []
+        else:
+            lines.append(line)
+    return chunks
+
+
+def _open_pdf(path, password):
+    "return the PDF opened with pikepdf, or None if it cannot be opened"
+    try:
+        return pikepdf.open(path, password=password or "")
+    except (pikepdf.PdfError, OSError) as err:
+        logger.warning("Falling back to pdfimages: %s", err)
+    return None
+
+
+def _sniff_format(header):
+    """return the format of a file from its first bytes, or None if it is
+    not one that needs a specific reader"""
+    if header.startswith(b"SQLite format 3\x00"):
+        return "session file"
+    if header[:4] == b"AT&T" and header[4:8] == b"FORM" and header[12:15] == b"DJV":
+        return "DJVU"
+    if header.startswith(b"%PDF-"):
+        return "Portable Document Format"
+    if header[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+        return "Tagged Image File Format"
+    return None
+
+
+def _pdf_page_size(page):
+    "return the displayed size of a PDF page in points, as reported by pdfinfo"
+    box = [float(x) for x in page.cropbox]
+    width, height = abs(box[2] - box[0]), abs(box[3] - box[1])
+    if int(page.obj.get("/Rotate", 0)) % 180:
+        width, height = height, width
+    return [round(width, 2), round(height, 2), "pts"]
+
+
+def _add_docinfo_to_info(info, docinfo):
+    "add the metadata from the document information dictionary of a PDF"
+    for key, value in DOCINFO_KEYS.items():
+        if key not in docinfo:
+            continue
+        try:
+            string = str(docinfo[key]).strip()
+        except (TypeError, ValueError, UnicodeDecodeError):
+            continue
+        if not string:
+            continue
+        if value == "datetime":
+            try:
+                string = decode_pdf_date(string).isoformat()
+            except ValueError:
+                continue
+        info[value] = string
 
 
 def _add_metadata_to_info(info, string, regex):
@@ -576,48 +775,173 @@ def _parse_pdfimages_list(out):
     return entries
 
 
-def _composite_over_white(image_path, mask_path):
-    "composite the image over a white background using its soft mask, in place"
+def _composite_over_white(image, mask):
+    """return the image composited over a white background using its soft mask,
+    or None if the sizes do not match"""
+    if image.size != mask.size:
+        return None
     try:
-        image = Image.open(image_path)
-        mask = Image.open(mask_path)
-        if image.size != mask.size:
-            return False
         background = Image.new("RGB", image.size, "white")
         result = Image.composite(image.convert("RGB"), background, mask.convert("L"))
-        if image.mode not in ("RGB", "RGBA"):
-            result = result.convert("L")
-        result.save(image_path)
     except (OSError, ValueError):
-        return False
-    return True
+        return None
+    if image.mode not in ("RGB", "RGBA"):
+        result = result.convert("L")
+    return result
 
 
-def _correlate_pdf_images(entries):
-    "correlate extracted files with pdfimages -list entries by index"
-    images = sorted(glob.glob("x-??*.???"))
+def _correlate_pdf_images(images, entries):
+    """correlate the files extracted by pdfimages with the pdfimages -list
+    entries by index, returning a list of (image, x-ppi, y-ppi, mask) tuples,
+    where mask is the filename of the soft mask, or None. Unpaired soft masks
+    and stencils are ignored."""
     if len(images) != len(entries):
         # Unexpected structure: import every file and warn
         xresolution, yresolution = None, None
         if entries:
             xresolution = entries[0]["x_ppi"]
             yresolution = entries[0]["y_ppi"]
-        return [(fname, xresolution, yresolution, None) for fname in images], True
+        return [(fname, xresolution, yresolution, None) for fname in images]
     images_and_resolution = []
-    paired_masks = set()
     for i, (fname, entry) in enumerate(zip(images, entries)):
         if entry["type"] == "image":
             mask_fname = None
             if i + 1 < len(entries) and entries[i + 1]["type"] == "smask":
                 mask_fname = images[i + 1]
-                paired_masks.add(images[i + 1])
             images_and_resolution.append(
                 (fname, entry["x_ppi"], entry["y_ppi"], mask_fname)
             )
-    for fname, entry in zip(images, entries):
-        if entry["type"] != "image" and fname not in paired_masks:
-            os.remove(fname)
-    return images_and_resolution, len(images_and_resolution) != 1
+    return images_and_resolution
+
+
+def _multiply_matrices(first, second):
+    "return the product of two PDF transformation matrices [a b c d e f]"
+    a, b, c, d, e, f = first
+    a2, b2, c2, d2, e2, f2 = second
+    return (
+        a * a2 + b * c2,
+        a * b2 + b * d2,
+        c * a2 + d * c2,
+        c * b2 + d * d2,
+        e * a2 + f * c2 + e2,
+        e * b2 + f * d2 + f2,
+    )
+
+
+def _pdf_image_resolution(width, height, ctm):
+    """return the resolution in ppi of an image of the given size drawn into the
+    unit square transformed by the CTM, rounded as pdfimages does"""
+    xsize = math.hypot(ctm[0], ctm[1])
+    ysize = math.hypot(ctm[2], ctm[3])
+    if xsize == 0 or ysize == 0:
+        return None, None
+    return (
+        round(width * POINTS_PER_INCH / xsize),
+        round(height * POINTS_PER_INCH / ysize),
+    )
+
+
+def _inherited_resources(obj):
+    "return the resources of a page, which may be inherited from the page tree"
+    while obj is not None:
+        if "/Resources" in obj:
+            return obj.Resources
+        obj = obj.get("/Parent")
+    return pikepdf.Dictionary()
+
+
+def _collect_pdf_images(content, resources, ctm, images, forms):
+    """append the images drawn by the content stream with their resolution to
+    images, recursing into form XObjects"""
+    stack = []
+    xobjects = resources.get("/XObject", pikepdf.Dictionary())
+    for instruction in pikepdf.parse_content_stream(content):
+        if isinstance(instruction, pikepdf.ContentStreamInlineImage):
+            image = instruction.iimage
+            if not image.image_mask:
+                images.append(
+                    (image, *_pdf_image_resolution(image.width, image.height, ctm))
+                )
+            continue
+        operands, operator = instruction.operands, str(instruction.operator)
+        if operator == "q":
+            stack.append(ctm)
+        elif operator == "Q" and stack:
+            ctm = stack.pop()
+        elif operator == "cm":
+            ctm = _multiply_matrices([float(x) for x in operands], ctm)
+        elif operator == "Do" and operands[0] in xobjects:
+            xobject = xobjects[operands[0]]
+            subtype = xobject.get("/Subtype")
+            if subtype == "/Image" and not xobject.get("/ImageMask", False):
+                images.append(
+                    (
+                        pikepdf.PdfImage(xobject),
+                        *_pdf_image_resolution(
+                            int(xobject.Width), int(xobject.Height), ctm
+                        ),
+                    )
+                )
+            elif subtype == "/Form" and xobject.objgen not in forms:
+                # guard against forms that draw themselves
+                forms.add(xobject.objgen)
+                matrix = [float(x) for x in xobject.get("/Matrix", [1, 0, 0, 1, 0, 0])]
+                _collect_pdf_images(
+                    xobject,
+                    xobject.get("/Resources", resources),
+                    _multiply_matrices(matrix, ctm),
+                    images,
+                    forms,
+                )
+                forms.discard(xobject.objgen)
+
+
+def _is_plain_jpeg(pdfimage):
+    """whether the image is an 8-bit gray or RGB DCT stream that can be stored
+    as a JPEG without decoding"""
+    return (
+        isinstance(pdfimage, pikepdf.PdfImage)
+        and pdfimage.filters == ["/DCTDecode"]
+        and pdfimage.colorspace in ("/DeviceGray", "/DeviceRGB")
+        and pdfimage.bits_per_component == 8
+        and "/Decode" not in pdfimage.obj
+        and "/SMask" not in pdfimage.obj
+    )
+
+
+def _extract_pdf_page_images(page):
+    """return the images drawn on the PDF page as a list of (image, x-ppi, y-ppi)
+    tuples, with soft masks composited over white, or None if any of them
+    cannot be decoded in-process. Plain DCT streams are returned as the bytes of
+    the JPEG, and CCITT and JBIG2 streams are decoded to bilevel images, so
+    that neither is re-encoded lossily."""
+    drawn = []
+    try:
+        _collect_pdf_images(
+            page, _inherited_resources(page.obj), (1, 0, 0, 1, 0, 0), drawn, set()
+        )
+        images = []
+        for pdfimage, xresolution, yresolution in drawn:
+            if _is_plain_jpeg(pdfimage):
+                jpeg = pdfimage.obj.read_raw_bytes()
+                Image.open(io.BytesIO(jpeg)).verify()
+                images.append((jpeg, xresolution, yresolution))
+                continue
+            image = pdfimage.as_pil_image()
+            smask = getattr(pdfimage, "obj", {}).get("/SMask")
+            if smask is not None:
+                mask = pikepdf.PdfImage(smask).as_pil_image()
+                image = _composite_over_white(image, mask) or image
+            images.append((image, xresolution, yresolution))
+    except (
+        pikepdf.PikepdfError,
+        NotImplementedError,
+        OSError,
+        ValueError,
+    ) as err:
+        logger.info("Unable to extract images in-process: %s", err)
+        return None
+    return images
 
 
 def _note_callbacks(kwargs):
@@ -0,0 +1,186 @@
+"Mixed raster content: split a page into a text mask and background layers"
+
+import io
+import logging
+
+import pikepdf
+from bboxtree import Bboxtree
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageStat, TiffImagePlugin
+
+logger = logging.getLogger(__name__)
+
+# A pixel is text when its darkest channel is more than this % from white
+INK_THRESHOLD = 50
+# The background and foreground layers are resampled to about this resolution
+LAYER_DPI = 100
+# Text whose colour varies less than this standard deviation in every channel
+# is painted with a single colour, rather than a foreground image
+UNIFORM_INK_STD_DEV = 32
+DEFAULT_QUALITY = 75
+# OCR word boxes are grown by this many pixels when restricting the mask
+WORD_MARGIN = 2
+# Without OCR, dark areas at least this many pixels thick at the resolution of
+# the layers are taken to be graphics rather than text
+THICK_INK = 5
+
+
+def text_mask(image, text_layer=None, factor=1, threshold=INK_THRESHOLD):
+    """return a bilevel mask of the text of the image, 0 for text and 1 for
+    background. As for the threshold tool, a pixel is text when its darkest
+    channel is dark enough. If the page has been OCRed, the mask is restricted
+    to the word boxes, so that dark areas of photos stay in the background.
+    Otherwise, dark areas too thick to be text are removed from the mask, as
+    found by an opening of the mask reduced by the given factor."""
+    red, green, blue = image.convert("RGB").split()
+    min_channel = ImageChops.darker(ImageChops.darker(red, green), blue)
+    cutoff = round(255 * (100 - threshold) / 100)
+    mask = min_channel.point(lambda p: 0 if p < cutoff else 255)
+    words = []
+    if text_layer:
+        words = [
+            bbox["bbox"]
+            for bbox in Bboxtree(text_layer).each_bbox()
+            if bbox["type"] == "word"
+        ]
+    if words:
+        region = Image.new("L", image.size, 255)
+        draw = ImageDraw.Draw(region)
+        for x_1, y_1, x_2, y_2 in words:
+            draw.rectangle(
+                (
+                    x_1 - WORD_MARGIN,
+                    y_1 - WORD_MARGIN,
+                    x_2 + WORD_MARGIN,
+                    y_2 + WORD_MARGIN,
+                ),
+                fill=0,
+            )
+    else:
+        region = (
+            mask.reduce(factor)
+            .point(lambda p: 0 if p < 128 else 255)
+            .filter(ImageFilter.MaxFilter(THICK_INK))
+            # grown by a couple of pixels more, to catch the antialiased edges
+            # and the gaps between reversed-out text
+            .filter(ImageFilter.MinFilter(THICK_INK + 4))
+            .resize(image.size, Image.Resampling.NEAREST)
+        )
+        region = ImageChops.invert(region)
+    return ImageChops.lighter(mask, region).convert("1")
+
+
+def layers(image, mask, factor):
+    """return the background, with the text removed, and the colour of the
+    text, both reduced by the given factor"""
+    image = image.convert("L" if image.mode in ("1", "L", "LA") else "RGB")
+    small = image.reduce(factor)
+
+    # The text is darker than the background, so a maximum filter removes it.
+    # Only use the filtered pixels near the text, including its antialiased
+    # edges, to keep the edges of the rest of the background sharp.
+    coverage = mask.convert("L").reduce(factor)
+    text = coverage.point(lambda p: 255 if p < 255 else 0)
+    text = text.filter(ImageFilter.MaxFilter(3))
+    background = Image.composite(small.filter(ImageFilter.MaxFilter(5)), small, text)
+
+    # Conversely, the darkest pixels near the text give its colour
+    foreground = small.filter(ImageFilter.MinFilter(3))
+    return background, foreground
+
+
+def ink_colour(image, mask):
+    """return the median colour of the text, as PDF fill colour components in
+    the range 0-1, if it is uniform enough to be painted with a single colour,
+    otherwise None"""
+    # Ignore the antialiased edges of the text, if there is anything left
+    ink = ImageChops.invert(mask.convert("L"))
+    core = ink.filter(ImageFilter.MinFilter(3))
+    stat = ImageStat.Stat(image, mask=core if core.getbbox() else ink)
+    if max(stat.stddev) > UNIFORM_INK_STD_DEV:
+        return None
+    return [value / 255 for value in stat.median]
+
+
+def _jpeg(pdf, image, quality):
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=quality)
+    return pikepdf.Stream(
+        pdf,
+        buf.getvalue(),
+        Type=pikepdf.Name.XObject,
+        Subtype=pikepdf.Name.Image,
+        Width=image.width,
+        Height=image.height,
+        ColorSpace=(
+            pikepdf.Name.DeviceGray if image.mode == "L" else pikepdf.Name.DeviceRGB
+        ),
+        BitsPerComponent=8,
+        Filter=pikepdf.Name.DCTDecode,
+    )
+
+
+def _ccitt_mask(pdf, mask):
+    "return the mask as an image mask stream, compressed with CCITT Group 4"
+    buf = io.BytesIO()
+    # PDF only supports single-strip CCITT data
+    mask.save(
+        buf,
+        format="TIFF",
+        compression="group4",
+        tiffinfo={TiffImagePlugin.ROWSPERSTRIP: mask.height},
+    )
+    with Image.open(buf) as tiff:
+        offset = tiff.tag_v2[TiffImagePlugin.STRIPOFFSETS][0]
+        length = tiff.tag_v2[TiffImagePlugin.STRIPBYTECOUNTS][0]
+    return pikepdf.Stream(
+        pdf,
+        buf.getvalue()[offset : offset + length],
+        Type=pikepdf.Name.XObject,
+        Subtype=pikepdf.Name.Image,
+        Width=mask.width,
+        Height=mask.height,
+        ImageMask=True,
+        BitsPerComponent=1,
+        Filter=pikepdf.Name.CCITTFaxDecode,
+        DecodeParms=pikepdf.Dictionary(
+            K=-1, Columns=mask.width, Rows=mask.height, BlackIs1=True
+        ),
+    )
+
+
+def write_pdf_page(image, filename, size, resolution, text_layer=None, quality=None):
+    """write the image as a single-page PDF of the given size in points, as a
+    low-resolution JPEG background, overlaid with the text, drawn with a CCITT
+    Group 4 mask either in a single colour or through a low-resolution JPEG
+    foreground"""
+    if quality is None:
+        quality = DEFAULT_QUALITY
+    quality = int(quality)
+    factor = max(1, round(min(resolution) / LAYER_DPI))
+    mask = text_mask(image, text_layer, factor)
+    background, foreground = layers(image, mask, factor)
+
+    width, height = size
+    pdf = pikepdf.new()
+    xobjects = {"/Im0": _jpeg(pdf, background, quality)}
+    ops = [f"q {width:.4f} 0 0 {height:.4f} 0 0 cm /Im0 Do Q"]
+    if mask.getextrema()[0]:
+        logger.debug("No text found for MRC, writing background only")
+    else:
+        stencil = _ccitt_mask(pdf, mask)
+        colour = ink_colour(image.convert(background.mode), mask)
+        fill = ""
+        if colour is None:
+            fg_image = _jpeg(pdf, foreground, quality)
+            fg_image.Mask = stencil
+            xobjects["/Im1"] = fg_image
+        else:
+            xobjects["/Im1"] = stencil
+            operator = "g" if len(colour) == 1 else "rg"
+            fill = " ".join(f"{value:.3f}" for value in colour) + f" {operator} "
+        ops.append(f"q {fill}{width:.4f} 0 0 {height:.4f} 0 0 cm /Im1 Do Q")
+
+    pdf.add_blank_page(page_size=(width, height))
+    pdf.pages[0].Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(xobjects))
+    pdf.pages[0].Contents = pdf.make_stream("\n".join(ops).encode())
+    pdf.save(filename)
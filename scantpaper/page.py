@@ -1,15 +1,14 @@
 "Class of data and methods for handling page objects"
 
+import hashlib
 import io
 import json
 import locale
 import re
-import subprocess
 import tempfile
 import uuid
 import logging
-from PIL import Image, ImageFile
-import config
+from PIL import Image, ImageChops, ImageFile, TiffImagePlugin
 from const import POINTS_PER_INCH, MM_PER_INCH, CM_PER_INCH
 from bboxtree import Bboxtree
 from helpers import exec_command
@@ -21,6 +20,17 @@ gi.require_version("GdkPixbuf", "2.0")
 from gi.repository import GdkPixbuf, GLib  # pylint: disable=wrong-import-position
 
 PAGE_TOLERANCE = 0.02
+# PDF compression options with which bilevel images are written as CCITT G4
+_CCITT_COMPRESSION = ("auto", "g3", "g4", "mrc")
+_DEFAULT_JPEG_QUALITY = 75
+# With automatic PDF compression, a page is colour if more than this fraction
+# of it, at about the analysis resolution, is more saturated than this chroma
+_ANALYSIS_DPI = 25
+_COLOUR_CHROMA = 32
+_COLOUR_FRACTION = 0.0005
+# Otherwise, it is bilevel if less than this fraction of it is midtones
+_MIDTONES = (48, 208)
+_BILEVEL_FRACTION = 0.01
 MODE2DEPTH = {
     "1": 1,
     "L": 8,
@@ -37,6 +47,68 @@ MODE2DEPTH = {
 logger = logging.getLogger(__name__)
 
 
+def encode_for_storage(image):
+    """return the image encoded as bytes for storing as a blob in SQLite: PNG for
+    bilevel images and those with an alpha channel, otherwise JPEG at the storage
+    quality"""
+    img_byte_arr = io.BytesIO()
+    if image.mode in ("1", "RGBA", "LA", "PA"):
+        image.save(img_byte_arr, format="PNG")
+    else:
+        if image.mode in ("I", "F", "P"):
+            image = image.convert("RGB" if image.mode == "P" else "L")
+        image.save(img_byte_arr, format="JPEG", quality=92)
+    return img_byte_arr.getvalue()
+
+
+def classify_image(image, resolution):
+    """return whether the image looks "colour", "grey" or "bilevel", to choose
+    how to compress it. The chroma is measured on a reduced image, so that the
+    colour fringes of scanners around text average out, whilst coloured stamps
+    or signatures are still found."""
+    if image.mode == "1":
+        return "bilevel"
+    if image.mode != "L":
+        factor = max(1, round(min(resolution) / _ANALYSIS_DPI))
+        red, green, blue = image.convert("RGB").reduce(factor).split()
+        chroma = ImageChops.subtract(
+            ImageChops.lighter(ImageChops.lighter(red, green), blue),
+            ImageChops.darker(ImageChops.darker(red, green), blue),
+        )
+        coloured = sum(chroma.histogram()[_COLOUR_CHROMA:])
+        if coloured > _COLOUR_FRACTION * chroma.width * chroma.height:
+            return "colour"
+    midtones = sum(image.convert("L").histogram()[_MIDTONES[0] : _MIDTONES[1]])
+    if midtones < _BILEVEL_FRACTION * image.width * image.height:
+        return "bilevel"
+    return "grey"
+
+
+def write_pdf_image(image, filename, compression, resolution, quality=None):
+    """write the image, as chosen by Page.pdf_encoding(), as a file that
+    img2pdf can embed, returning whether it will embed its data as it is"""
+    if quality is None:
+        quality = _DEFAULT_JPEG_QUALITY
+    if image.mode == "1" and compression in _CCITT_COMPRESSION:
+        # PDF only supports single-strip CCITT data, which img2pdf copies
+        # from the TIFF without decoding it
+        image.save(
+            filename,
+            format="TIFF",
+            compression="group4",
+            dpi=resolution,
+            tiffinfo={TiffImagePlugin.ROWSPERSTRIP: image.height},
+        )
+        return True
+    if compression == "jpg" and image.mode != "1":
+        if image.mode not in ("L", "RGB", "CMYK"):
+            image = image.convert("L" if image.mode == "LA" else "RGB")
+        image.save(filename, format="JPEG", quality=int(quality), dpi=resolution)
+        return True
+    image.save(filename, format="PNG", dpi=resolution)
+    return False
+
+
 class Page:
     "Class of data and methods for handling page objects"
 
@@ -56,11 +128,12 @@ class Page:
     _stored_bytes = None
 
     def __init__(self, **kwargs):
-        if ("image_object" not in kwargs and "filename" not in kwargs) or (
-            "image_object" in kwargs and "filename" in kwargs
-        ):
+        sources = [
+            key for key in ("image_object", "filename", "image_bytes") if key in kwargs
+        ]
+        if len(sources) != 1:
             raise ValueError(
-                "Error: please supply either a filename or an image object"
+                "Error: please supply either a filename, an image object or image bytes"
             )
         if "image_object" in kwargs and not isinstance(
             kwargs["image_object"], Image.Image
@@ -75,6 +148,12 @@ class Page:
                 with open(kwargs["filename"], "rb") as fhd:
                     self._stored_bytes = fhd.read()
 
+        # bytes already in the storage format, e.g. encoded by the scanner
+        # thread, so that the uncompressed frame never crosses threads
+        if "image_bytes" in kwargs:
+            self._stored_bytes = kwargs.pop("image_bytes")
+            self.image_object = Image.open(io.BytesIO(self._stored_bytes))
+
         # set this before setting attributes from kwargs in order to reuse uuid
         # if necessary. Therefore, the uuid tracks the page through import,
         # threshold, rotate, unpaper, etc. steps but still allows the page
@@ -89,7 +168,7 @@ class Page:
 
         logger.info(
             "New page size %s, format %s, (%s)",
-            len(self.image_object.tobytes()),
+            self.image_object.size,
             self.image_object.mode,
             self.uuid,
         )
@@ -99,27 +178,11 @@ class Page:
         a compact format that can be embedded in a PDF without re-encoding"""
         if self.image_object.format in ("JPEG", "PNG") and self._stored_bytes:
             return self._stored_bytes
-        if self.image_object.mode == "1":
-            return self._to_png_bytes()
-        if self.image_object.mode in ("RGBA", "LA", "PA"):
-            return self._to_png_bytes()
-        return self._to_jpeg_bytes()
-
-    def _to_png_bytes(self):
-        "return the image encoded as PNG bytes"
-        img_byte_arr = io.BytesIO()
-        image = self.image_object
-        image.save(img_byte_arr, format="PNG")
-        return img_byte_arr.getvalue()
+        return encode_for_storage(self.image_object)
 
-    def _to_jpeg_bytes(self):
-        "return the image encoded as JPEG bytes at the storage quality"
-        img_byte_arr = io.BytesIO()
-        image = self.image_object
-        if image.mode in ("I", "F", "P"):
-            image = image.convert("RGB" if image.mode == "P" else "L")
-        image.save(img_byte_arr, format="JPEG", quality=92)
-        return img_byte_arr.getvalue()
+    def digest(self):
+        "return a digest of the stored image, identifying it between saves"
+        return hashlib.sha256(self.to_stored_bytes()).hexdigest()
 
     @classmethod
     def from_bytes(cls, blob, **kwargs):
@@ -383,27 +446,48 @@ class Page:
             )
         return xresolution, self.image_object
 
-    def write_image_for_pdf(self, filename, options):
-        "write the image as a file suitable for embedding in a PDF"
+    def pdf_encoding(self, options):
+        """return the image to embed in a PDF, converted and downsampled as
+        required by the options, the compression with which to write it, and
+        whether the stored bytes can be embedded instead"""
         image = self.image_object
         opts = {}
         if options and options.get("options"):
             opts = options["options"]
+        compression = opts.get("compression") or "auto"
+        if compression == "auto" and image.mode in ("L", "RGB", "CMYK"):
+            # choose the codec from the content of the page, rather than the
+            # format in which it happens to be stored
+            content = classify_image(image, self.get_resolution()[:2])
+            logger.info("Page %s looks %s", self.id, content)
+            if content == "bilevel":
+                compression = "g4"
+            elif content == "grey" and image.mode != "L":
+                compression = "jpg" if image.format == "JPEG" else "png"
+                image = image.convert("L")
+        # JPEG blobs can be embedded as they are, as can bilevel PNG blobs, if
+        # Flate rather than CCITT compression is wanted
         if (
             self._stored_bytes is not None
-            and self.image_object.format == "JPEG"
+            and image is self.image_object
+            and (
+                image.format == "JPEG"
+                or (
+                    image.format == "PNG"
+                    and image.mode == "1"
+                    and compression not in _CCITT_COMPRESSION
+                )
+            )
             and not opts.get("downsample")
-            and not (opts.get("compression") and opts["compression"][0] == "g")
+            and compression[0] != "g"
         ):
-            with open(filename, "wb") as fhd:
-                fhd.write(self._stored_bytes)
-            return
+            return image, compression, True
         if opts and "downsample" in opts and opts["downsample"]:
             if opts["downsample dpi"] < min(self.resolution[0], self.resolution[1]):
                 width = int(self.width * opts["downsample dpi"] // self.resolution[0])
                 height = int(self.height * opts["downsample dpi"] // self.resolution[1])
                 image = image.resize((width, height))
-        if opts and "compression" in opts and opts["compression"][0] == "g":  # g3 or g4
+        if compression[0] == "g":  # g3 or g4
             # Grayscale
             image = image.convert("L")
             # Threshold
@@ -411,9 +495,26 @@ class Page:
             image = image.point(lambda p: 255 if p > threshold else 0)
             # To mono
             image = image.convert("1")
+        return image, compression, False
 
-        xresolution, yresolution, _units = self.get_resolution()
-        image.save(filename, dpi=(xresolution, yresolution))
+    def write_image_for_pdf(self, filename, options):
+        """write the image as a file suitable for embedding in a PDF, returning
+        whether img2pdf will embed its data as it is"""
+        image, compression, passthrough = self.pdf_encoding(options)
+        if passthrough:
+            with open(filename, "wb") as fhd:
+                fhd.write(self._stored_bytes)
+            return image.format == "JPEG"
+        opts = {}
+        if options and options.get("options"):
+            opts = options["options"]
+        return write_pdf_image(
+            image,
+            filename,
+            compression,
+            self.get_resolution()[:2],
+            opts.get("quality"),
+        )
 
     def write_image_for_djvu(self, filename, options):
         "Save the image as a DjVu file."
@@ -449,94 +550,41 @@ class Page:
             )
             if proc.returncode:
                 logger.error("Error creating DjVu: %s", proc.stderr)
-            self._add_txt_to_djvu(filename, options.get("dir"))
-            self._add_ann_to_djvu(filename, options.get("dir"))
 
-    def _add_txt_to_djvu(self, djvu, dirname):
-        if self.text_layer is not None:
-            try:
-                txt = self.export_djvu_txt()
-            except json.decoder.JSONDecodeError:
-                return
-            logger.debug(txt)
-
-            # Write djvusedtxtfile
-            with tempfile.NamedTemporaryFile(
-                mode="wt", dir=dirname, suffix=".txt"
-            ) as fhd:
-                fhd.write(txt)
-                fhd.flush()
-
-                # Run djvusedtxtfile
-                cmd = [
-                    "djvused",
-                    djvu,
-                    "-e",
-                    f"select 1; set-txt {fhd.name}",
-                    "-s",
-                ]
-                logger.info(cmd)
-                subprocess.run(cmd, check=True)
-
-    def _add_ann_to_djvu(self, djvu, dirname):
-        "FIXME - refactor this together with _add_txt_to_djvu"
-        if self.annotations is not None:
+    def djvused_layers(self):
+        """return djvused commands setting the text and annotation layers of the
+        selected page, so that those of all the pages of a document can be set
+        with a single djvused script"""
+        script = ""
+        for command, export in (
+            ("set-txt", self.export_djvu_txt),
+            ("set-ant", self.export_djvu_ann),
+        ):
             try:
-                ann = self.export_djvu_ann()
+                layer = export()
             except json.decoder.JSONDecodeError:
-                return
-            logger.debug(ann)
-
-            # Write djvusedtxtfile
-            with tempfile.NamedTemporaryFile(
-                mode="w", dir=dirname, suffix=".txt"
-            ) as fhd:
-                fhd.write(ann)
-                fhd.flush()
-
-                # Run djvusedtxtfile
-                cmd = [
-                    "djvused",
-                    djvu,
-                    "-e",
-                    f"select 1; set-ant {fhd.name}",
-                    "-s",
-                ]
-                logger.info(cmd)
-                subprocess.run(cmd, check=True)
-
-    def write_image_for_tiff(self, filename, options):
-        "Save the image as a TIFF file."
-        with tempfile.NamedTemporaryFile(
-            dir=options.get("dir"), suffix=".tif"
-        ) as infile:
-            self.image_object.save(infile.name)
-            xresolution, yresolution, units = self.resolution
-
-            # Convert to tiff
-            depth = []
-            if "compression" in options["options"]:
-                if options["options"]["compression"] == "jpeg":
-                    depth = ["-depth", "8"]
-
-                elif re.search(
-                    r"g[34]",
-                    options["options"]["compression"],
-                    re.MULTILINE | re.DOTALL | re.VERBOSE,
-                ):
-                    depth = ["-threshold", "40%", "-depth", "1"]
-
-            cmd = [
-                config.CONVERT_COMMAND,
-                infile.name,
-                "-units",
-                units,
-                "-density",
-                f"{xresolution}x{yresolution}",
-                *depth,
-                filename,
-            ]
-            subprocess.run(cmd, check=True)
+                continue
+            if layer:
+                logger.debug(layer)
+                script += f"{command}\n{layer}\n.\n"
+        return script
+
+    def tiff_frame(self, options):
+        """return the image, converted as required by the TIFF compression, and
+        its resolution in dpi"""
+        image = self.image_object
+        compression = (options.get("options") or {}).get("compression")
+        if compression in ("g3", "g4"):
+            image = image.convert("L")
+            threshold = 0.4 * 255
+            image = image.point(lambda p: 255 if p > threshold else 0).convert("1")
+        elif compression == "jpeg" and image.mode not in ("L", "RGB"):
+            image = image.convert("L" if image.mode in ("1", "LA") else "RGB")
+        elif image.mode in ("LA", "P", "PA", "RGBA"):
+            image = image.convert("L" if image.mode == "LA" else "RGB")
+
+        xresolution, yresolution, _units = self.get_resolution()
+        return image, (xresolution, yresolution)
 
 
 def _prepare_scale(image_width, image_height, res_ratio, max_width, max_height):
@@ -1,111 +1,104 @@
 "Threading model for the Document class"
 
+import concurrent.futures
+import contextlib
 import datetime
-import json
+import hashlib
+import io
 import logging
 import os
 import pathlib
+import queue
 import re
 import shutil
 import subprocess
 import tempfile
-from collections import defaultdict
+import threading
+import zlib
+from collections import defaultdict, deque
 
 import img2pdf
-import ocrmypdf
+import mrc
 import pikepdf
 from basethread import Request
 from bboxtree import Bboxtree
 from const import ANNOTATION_COLOR, POINTS_PER_INCH, VERSION
 from helpers import exec_command
 from i18n import _
-from importthread import Importhread, _note_callbacks
-from ocrmypdf import hookimpl
-from ocrmypdf.pluginspec import ProgressBar
-from page import Page
-from PIL import Image
+from importthread import CancelledError, Importhread, _note_callbacks
+from page import Page, write_pdf_image
+from PIL import Image, ImageCms, TiffImagePlugin
 
 logger = logging.getLogger(__name__)
 
 img2pdf.default_dpi = 72.0
 
-# PDFs larger than 2 GiB hit 32-bit file-offset limits in img2pdf's
-# linearizing engine, Ghostscript's PDF/A conversion, and pikepdf's
-# xref-stream linearization, producing truncated or corrupt output.
+# PDFs larger than 2 GiB hit 32-bit file-offset limits in pikepdf's
+# xref-stream linearization, producing truncated or corrupt output, so
+# linearization is skipped above this size.
 _2GIB = 2 * 1024 * 1024 * 1024
 
-# Bytes per pixel used to estimate PDF size from the source image mode.
-_PIXEL_BPP = {
-    "1": 0.125,
-    "L": 1,
-    "LA": 2,
-    "P": 3,
-    "RGB": 3,
-    "RGBA": 4,
-    "CMYK": 4,
-    "I": 4,
+# Maximum number of PDFs held open at once while concatenating pages
+_MAX_OPEN_PDFS = 256
+
+# Subdirectory of the session directory in which the single-page PDFs of the
+# last saved PDF are kept, so that unchanged pages are not encoded again when
+# it is saved again. They are keyed by the image, the page size and these
+# options, which change how a page is encoded, and for MRC, the text layer.
+_PDF_CACHE_DIR = "pdf-cache"
+_PAGE_PDF_OPTIONS = ("downsample", "downsample dpi", "compression", "quality")
+
+# Pillow TIFF encoders for the compression settings of the save dialog
+_TIFF_COMPRESSION = {
+    "lzw": "tiff_lzw",
+    "zip": "tiff_adobe_deflate",
+    "jpeg": "jpeg",
+    "packbits": "packbits",
+    "g3": "group3",
+    "g4": "group4",
 }
 
+# Document information dictionary keys for the output metadata. The creator is
+# set together with the XMP metadata.
+_DOCINFO_KEYS = {
+    "title": "/Title",
+    "author": "/Author",
+    "subject": "/Subject",
+    "keywords": "/Keywords",
+    "creationdate": "/CreationDate",
+    "moddate": "/ModDate",
+}
+
+# The text layer is drawn invisibly with Tesseract's glyphless font, whose
+# glyphs are all half as wide as they are high. Text is encoded as UTF-16BE
+# and mapped back to Unicode one to one.
+_TEXT_FONT = pikepdf.Name("/f-0-0")
+_GLYPHLESS_FONT = pathlib.Path(__file__).with_name("glyphless.ttf")
+_CHAR_ASPECT = 2
+
+# The size of a save is estimated from this many pages, spread through the
+# document, by encoding about this many pixels of each, in this many bands
+# across the page, and extrapolating. Full-resolution bands, rather than a
+# thumbnail, compress like the rest of the page.
+_ESTIMATE_PAGES = 5
+_ESTIMATE_PIXELS = 2000000
+_ESTIMATE_BANDS = 8
+_ESTIMATE_IMAGE_FORMATS = {"jpg": "JPEG", "png": "PNG", "pnm": "PPM", "gif": "GIF"}
+
+# save_multiple fetches each page once and passes it to the writer of each
+# target, running on a thread of its own, through a queue of this many pages,
+# so that the fetching keeps pace with the slowest writer. Only the text and
+# hOCR writers do without the pixels of the pages.
+_FEED_PAGES = 2
+_FEED_TIMEOUT = 0.1  # s
+_TEXT_FORMATS = ("text", "hocr")
+_FEED = threading.local()
+
 LEFT = 0
 TOP = 1
 RIGHT = 2
 BOTTOM = 3
 
-# Global variable to hold the current thread instance for progress reporting
-# This is a list to make it mutable from within nested functions
-_current_request_for_progress = [None]
-
-
-class SaveThreadProgressBar(ProgressBar):
-    """Custom progress bar for ocrmypdf that updates SaveThread progress"""
-
-    def __init__(
-        self,
-        request,
-        total: int | None,
-        desc: str | None,
-        unit: str | None,
-        disable: bool = False,
-    ):
-        self.request = request
-        self.total = total or 1
-        self.desc = desc or "Processing PDF"
-        self.unit = unit
-        self.current = 0
-        self.disable = disable
-
-    def update(self, n=1, completed=None) -> None:
-        """Update progress"""
-        if self.disable:
-            return
-
-        if completed is not None:
-            self.current = completed
-        else:
-            self.current += n
-
-        if self.request:
-            self.request.data(min(1.0, self.current / self.total))
-            self.request.data(_(self.desc))
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback) -> bool:
-        return False
-
-
-@hookimpl
-def get_progressbar_class():
-    """ocrmypdf plugin hook to provide custom progress bar class"""
-
-    def create_progress_bar(total, desc, unit, disable=False, **kwargs):
-        """Factory function that accepts all ocrmypdf progress bar parameters"""
-        request_instance = _current_request_for_progress[0]
-        return SaveThreadProgressBar(request_instance, total, desc, unit, disable)
-
-    return create_progress_bar
-
 
 class SaveThread(Importhread):
     "subclass basethread for document"
@@ -115,45 +108,6 @@ class SaveThread(Importhread):
         callbacks = _note_callbacks(kwargs)
         return self.send("save_pdf", kwargs, **callbacks)
 
-    def _embed_text_layer(self, outdir, filename, request):
-        "Embed the text layer into the PDF using ocrmypdf"
-        request.data(_("Embedding text layer"))
-
-        # Set up progress tracking via plugin
-        _current_request_for_progress[0] = request
-
-        # Call ocrmypdf with our custom progress plugin
-        # The savethread module provides get_progressbar_class hook
-        try:
-            ocrmypdf.api._hocr_to_ocr_pdf(
-                outdir,
-                filename,
-                optimize=0,
-                plugins=["savethread"],
-            )
-        except Exception as err:
-            # ocrmypdf may fail if pikepdf cannot parse the PDF produced by
-            # img2pdf (InputFileError wraps PdfError).  The raw origin.pdf is
-            # still valid, so fall back to copying it rather than failing the
-            # entire save.  The text layer and PDF/A title metadata will be
-            # absent but the PDF remains usable.  Return False so the caller
-            # can skip subsequent pikepdf operations that would also fail on
-            # the malformed PDF.
-            msg = str(err) or err.__class__.__name__
-            logging.warning(
-                "Could not embed text layer (%s): %s – "
-                "saving without embedded text layer",
-                err.__class__.__name__,
-                msg,
-            )
-            shutil.copyfile(outdir / "origin.pdf", filename)
-            return False
-        finally:
-            request.data(1.0)
-            _current_request_for_progress[0] = None
-
-        return True
-
     def do_save_pdf(self, request):
         "save PDF in thread"
         options = defaultdict(None, request.args[0])
@@ -161,9 +115,10 @@ class SaveThread(Importhread):
         request.data(_("Setting up PDF"))
         with tempfile.TemporaryDirectory(dir=options.get("dir")) as tempdir:
             outdir = pathlib.Path(tempdir)
+            opts = options.get("options") or {}
             filename = options["path"]
             temp_pdf = None
-            if _need_temp_pdf(options.get("options")):
+            if opts.get("ps"):
                 temp_pdf = tempfile.NamedTemporaryFile(
                     dir=options.get("dir"), suffix=".pdf"
                 )
@@ -173,141 +128,152 @@ class SaveThread(Importhread):
             if "metadata" in options and "ps" not in options:
                 metadata = prepare_output_metadata("PDF", options["metadata"])
 
-            list_of_pages = []
-            with open(
-                outdir / "origin.pdf", "wb", buffering=0
-            ) as fhd:  # turn off buffering
-                filenames = []
-                resolutions = []
-                opts = {}
-                if options.get("options"):
-                    opts = options["options"]
-                estimated_size = 0
-                for i, page_id in enumerate(options["list_of_pages"], start=1):
-                    page = self.get_page(id=page_id)
-                    list_of_pages.append(page)
-                    request.data(i / (len(options["list_of_pages"]) + 1))
-                    request.data(
-                        _("Writing page %i of %i")
-                        % (
-                            i,
-                            len(options["list_of_pages"]),
-                        )
-                    )
-
-                    # store the filename and not the tempfile object to avoid potentially
-                    # holding many open filehandles
-                    with tempfile.NamedTemporaryFile(
-                        dir=options.get("dir"), suffix=".png", delete=False
-                    ) as tmp:
-                        page.write_image_for_pdf(tmp.name, options)
-                        filenames.append(tmp.name)
-                        estimated_size += _estimate_page_pdf_size(
-                            page.image_object, tmp.name, opts
-                        )
-                    xres, yres, _units = page.get_resolution(self.paper_sizes)
-                    resolutions.append((xres, yres))
-
-                if estimated_size >= _2GIB:
-                    for fname in filenames:
-                        os.remove(fname)
-                    raise RuntimeError(
-                        _(
-                            "The estimated PDF size (%.1f GiB) exceeds 2 GiB."
-                            "  Please save fewer pages."
-                        )
-                        % (estimated_size / (1024 * 1024 * 1024),)
-                    )
-                index = 0
-
-                def layout_fun(imgwidthpx, imgheightpx, _ndpi):
-                    nonlocal index
-                    xres, yres = resolutions[index]
-                    index += 1
-                    pagewidth = imgwidthpdf = img2pdf.px_to_pt(imgwidthpx, xres)
-                    pageheight = imgheightpdf = img2pdf.px_to_pt(imgheightpx, yres)
-                    return pagewidth, pageheight, imgwidthpdf, imgheightpdf
-
-                metadata["layout_fun"] = layout_fun
-                request.data(_("Writing PDF"))
-                fhd.write(img2pdf.convert(filenames, **metadata))
-                for fname in filenames:
-                    os.remove(fname)
-            for pagenr, page in enumerate(list_of_pages):
-                if page.text_layer and page.text_layer != "[]":
-                    with (
-                        open(
-                            outdir / f"{pagenr + 1:-06}_ocr_hocr.hocr",
-                            "w",
-                            encoding="utf-8",
-                        ) as hocr_fh,
-                        open(
-                            outdir / f"{pagenr + 1:-06}_hocr.json",
-                            "w",
-                            encoding="utf-8",
-                        ) as json_fh,
-                    ):
-                        hocr_fh.write(page.export_hocr())
-                        json_fh.write(
-                            json.dumps({"pageno": pagenr, "orientation_correction": 0})
-                        )
-                self.check_cancelled()
-
-            # Embed text layer using ocrmypdf (also applies PDF/A metadata such
-            # as the title), so it runs even when no page has a text layer.
-            embed_ok = self._embed_text_layer(outdir, filename, request)
-
-            # When embed fell back (embed_ok is False) the output PDF may be
-            # malformed – pikepdf-dependent operations would fail too, so skip
-            # them and hand the user a usable (but textless) PDF.
-            if embed_ok:
-                # Metadata fixup is cosmetic - if it fails, deliver an
-                # unbranded but otherwise usable PDF rather than failing
-                # the save.
+            # Pages are written on a pool of worker threads, fetching them from
+            # the database only a few pages ahead, to limit memory use. Pages
+            # unchanged since the last save are taken from the cache.
+            cache_dir = _pdf_cache_dir(options)
+            npages = len(options["list_of_pages"])
+            page_pdfs = []
+            text_layers = []
+            estimated_size = 0
+            workers = max(1, min(os.cpu_count() or 1, npages))
+            pending = deque()
+
+            def collect(future):
+                nonlocal estimated_size
+                page_pdf, size, text_layer = future.result()
+                page_pdfs.append(page_pdf)
+                estimated_size += size
+                text_layers.append(text_layer)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
                 try:
-                    _fix_pdf_metadata(filename, "title" not in metadata)
-                except Exception as err:
-                    logging.warning(
-                        "Could not fix PDF metadata (%s): %s - "
-                        "saving without creator branding",
-                        err.__class__.__name__,
-                        err,
-                    )
-
-                _append_pdf(filename, options, request)
-
-                if options.get("options") and options["options"].get("user-password"):
-                    if _encrypt_pdf(filename, options, request):
-                        return
-
-                _set_timestamp(options)
-                if options.get("options") and options["options"].get("ps"):
-                    request.data(_("Converting to PS"))
-                    proc = exec_command(
-                        [
-                            options["options"]["pstool"],
-                            filename,
-                            options["options"]["ps"],
-                        ],
-                        options["pidfile"],
-                    )
-                    if proc.returncode or proc.stderr:
-                        logger.info(proc.stderr)
-                        request.error(
-                            _("Error converting PDF to PS: %s") % (proc.stderr)
+                    for i, page_id in enumerate(options["list_of_pages"], start=1):
+                        page = self._export_page(page_id)
+                        request.data(i / (npages + 1))
+                        request.data(_("Writing page %i of %i") % (i, npages))
+                        pending.append(
+                            executor.submit(
+                                _write_pdf_page,
+                                page,
+                                outdir / f"page-{i:06}.pdf",
+                                page.get_resolution(self.paper_sizes)[:2],
+                                options,
+                                cache_dir,
+                            )
                         )
-                        return
+                        if len(pending) >= 2 * workers:
+                            collect(pending.popleft())
+                        self.check_cancelled()
+                    while pending:
+                        collect(pending.popleft())
+                finally:
+                    for future in pending:
+                        future.cancel()
+
+            existing = opts.get("prepend") or opts.get("append")
+            if existing:
+                estimated_size += os.path.getsize(existing)
+            large = estimated_size >= _2GIB
+            if large:
+                logger.info(
+                    "Estimated PDF size %.1f GiB, skipping linearization",
+                    estimated_size / (1024 * 1024 * 1024),
+                )
+            request.data(_("Writing PDF"))
+            try:
+                _write_pdf(
+                    page_pdfs,
+                    text_layers,
+                    filename,
+                    metadata,
+                    linearize=not large,
+                    prepend=opts.get("prepend"),
+                    append=opts.get("append"),
+                    password=opts.get("user-password"),
+                    pdfa=opts.get("pdfa", False),
+                )
+            except pikepdf.PdfError as err:
+                if not existing:
+                    raise
+                message = (
+                    _("Error prepending PDF: %s")
+                    if opts.get("prepend")
+                    else _("Error appending PDF: %s")
+                )
+                logger.info(err)
+                request.error(message % err)
+                return
+            if cache_dir is not None:
+                feed = getattr(_FEED, "feed", None)
+                if feed is None:
+                    _prune_pdf_cache(cache_dir, page_pdfs)
+                else:
+                    # other targets may still need the pages that are not in
+                    # this PDF, so save_multiple prunes once they have finished
+                    feed.page_pdfs = page_pdfs
+            request.data(1.0)
 
-                    _post_save_hook(options["options"]["ps"], options["options"])
+            _set_timestamp(options)
+            if opts.get("ps"):
+                request.data(_("Converting to PS"))
+                proc = exec_command(
+                    [
+                        options["options"]["pstool"],
+                        filename,
+                        options["options"]["ps"],
+                    ],
+                    options["pidfile"],
+                )
+                if proc.returncode or proc.stderr:
+                    logger.info(proc.stderr)
+                    request.error(_("Error converting PDF to PS: %s") % (proc.stderr))
+                    return
+
+                _post_save_hook(options["options"]["ps"], options["options"])
 
-                else:
-                    _post_save_hook(filename, options.get("options"))
             else:
                 _post_save_hook(filename, options.get("options"))
             self.do_set_saved(
                 Request("set_saved", (options["list_of_pages"], True), self.responses)
             )
 
+    def estimate_size(self, **kwargs):
+        "estimate the size of a save"
+        callbacks = _note_callbacks(kwargs)
+        return self.send("estimate_size", kwargs, **callbacks)
+
+    def do_estimate_size(self, request):
+        """estimate the size in bytes of a save of the given format in thread,
+        returning None for formats whose size cannot be estimated"""
+        options = request.args[0]
+        image_type = options["format"]
+        if not re.search(r"pdf", image_type) and image_type not in (
+            "tif",
+            "djvu",
+            *_ESTIMATE_IMAGE_FORMATS,
+        ):
+            return None
+        list_of_pages = options["list_of_pages"]
+        if not list_of_pages:
+            return 0
+        step = max(1, len(list_of_pages) / _ESTIMATE_PAGES)
+        sample = [list_of_pages[int(i * step)] for i in range(_ESTIMATE_PAGES)]
+        sample = list(dict.fromkeys(sample))
+        size = 0
+        with tempfile.TemporaryDirectory(dir=options.get("dir")) as tempdir:
+            for page_id in sample:
+                self.check_cancelled()
+                page = self.get_page(id=page_id)
+                size += _estimate_page_size(
+                    page,
+                    image_type,
+                    options.get("options") or {},
+                    page.get_resolution(self.paper_sizes)[:2],
+                    tempdir,
+                )
+        return round(size * len(list_of_pages) / len(sample))
+
     def save_djvu(self, **kwargs):
         "save DjvU"
         callbacks = _note_callbacks(kwargs)
@@ -316,103 +282,68 @@ class SaveThread(Importhread):
     def do_save_djvu(self, request):
         "save DjvU in thread"
         args = request.args[0]
-        i = 0
-        filelist = []
-        for page_id in args["list_of_pages"]:
-            page = self.get_page(id=page_id)
-            i += 1
-            request.data(i / (len(args["list_of_pages"]) + 1))
-            request.data(
-                _("Writing page %i of %i")
-                % (
-                    i,
-                    len(args["list_of_pages"]),
-                )
+        npages = len(args["list_of_pages"])
+        with tempfile.TemporaryDirectory(dir=args.get("dir")) as tempdir:
+            outdir = pathlib.Path(tempdir)
+
+            # Pages are encoded on a pool of worker threads, fetching them from
+            # the database only a few pages ahead, to limit memory use. Their
+            # text and annotation layers are collected, to be set in one go
+            # after merging.
+            filelist = []
+            layers = []
+            workers = max(1, min(os.cpu_count() or 1, npages))
+            pending = deque()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                try:
+                    for i, page_id in enumerate(args["list_of_pages"], start=1):
+                        page = self._export_page(page_id)
+                        request.data(i / (npages + 1))
+                        request.data(_("Writing page %i of %i") % (i, npages))
+                        layers.append(page.djvused_layers())
+                        pending.append(
+                            executor.submit(
+                                _write_djvu_page,
+                                page,
+                                outdir / f"page-{i:06}.djvu",
+                                args,
+                            )
+                        )
+                        if len(pending) >= 2 * workers:
+                            filelist.append(pending.popleft().result())
+                        self.check_cancelled()
+                    while pending:
+                        filelist.append(pending.popleft().result())
+                finally:
+                    for future in pending:
+                        future.cancel()
+
+            request.data(1.0)
+            request.data(_("Merging DjVu"))
+            proc = exec_command(
+                ["djvm", "-c", args["path"], *filelist], args["pidfile"]
             )
-            with tempfile.NamedTemporaryFile(
-                dir=args.get("dir"), suffix=".djvu", delete=False
-            ) as djvu:
-                # logger.error("Caught error writing DjVu: %s", err)
-                # self._thread_throw_error(
-                #     args["uuid"],
-                #     args["page"]["uuid"],
-                #     "Save file",
-                #     f"Caught error writing DjVu: {_}.",
-                # )
-                # error = True
-
-                # if error:
-                #     return
-                page.write_image_for_djvu(djvu.name, args)
-                filelist.append(djvu.name)
+            self.check_cancelled()
+            if proc.returncode:
+                logger.error("Error merging DjVu: %s", proc.stderr)
+                request.error(_("Error merging DjVu: %s") % (proc.stderr,))
+                return
+
+            script = _djvused_script(layers, args.get("metadata"))
+            if script:
+                scriptfile = outdir / "djvused.txt"
+                scriptfile.write_text(script, encoding="utf-8")
+                cmd = ["djvused", args["path"], "-f", str(scriptfile), "-s"]
+                logger.info(cmd)
+                subprocess.run(cmd, check=True)
+                self.check_cancelled()
 
-        request.data(1.0)
-        request.data(_("Merging DjVu"))
-        proc = exec_command(["djvm", "-c", args["path"], *filelist], args["pidfile"])
-        for filename in filelist:
-            os.remove(filename)
-        self.check_cancelled()
-        if proc.returncode:
-            logger.error("Error merging DjVu: %s", proc.stderr)
-            request.error(_("Error merging DjVu: %s") % (proc.stderr,))
-
-        self._add_metadata_to_djvu(args)
         _set_timestamp(args)
         _post_save_hook(args["path"], args.get("options"))
         self.do_set_saved(
             Request("set_saved", (args["list_of_pages"], True), self.responses)
         )
 
-    def _add_metadata_to_djvu(self, options):
-        if "metadata" in options and options["metadata"] is not None:
-            metadata = prepare_output_metadata("DjVu", options["metadata"])
-
-            # Write djvusedmetafile
-            with tempfile.NamedTemporaryFile(
-                mode="wt", dir=options.get("dir"), suffix=".txt"
-            ) as fhd:
-                fhd.write("(metadata\n")
-
-                # Write the metadata
-                for key, val in metadata.items():
-                    if val is not None:
-                        # backslash-escape any double quotes and bashslashes
-                        val = re.sub(
-                            r"\\",
-                            r"\\\\",
-                            val,
-                            flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
-                        )
-                        val = re.sub(
-                            r"\"",
-                            r"\\\"",
-                            val,
-                            flags=re.MULTILINE | re.DOTALL | re.VERBOSE,
-                        )
-                        fhd.write(f'{key} "{val}"\n')
-
-                fhd.write(")\n")
-                fhd.flush()
-
-                # Write djvusedmetafile
-                cmd = [
-                    "djvused",
-                    "-e",
-                    f'"set-meta" {fhd.name}',
-                    options["path"],
-                    "-s",
-                ]
-                subprocess.run(cmd, check=True)
-                self.check_cancelled()
-                # if status:
-                #     logger.error("Error adding metadata info to DjVu file")
-                #     self._thread_throw_error(
-                #         options["uuid"],
-                #         options["page"]["uuid"],
-                #         "Save file",
-                #         _("Error adding metadata to DjVu"),
-                #     )
-
     def save_tiff(self, **kwargs):
         "save TIFF"
         callbacks = _note_callbacks(kwargs)
@@ -421,57 +352,19 @@ class SaveThread(Importhread):
     def do_save_tiff(self, request):
         "save TIFF in thread"
         options = request.args[0]
+        npages = len(options["list_of_pages"])
 
-        i = 0
-        filelist = []
-        for page_id in options["list_of_pages"]:
-            page = self.get_page(id=page_id)
-            request.data(i / (len(options["list_of_pages"]) + 1))
-            i += 1
-            # self.message = _("Converting image %i of %i to TIFF") % (
-            #     page,
-            #     len(options["list_of_pages"]) - 1 + 1,
-            # )
-            with tempfile.NamedTemporaryFile(
-                dir=options.get("dir"), suffix=".tif", delete=False
-            ) as out:
-                page.write_image_for_tiff(out.name, options)
+        def frames():
+            for i, page_id in enumerate(options["list_of_pages"]):
+                page = self._export_page(page_id)
+                request.data(i / (npages + 1))
+                yield page.tiff_frame(options)
                 self.check_cancelled()
-                # if status:
-                #     logger.error("Error writing TIFF")
-                #     self._thread_throw_error(
-                #         options["uuid"],
-                #         options["page"]["uuid"],
-                #         "Save file",
-                #         _("Error writing TIFF"),
-                #     )
-                #     return
-                filelist.append(out.name)
-
-        compression = []
-        if "compression" in options["options"]:
-            compression = ["-c", options["options"]["compression"]]
-            if options["options"]["compression"] == "jpeg":
-                compression[1] += f":{options['options']['quality']}"
-                compression.append(["-r", "16"])
-
-        # Create the tiff
+
+        # The pages are written as they are fetched from the database, so that
+        # only one is held in memory at a time
+        _write_tiff(frames(), options["path"], options["options"])
         request.data(1.0)
-        # self.message = _("Concatenating TIFFs")
-        cmd = ["tiffcp", *compression, *filelist, options["path"]]
-        subprocess.run(cmd, check=True)
-        for filename in filelist:
-            os.remove(filename)
-        self.check_cancelled()
-        # if status or error != EMPTY:
-        #     logger.info(error)
-        #     self._thread_throw_error(
-        #         options["uuid"],
-        #         options["page"]["uuid"],
-        #         "Save file",
-        #         _("Error compressing image: %s") % (error),
-        #     )
-        #     return
 
         if "ps" in options["options"] and options["options"]["ps"] is not None:
             # self.message = _("Converting to PS")
@@ -502,7 +395,7 @@ class SaveThread(Importhread):
 
         i = 0
         for page_id in options["list_of_pages"]:
-            page = self.get_page(id=page_id)
+            page = self._export_page(page_id)
             i += 1
             if len(options["list_of_pages"]) > 1:
                 filename = options["path"] % (i)
@@ -529,7 +422,7 @@ class SaveThread(Importhread):
 
         string = ""
         for page_id in options["list_of_pages"]:
-            page = self.get_page(id=page_id)
+            page = self._export_page(page_id)
             string += page.export_text()
             self.check_cancelled()
 
@@ -539,6 +432,9 @@ class SaveThread(Importhread):
         if "options" not in options:
             options["options"] = None
         _post_save_hook(options["path"], options["options"])
+        self.do_set_saved(
+            Request("set_saved", (options["list_of_pages"], True), self.responses)
+        )
 
     def save_hocr(self, **kwargs):
         "save hocr file"
@@ -552,7 +448,7 @@ class SaveThread(Importhread):
         with open(options["path"], "w", encoding="utf-8") as fhd:
             written_header = False
             for page_id in options["list_of_pages"]:
-                page = self.get_page(id=page_id)
+                page = self._export_page(page_id)
                 hocr = page.export_hocr()
                 regex = re.search(
                     r"([\s\S]*<body>)([\s\S]*)<\/body>",
@@ -575,6 +471,71 @@ class SaveThread(Importhread):
         if "options" not in options:
             options["options"] = None
         _post_save_hook(options["path"], options["options"])
+        self.do_set_saved(
+            Request("set_saved", (options["list_of_pages"], True), self.responses)
+        )
+
+    def save_multiple(self, **kwargs):
+        "save the document in several formats at once"
+        callbacks = _note_callbacks(kwargs)
+        return self.send("save_multiple", kwargs, **callbacks)
+
+    def do_save_multiple(self, request):
+        """save the document in several formats at once in thread, fetching
+        each page only once. Each target is a dict with the format, one of pdf,
+        djvu, tiff, image, text or hocr, and the options of its save, which is
+        run by the usual method on a thread of its own"""
+        options = request.args[0]
+        list_of_pages = options["list_of_pages"]
+        npages = len(list_of_pages)
+        common = {key: value for key, value in options.items() if key != "targets"}
+        targets = [{**common, **target} for target in options["targets"]]
+        decode = any(target["format"] not in _TEXT_FORMATS for target in targets)
+        feeds = [_PageFeed() for _target in targets]
+
+        def write(target, feed):
+            _FEED.feed = feed
+            try:
+                handler = getattr(self, f"do_save_{target['format']}")
+                handler(_TargetRequest(request, target))
+            finally:
+                _FEED.feed = None
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(targets)
+        ) as executor:
+            for target, feed in zip(targets, feeds):
+                feed.future = executor.submit(write, target, feed)
+            try:
+                for i, page_id in enumerate(list_of_pages, start=1):
+                    page = self.get_page(id=page_id)
+                    request.data(i / (npages + 1))
+                    request.data(_("Writing page %i of %i") % (i, npages))
+                    if decode:
+                        # decode the image here, rather than in each writer
+                        page.image_object.load()
+                    for feed in feeds:
+                        feed.put(page_id, page, self.check_cancelled)
+                    self.check_cancelled()
+            except BaseException:
+                for feed in feeds:
+                    feed.close()
+                raise
+            concurrent.futures.wait([feed.future for feed in feeds])
+        page_pdfs = [pdf for feed in feeds for pdf in feed.page_pdfs or []]
+        if page_pdfs:
+            _prune_pdf_cache(_pdf_cache_dir(options), page_pdfs)
+        for feed in feeds:
+            feed.future.result()
+        request.data(1.0)
+
+    def _export_page(self, page_id):
+        """return the page to be saved, from the pages fetched by save_multiple
+        if running as the writer of one of its targets"""
+        feed = getattr(_FEED, "feed", None)
+        if feed is not None:
+            return feed.get(page_id)
+        return self.get_page(id=page_id)
 
     def do_set_paper_sizes(self, request):
         "set paper sizes in thread"
@@ -687,47 +648,521 @@ class SaveThread(Importhread):
             )
 
 
-def _need_temp_pdf(options):
-    return options and (
-        "prepend" in options
-        or "append" in options
-        or "ps" in options
-        or ("user-password" in options and options["user-password"] != "")
+class _PageFeed:
+    """Pass the pages fetched by save_multiple, in order, to the writer of one
+    of its targets"""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=_FEED_PAGES)
+        self.future = None
+        # the pages of the PDF written from the page cache, if any
+        self.page_pdfs = None
+
+    def put(self, page_id, page, check_cancelled):
+        "pass on a page, unless the writer has already stopped"
+        while not self.future.done():
+            try:
+                self._queue.put((page_id, page), timeout=_FEED_TIMEOUT)
+                return
+            except queue.Full:
+                check_cancelled()
+
+    def get(self, page_id):
+        "return the next page, which the writer expects to be the given one"
+        item = self._queue.get()
+        if item is None:
+            raise CancelledError()
+        if item[0] != page_id:
+            raise ValueError(f"Expected page id {page_id}, got {item[0]}")
+        return item[1]
+
+    def close(self):
+        "stop the writer, dropping the pages it has not yet taken"
+        with contextlib.suppress(queue.Empty):
+            while True:
+                self._queue.get_nowait()
+        self._queue.put(None)
+
+
+class _TargetRequest:
+    """Stand in for the request of save_multiple in the writer of one of its
+    targets. The progress of the job is that of the pages fetched, so the
+    progress of the writers is dropped, but their messages and errors are
+    passed on."""
+
+    def __init__(self, request, options):
+        self.process = f"save_{options['format']}"
+        self.args = (options,)
+        self._request = request
+
+    def data(self, info, status=None):
+        "pass messages back to the main thread"
+        if not isinstance(info, float):
+            self._request.data(info, status)
+
+    def error(self, info=None, status=None):
+        "error notification"
+        self._request.error(info, status)
+
+
+def _write_djvu_page(page, filename, options):
+    "encode a page as DjVu, returning the filename"
+    page.write_image_for_djvu(str(filename), options)
+    return str(filename)
+
+
+def _tiff_params(options):
+    "return the Pillow parameters for writing TIFF frames with the options"
+    params = {}
+    compression = _TIFF_COMPRESSION.get(options.get("compression"))
+    if compression is not None:
+        params["compression"] = compression
+        if compression == "jpeg" and "quality" in options:
+            params["quality"] = options["quality"]
+    return params
+
+
+def _write_tiff(frames, path, options):
+    """write a multi-page TIFF, one frame at a time, from an iterable of images
+    and their resolutions"""
+    params = _tiff_params(options)
+    with open(path, "w+b") as fhd:
+        try:
+            with TiffImagePlugin.AppendingTiffWriter(fhd) as tiff:
+                for image, dpi in frames:
+                    image.save(tiff, format="TIFF", dpi=dpi, **params)
+                    tiff.newFrame()
+        except BaseException:
+            # don't leave a truncated TIFF behind if cancelled
+            fhd.close()
+            os.remove(path)
+            raise
+
+
+def _djvused_script(layers, metadata):
+    """return a djvused script setting the text and annotation layers of each
+    page, as given by Page.djvused_layers(), and the document metadata"""
+    script = ""
+    for i, layer in enumerate(layers, start=1):
+        if layer:
+            script += f"select {i}\n{layer}"
+    if metadata is not None:
+        script += "select\nset-meta\n(metadata\n"
+        for key, val in prepare_output_metadata("DjVu", metadata).items():
+            if val is not None:
+                # backslash-escape any double quotes and backslashes
+                val = val.replace("\\", "\\\\").replace('"', '\\"')
+                script += f'{key} "{val}"\n'
+        script += ")\n.\n"
+    return script
+
+
+def _proxy(image):
+    """return bands spread down the image, stacked, with about
+    _ESTIMATE_PIXELS pixels, and the fraction of the image they cover"""
+    rows = _ESTIMATE_PIXELS // image.width
+    if rows >= image.height:
+        return image, 1
+    # bands of multiples of 16 rows, starting on multiples of 16 rows, so
+    # that their JPEG blocks are those of the image
+    band = max(16, rows // _ESTIMATE_BANDS // 16 * 16)
+    nbands = max(1, min(rows // band, image.height // band))
+    proxy = Image.new(image.mode, (image.width, band * nbands))
+    if image.mode in ("P", "PA"):
+        proxy.putpalette(image.getpalette())
+    step = image.height / nbands
+    for i in range(nbands):
+        top = min(int((i + 0.5) * step) - band // 2, image.height - band) // 16 * 16
+        proxy.paste(image.crop((0, top, image.width, top + band)), (0, i * band))
+    return proxy, proxy.height / image.height
+
+
+def _estimate_page_size(page, image_type, options, resolution, tempdir):
+    """estimate the size in bytes of the page in a save of the given format, by
+    encoding a proxy of the page as it would be saved"""
+    if re.search(r"pdf", image_type):
+        buf = io.BytesIO()
+        if options.get("compression") == "mrc" and page.image_object.mode != "1":
+            proxy, fraction = _proxy(page.image_object)
+            mrc.write_pdf_page(
+                proxy,
+                buf,
+                (px2pt(proxy.width, resolution[0]), px2pt(proxy.height, resolution[1])),
+                resolution,
+                quality=options.get("quality"),
+            )
+            return len(buf.getvalue()) / fraction
+        image, compression, passthrough = page.pdf_encoding({"options": options})
+        if passthrough:
+            return len(page.to_stored_bytes())
+        proxy, fraction = _proxy(image)
+        write_pdf_image(proxy, buf, compression, resolution, options.get("quality"))
+        return len(buf.getvalue()) / fraction
+
+    proxy, fraction = _proxy(page.image_object)
+    page = Page(image_object=proxy, resolution=page.resolution)
+    if image_type == "djvu":
+        filename = os.path.join(tempdir, "proxy.djvu")
+        page.write_image_for_djvu(filename, {"dir": tempdir, "pidfile": None})
+        return os.path.getsize(filename) / fraction
+    buf = io.BytesIO()
+    if image_type == "tif":
+        image, dpi = page.tiff_frame({"options": options})
+        image.save(buf, format="TIFF", dpi=dpi, **_tiff_params(options))
+    else:
+        proxy.save(buf, format=_ESTIMATE_IMAGE_FORMATS[image_type])
+    return len(buf.getvalue()) / fraction
+
+
+def _write_pdf_page(page, page_pdf, resolution, options, cache_dir=None):
+    """write a page as a single-page PDF, or find it in the cache, returning its
+    filename, its size, which is about what it adds to the output, and the
+    content stream of its text layer"""
+    opts = options.get("options") or {}
+    width = px2pt(page.width, resolution[0])
+    height = px2pt(page.height, resolution[1])
+    text_layer = None
+    if page.text_layer and page.text_layer != "[]":
+        text_layer = _text_layer_content(page.text_layer, resolution, height)
+
+    cached_pdf = None
+    if cache_dir is not None:
+        # MRC pages also depend on the text layer, which restricts the mask
+        text_digest = None
+        if opts.get("compression") == "mrc" and page.text_layer:
+            text_digest = hashlib.sha256(page.text_layer.encode()).hexdigest()
+        key = repr(
+            (
+                page.digest(),
+                width,
+                height,
+                [opts.get(option) for option in _PAGE_PDF_OPTIONS],
+                text_digest,
+            )
+        )
+        cached_pdf = cache_dir / f"{hashlib.sha256(key.encode()).hexdigest()}.pdf"
+        if cached_pdf.exists():
+            logger.debug("Using cached %s for page %s", cached_pdf, page.id)
+            os.utime(cached_pdf)
+            return cached_pdf, os.path.getsize(cached_pdf), text_layer
+
+    if opts.get("compression") == "mrc" and page.image_object.mode != "1":
+        mrc.write_pdf_page(
+            page.image_object,
+            page_pdf,
+            (width, height),
+            resolution,
+            page.text_layer,
+            opts.get("quality"),
+        )
+    else:
+        with tempfile.NamedTemporaryFile(
+            dir=options.get("dir"), suffix=".png", delete=False
+        ) as tmp:
+            page.write_image_for_pdf(tmp.name, options)
+        with open(page_pdf, "wb") as fhd:
+            img2pdf.convert(
+                tmp.name, layout_fun=_layout_fun(width, height), outputstream=fhd
+            )
+        os.remove(tmp.name)
+    size = os.path.getsize(page_pdf)
+    if cached_pdf is not None:
+        os.replace(page_pdf, cached_pdf)
+        page_pdf = cached_pdf
+    return page_pdf, size, text_layer
+
+
+def _pdf_cache_dir(options):
+    "return the directory in the session directory caching page PDFs, if any"
+    if not options.get("dir"):
+        return None
+    cache_dir = pathlib.Path(options["dir"]) / _PDF_CACHE_DIR
+    cache_dir.mkdir(exist_ok=True)
+    return cache_dir
+
+
+def _prune_pdf_cache(cache_dir, page_pdfs):
+    "remove the pages from the cache that were not in the last saved PDF"
+    keep = set(page_pdfs)
+    for path in cache_dir.glob("*.pdf"):
+        if path not in keep:
+            path.unlink(missing_ok=True)
+
+
+def _layout_fun(width, height):
+    """return an img2pdf layout function filling a page of the given size in
+    points, which is kept if the image has been downsampled"""
+
+    def layout_fun(_imgwidthpx, _imgheightpx, _ndpi):
+        return width, height, width, height
+
+    return layout_fun
+
+
+def _text_layer_content(text_layer, resolution, height):
+    """return a content stream drawing the text layer invisibly, with each word
+    on the baseline of its line and scaled horizontally to fill its bbox"""
+    xresolution, yresolution = resolution
+    ops = []
+
+    def show(text, left, right, baseline, size):
+        encoded = text.encode("utf-16-be")
+        width = len(encoded) // 2 * size / _CHAR_ASPECT
+        if width <= 0 or size <= 0 or right <= left:
+            return
+        ops.append(
+            f"{size:.2f} {_TEXT_FONT} Tf {100 * (right - left) / width:.2f} Tz "
+            f"1 0 0 1 {left:.2f} {baseline:.2f} Tm <{encoded.hex()}> Tj"
+        )
+
+    line, words = None, []
+
+    def show_line():
+        # words are placed on the baseline of their line, if they have one
+        if line is None or line["type"] not in ("line", "header", "footer", "caption"):
+            text_line = None
+        else:
+            text_line = line
+        for i, word in enumerate(words):
+            x_1, _y_1, x_2, _y_2 = word["bbox"]
+            bbox = text_line["bbox"] if text_line else word["bbox"]
+            base = bbox[3]
+            if text_line and "baseline" in text_line:
+                base += text_line["baseline"][-1]
+            size = px2pt(base - bbox[1], yresolution)
+            baseline = height - px2pt(base, yresolution)
+            left, right = px2pt(x_1, xresolution), px2pt(x_2, xresolution)
+            show(word["text"], left, right, baseline, size)
+            # a space filling the gap to the next word, so that text extraction
+            # separates them
+            if i + 1 < len(words):
+                show(
+                    " ",
+                    right,
+                    px2pt(words[i + 1]["bbox"][0], xresolution),
+                    baseline,
+                    size,
+                )
+
+    for bbox in Bboxtree(text_layer).each_bbox():
+        if bbox["type"] == "word":
+            if bbox.get("text", "") != "":
+                words.append(bbox)
+            continue
+        show_line()
+        line, words = bbox, []
+        if bbox.get("text", "") != "":
+            # text without word positions, e.g. from plain text, so divide the
+            # box between its lines
+            lines = bbox["text"].splitlines() or [bbox["text"]]
+            x_1, y_1, x_2, y_2 = bbox["bbox"]
+            step = (y_2 - y_1) / len(lines)
+            for i, text in enumerate(lines):
+                show(
+                    text,
+                    px2pt(x_1, xresolution),
+                    px2pt(x_2, xresolution),
+                    height - px2pt(y_1 + step * (i + 1), yresolution),
+                    px2pt(step, yresolution),
+                )
+    show_line()
+    if not ops:
+        return None
+    return ("BT 3 Tr\n" + "\n".join(ops) + "\nET\n").encode("ascii")
+
+
+def _glyphless_font(pdf):
+    "add the glyphless font used to draw the text layer to the PDF"
+    descriptor = pdf.make_indirect(
+        pikepdf.Dictionary(
+            Type=pikepdf.Name.FontDescriptor,
+            FontName=pikepdf.Name.GlyphLessFont,
+            Flags=5,  # fixed pitch and symbolic
+            FontBBox=[0, 0, 1000 // _CHAR_ASPECT, 1000],
+            ItalicAngle=0,
+            Ascent=1000,
+            Descent=-1,
+            CapHeight=1000,
+            StemV=80,
+            FontFile2=pdf.make_stream(_GLYPHLESS_FONT.read_bytes()),
+        )
+    )
+    cid_font = pdf.make_indirect(
+        pikepdf.Dictionary(
+            Type=pikepdf.Name.Font,
+            Subtype=pikepdf.Name.CIDFontType2,
+            BaseFont=pikepdf.Name.GlyphLessFont,
+            CIDSystemInfo=pikepdf.Dictionary(
+                Registry="Adobe", Ordering="Identity", Supplement=0
+            ),
+            FontDescriptor=descriptor,
+            DW=1000 // _CHAR_ASPECT,
+            CIDToGIDMap=pdf.make_stream(
+                zlib.compress(b"\x00\x01" * 65536), Filter=pikepdf.Name.FlateDecode
+            ),
+        )
+    )
+    to_unicode = pdf.make_stream(
+        b"/CIDInit /ProcSet findresource begin\n"
+        b"12 dict begin\n"
+        b"begincmap\n"
+        b"/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def\n"
+        b"/CMapName /Adobe-Identity-UCS def\n"
+        b"/CMapType 2 def\n"
+        b"1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n"
+        b"1 beginbfrange\n<0000> <FFFF> <0000>\nendbfrange\n"
+        b"endcmap\n"
+        b"CMapName currentdict /CMap defineresource pop\n"
+        b"end\n"
+        b"end\n"
+    )
+    return pdf.make_indirect(
+        pikepdf.Dictionary(
+            Type=pikepdf.Name.Font,
+            Subtype=pikepdf.Name.Type0,
+            BaseFont=pikepdf.Name.GlyphLessFont,
+            Encoding=pikepdf.Name("/Identity-H"),
+            DescendantFonts=[cid_font],
+            ToUnicode=to_unicode,
+        )
     )
 
 
-def _estimate_page_pdf_size(image, temp_filename, opts):
-    "Estimate a page's contribution to the output PDF size in bytes"
-    if (
-        image.format == "JPEG"
-        and not opts.get("downsample")
-        and not (opts.get("compression") and opts["compression"][0] == "g")
-    ):
-        # JPEG is stored verbatim, so the written file size is the size it
-        # will take in the PDF.
-        return os.path.getsize(temp_filename)
-    # Other formats are stored uncompressed, so estimate from the pixel data.
-    bpp = _PIXEL_BPP.get(image.mode, 4)
-    return int(image.width * image.height * bpp)
-
-
-def _fix_pdf_metadata(path, remove_title):
-    "brand scantpaper as the PDF creator and remove any placeholder title"
-    creator = f"scantpaper v{VERSION}"
-    with pikepdf.open(path, allow_overwriting_input=True) as pdf:
-        existing_creator = str(pdf.docinfo.get("/Creator", "")).strip()
-        if existing_creator:
-            creator = f"{creator} / {existing_creator}"
-        with pdf.open_metadata(
-            set_pikepdf_as_editor=False, update_docinfo=False
-        ) as metadata:
-            if remove_title:
-                metadata.pop("dc:title", None)
-            metadata["xmp:CreatorTool"] = creator
-        if remove_title and "/Title" in pdf.docinfo:
-            del pdf.docinfo["/Title"]
-        pdf.docinfo["/Creator"] = creator
-        pdf.save(path, preserve_pdfa=True, linearize=True)
+def _set_xmp_metadata(pdf, pdfa):
+    """brand scantpaper as the PDF creator, and if requested, identify the PDF
+    as PDF/A-2B, with an sRGB output intent"""
+    pdf.docinfo["/Creator"] = f"scantpaper v{VERSION}"
+    with pdf.open_metadata() as metadata:
+        metadata.load_from_docinfo(pdf.docinfo)
+        if pdfa:
+            metadata["pdfaid:part"] = "2"
+            metadata["pdfaid:conformance"] = "B"
+    if not pdfa:
+        return
+    profile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    pdf.Root.OutputIntents = [
+        pikepdf.Dictionary(
+            Type=pikepdf.Name.OutputIntent,
+            S=pikepdf.Name.GTS_PDFA1,
+            OutputConditionIdentifier="sRGB",
+            DestOutputProfile=pdf.make_stream(profile, N=3),
+        )
+    ]
+
+
+def _uses_device_cmyk(pdf):
+    """return whether any image on the pages is in DeviceCMYK, as for CMYK
+    JPEGs, which are passed through as they are stored"""
+    for page in pdf.pages:
+        for xobject in page.Resources.get("/XObject", {}).values():
+            if xobject.get("/ColorSpace") == pikepdf.Name.DeviceCMYK:
+                return True
+    return False
+
+
+def _open_pdfs(stack, filenames):
+    """open the PDFs in the exit stack, returning the first, with the pages of
+    the others appended. qpdf only copies their contents as the output is
+    written, so memory use does not grow with the number of pages, but they
+    must stay open until then."""
+    pdf = stack.enter_context(pikepdf.open(filenames[0]))
+    for fname in filenames[1:]:
+        pdf.pages.extend(stack.enter_context(pikepdf.open(fname)).pages)
+    return pdf
+
+
+def _set_docinfo(pdf, metadata):
+    "replace the document information dictionary with the output metadata"
+    for key in list(pdf.docinfo.keys()):
+        del pdf.docinfo[key]
+    for key, val in metadata.items():
+        if key not in _DOCINFO_KEYS:
+            continue
+        if isinstance(val, datetime.datetime):
+            val = "D:" + val.astimezone(datetime.timezone.utc).strftime("%Y%m%d%H%M%SZ")
+        pdf.docinfo[_DOCINFO_KEYS[key]] = val
+
+
+def _write_pdf(
+    filenames,
+    text_layers,
+    path,
+    metadata=None,
+    linearize=True,
+    prepend=None,
+    append=None,
+    password=None,
+    pdfa=False,
+):  # pylint: disable=too-many-arguments
+    """concatenate single-page PDFs, add their text layers and the metadata,
+    prepend them to or append them to any existing PDF, and write the output,
+    encrypted with any password, in one pass, identified as PDF/A-2B if
+    requested and it can conform. To limit the number of open files, long
+    documents are first merged in rounds."""
+    level = 0
+    while len(filenames) > _MAX_OPEN_PDFS:
+        merged = []
+        for start in range(0, len(filenames), _MAX_OPEN_PDFS):
+            target = filenames[start].with_name(f"merged-{level}-{start:06}.pdf")
+            with contextlib.ExitStack() as stack:
+                _open_pdfs(stack, filenames[start : start + _MAX_OPEN_PDFS]).save(
+                    target
+                )
+            merged.append(target)
+        if level:
+            for fname in filenames:
+                os.remove(fname)
+        filenames = merged
+        level += 1
+
+    with contextlib.ExitStack() as stack:
+        pdf = _open_pdfs(stack, filenames)
+        font = None
+        for page, text_layer in zip(pdf.pages, text_layers):
+            if text_layer is not None:
+                if font is None:
+                    font = _glyphless_font(pdf)
+                page.add_resource(font, pikepdf.Name.Font, _TEXT_FONT)
+                page.contents_add(pdf.make_stream(text_layer))
+
+        # As with pdfunite, the metadata is that of the first document
+        if append is not None:
+            existing = stack.enter_context(pikepdf.open(append))
+            existing.pages.extend(pdf.pages)
+            pdf = existing
+        else:
+            _set_docinfo(pdf, metadata or {})
+            # Only our own pages are known to conform to PDF/A-2B, which also
+            # rules out encryption, and CMYK images with the sRGB output intent
+            pdfa = (
+                pdfa and prepend is None and not password and not _uses_device_cmyk(pdf)
+            )
+            _set_xmp_metadata(pdf, pdfa)
+            if prepend is not None:
+                pdf.pages.extend(stack.enter_context(pikepdf.open(prepend)).pages)
+
+        encryption = False
+        if password:
+            encryption = pikepdf.Encryption(owner=password, user=password, R=6)
+        # The existing PDF is still being read as the output is written, so
+        # write it alongside and replace the existing PDF afterwards
+        target = path
+        if prepend is not None or append is not None:
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(os.path.abspath(path)), suffix=".pdf", delete=False
+            ) as tmp:
+                target = tmp.name
+        try:
+            pdf.save(target, linearize=linearize, encryption=encryption)
+        except BaseException:
+            if target != path:
+                os.remove(target)
+            raise
+    if target != path:
+        os.replace(target, path)
+    if level:
+        for fname in filenames:
+            os.remove(fname)
 
 
 def prepare_output_metadata(ftype, metadata):
@@ -749,41 +1184,6 @@ def prepare_output_metadata(ftype, metadata):
     return out
 
 
-def _append_pdf(filename, options, request):
-    if options is None or "options" not in options or options["options"] is None:
-        return None
-    if "prepend" in options["options"]:
-        file1 = filename
-        file2 = options["options"]["prepend"] + ".bak"
-        bak = file2
-        out = options["options"]["prepend"]
-        message = _("Error prepending PDF: %s")
-        logger.info("Prepending PDF")
-
-    elif "append" in options["options"]:
-        file2 = filename
-        file1 = options["options"]["append"] + ".bak"
-        bak = file1
-        out = options["options"]["append"]
-        message = _("Error appending PDF: %s")
-        logger.info("Appending PDF")
-
-    else:
-        return None
-
-    try:
-        os.rename(out, bak)
-    except ValueError:
-        request.error(_("Error creating backup of PDF"))
-        return None
-
-    proc = exec_command(["pdfunite", file1, file2, out], options["pidfile"])
-    if proc.returncode:
-        logger.info(proc.stderr)
-        request.error(message % (proc.stderr))
-    return proc.returncode
-
-
 def _set_timestamp(options):
     if (
         not options.get("options")
@@ -817,31 +1217,6 @@ def _post_save_hook(filename, options):
         subprocess.run(args, check=True)
 
 
-def _encrypt_pdf(filename, options, request):
-    cmd = ["qpdf"]
-    if "user-password" in options["options"]:
-        cmd += [
-            "--encrypt",
-            f"--owner-password={options['options']['user-password']}",
-            f"--user-password={options['options']['user-password']}",
-            "--bits=256",
-            "--allow-insecure",
-            "--",
-        ]
-    cmd += [filename, options["path"]]
-
-    spo = subprocess.run(
-        cmd,
-        check=True,
-        capture_output=True,
-        text=True,
-    )
-    if spo.returncode != 0:
-        logger.info(spo.stderr)
-        request.error(_("Error encrypting PDF: %s") % (spo.stderr))
-    return spo.returncode
-
-
 def px2pt(pixels, resolution):
     """helper function to return length in points given a number of pixels
     and the resolution"""
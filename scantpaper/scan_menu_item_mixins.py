@@ -11,6 +11,7 @@ from dialog import Dialog
 from dialog.sane import SaneScanDialog
 from i18n import _
 from postprocess_controls import OCRControls, RotateControls
+from progress import Progress
 from scanner.profile import Profile
 
 gi.require_version("Gtk", "3.0")
@@ -18,6 +19,21 @@ from gi.repository import Gtk  # pylint: disable=wrong-import-position
 
 logger = logging.getLogger(__name__)
 
+# Settings read by _new_scan_callback, which are snapshotted per scan dialog
+# when its scan button is clicked
+POSTPROCESSING_SETTINGS = [
+    "rotate facing",
+    "rotate reverse",
+    "unpaper on scan",
+    "udt_on_scan",
+    "current_udt",
+    "OCR on scan",
+    "ocr engine",
+    "ocr language",
+    "threshold-before-ocr",
+    "threshold tool",
+]
+
 
 class ScanMenuItemMixins:
     "provide methods called from scan menu item"
@@ -33,12 +49,65 @@ class ScanMenuItemMixins:
         if "device" not in self.settings and "SANE_DEFAULT_DEVICE" in os.environ:
             self.settings["device"] = os.environ["SANE_DEFAULT_DEVICE"]
 
-        # scan dialog
+        self._windows = self._create_scan_dialog(self._scan_progress)
+        if not hidden:
+            self._windows.show_all()
+        self._update_postprocessing_options_callback(self._windows)
+        args = self.get_application().args
+        if args.device:
+            device_list = []
+            for d in args.device:
+                device_list.append(SimpleNamespace(name=d, label=d))
+
+            self._windows.device_list = device_list
+
+        elif (
+            not scan
+            and self.settings["cache-device-list"]
+            and len(self.settings["device list"])
+        ):
+            self._windows.device_list = self.settings["device list"]
+        else:
+            self._windows.get_devices()
+
+    def scan_another_device_dialog(self, _action, _param):
+        """Open an additional scan dialog with its own SANE thread, so that
+        several devices can scan into the document in parallel"""
+        progress = Progress()
+        self.builder.get_object("progress_hbox").pack_start(progress, True, True, 0)
+        dialog = self._create_scan_dialog(progress)
+        dialog.set_title(_("Scan Document (additional device)"))
+        dialog.progress = progress
+        self._extra_scan_windows.append(dialog)
+
+        def hide_extra_scan_dialog(_widget, _event):
+            "Unlike the main scan dialog, additional ones are not reused"
+            self._close_extra_scan_dialog(dialog)
+            return True
+
+        dialog.connect("delete-event", hide_extra_scan_dialog)
+        dialog.show_all()
+        self._update_postprocessing_options_callback(dialog)
+        if self.settings["cache-device-list"] and len(self.settings["device list"]):
+            dialog.device_list = self.settings["device list"]
+        else:
+            dialog.get_devices()
+
+    def _close_extra_scan_dialog(self, dialog):
+        if dialog in self._extra_scan_windows:
+            self._extra_scan_windows.remove(dialog)
+        dialog.progress.destroy()
+        dialog.thread.quit()
+        dialog.destroy()
+
+    def _create_scan_dialog(self, progress):
+        "Create a scan dialog, reporting progress via the given progress bar"
+        primary = progress is self._scan_progress
         kwargs = {
             "transient_for": self,
             "title": _("Scan Document"),
             "dir": self.session,
-            "hide_on_delete": True,
+            "hide_on_delete": primary,
             "paper_formats": self.settings["Paper"],
             "allow_batch_flatbed": self.settings["allow-batch-flatbed"],
             "adf_defaults_scan_all_pages": self.settings["adf-defaults-scan-all-pages"],
@@ -51,83 +120,98 @@ class ScanMenuItemMixins:
             ),
             "profiles": self.settings["profile"],
         }
+        if self.settings["cache options"]:
+            if self.settings["cache"] is None:
+                self.settings["cache"] = {}
+            kwargs["option_cache"] = self.settings["cache"]
+            kwargs["sane_version"] = self.settings["SANE version"]
         if self.settings["scan_window_width"]:
             kwargs["default_width"] = self.settings["scan_window_width"]
         if self.settings["scan_window_height"]:
             kwargs["default_height"] = self.settings["scan_window_height"]
-        self._windows = SaneScanDialog(**kwargs)
+        dialog = SaneScanDialog(**kwargs)
 
         # Can't set the device when creating the window,
         # as the list does not exist then
-        self._windows.connect("changed-device-list", self._changed_device_list_callback)
+        dialog.connect("changed-device-list", self._changed_device_list_callback)
 
         # Update default device
-        self._windows.connect("changed-device", self._changed_device_callback)
+        dialog.connect("changed-device", self._changed_device_callback)
         signal = None
 
         def started_progress_callback(_widget, message):
             logger.debug("'started-process' emitted with message: %s", message)
-            self._scan_progress.set_fraction(0)
-            self._scan_progress.set_text(message)
-            self._scan_progress.show()
+            progress.set_fraction(0)
+            progress.set_text(message)
+            progress.show()
             nonlocal signal
-            signal = self._scan_progress.connect("clicked", self._windows.cancel_scan)
+            signal = progress.connect("clicked", dialog.cancel_scan)
 
-        self._windows.connect("started-process", started_progress_callback)
-        self._windows.connect("changed-progress", self._changed_progress_callback)
-        self._windows.connect("finished-process", self._finished_process_callback)
+        dialog.connect("started-process", started_progress_callback)
+        dialog.connect("changed-progress", self._changed_progress_callback)
+
+        def finished_process_callback(widget, process):
+            nonlocal signal
+            if primary:
+                self._finished_process_callback(widget, process, signal)
+            else:
+                # only hide the dialog's own progress bar
+                if signal is not None:
+                    progress.disconnect(signal)
+                progress.hide()
+                self._prompt_reverse_sides(widget, process)
+            signal = None
+
+        dialog.connect("finished-process", finished_process_callback)
 
         def do_process_error(_widget, process, msg):
-            self._process_error_callback(_widget, process, msg, signal)
+            if primary:
+                self._process_error_callback(_widget, process, msg, signal)
+            else:
+                if signal is not None:
+                    progress.disconnect(signal)
+                progress.hide()
+                self._show_message_dialog(
+                    parent=dialog,
+                    message_type="error",
+                    buttons=Gtk.ButtonsType.CLOSE,
+                    page="",
+                    process=process,
+                    text=msg,
+                    store_response=True,
+                )
 
-        self._windows.connect("process-error", do_process_error)
-        self._windows.connect("changed-profile", self._changed_profile_callback)
-        self._windows.connect("added-profile", self._added_profile_callback)
+        dialog.connect("process-error", do_process_error)
+        dialog.connect("changed-profile", self._changed_profile_callback)
+        dialog.connect("added-profile", self._added_profile_callback)
 
         def removed_profile_callback(_widget, profile):
             del self.settings["profile"][profile]
 
-        self._windows.connect("removed-profile", removed_profile_callback)
+        dialog.connect("removed-profile", removed_profile_callback)
 
         def changed_current_scan_options_callback(_widget, profile, _uuid):
             "Update the default profile when the scan options change"
             self.settings["default-scan-options"] = profile.get()
 
-        self._windows.connect(
+        dialog.connect(
             "changed-current-scan-options", changed_current_scan_options_callback
         )
 
         def changed_paper_formats_callback(_widget, formats):
             self.settings["Paper"] = formats
 
-        self._windows.connect("changed-paper-formats", changed_paper_formats_callback)
-        self._windows.connect("new-scan", self._new_scan_callback)
-        self._windows.connect(
+        dialog.connect("changed-paper-formats", changed_paper_formats_callback)
+        dialog.connect("new-scan", self._new_scan_callback)
+        dialog.connect(
             "changed-scan-option", self._update_postprocessing_options_callback
         )
-        self.add_postprocessing_options(self._windows)
-        if not hidden:
-            self._windows.show_all()
-        self._update_postprocessing_options_callback(self._windows)
-        args = self.get_application().args
-        if args.device:
-            device_list = []
-            for d in args.device:
-                device_list.append(SimpleNamespace(name=d, label=d))
-
-            self._windows.device_list = device_list
-
-        elif (
-            not scan
-            and self.settings["cache-device-list"]
-            and len(self.settings["device list"])
-        ):
-            self._windows.device_list = self.settings["device list"]
-        else:
-            self._windows.get_devices()
+        self.add_postprocessing_options(dialog, primary)
+        return dialog
 
-    def add_postprocessing_options(self, widget):
-        "Adds post-processing options to the dialog window."
+    def add_postprocessing_options(self, widget, primary=True):
+        """Adds post-processing options to the dialog window. Only the controls
+        of the primary scan dialog are tracked by the main window."""
         scwin = Gtk.ScrolledWindow()
         widget.notebook.append_page(scwin, Gtk.Label(label=_("Postprocessing")))
         scwin.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
@@ -136,17 +220,24 @@ class ScanMenuItemMixins:
         scwin.add(vboxp)
 
         # Rotate
-        self._rotate_controls = RotateControls(
+        rotate_controls = RotateControls(
             rotate_facing=self.settings["rotate facing"],
             rotate_reverse=self.settings["rotate reverse"],
         )
-        vboxp.pack_start(self._rotate_controls, False, False, 0)
+        widget.rotate_controls = rotate_controls
+        vboxp.pack_start(rotate_controls, False, False, 0)
 
         # CheckButton for unpaper
         ubutton = self._add_postprocessing_unpaper(vboxp)
 
         # CheckButton for user-defined tool
-        udtbutton, self._scan_udt_cmbx = self._add_postprocessing_udt(vboxp)
+        udt_hbox, udt_button = self._scan_udt_hbox, self._scan_udt_button
+        udtbutton, udt_cmbx = self._add_postprocessing_udt(vboxp)
+        if primary:
+            self._rotate_controls = rotate_controls
+            self._scan_udt_cmbx = udt_cmbx
+        else:
+            self._scan_udt_hbox, self._scan_udt_button = udt_hbox, udt_button
         ocr_controls = OCRControls(
             available_engines=self._ocr_engine,
             engine=self.settings["ocr engine"],
@@ -158,14 +249,14 @@ class ScanMenuItemMixins:
         vboxp.pack_start(ocr_controls, False, False, 0)
 
         def clicked_scan_button_cb(_w):
-            self.settings["rotate facing"] = self._rotate_controls.rotate_facing
-            self.settings["rotate reverse"] = self._rotate_controls.rotate_reverse
+            self.settings["rotate facing"] = rotate_controls.rotate_facing
+            self.settings["rotate reverse"] = rotate_controls.rotate_reverse
             logger.info("rotate facing %s", self.settings["rotate facing"])
             logger.info("rotate reverse %s", self.settings["rotate reverse"])
             self.settings["unpaper on scan"] = ubutton.get_active()
             logger.info("unpaper %s", self.settings["unpaper on scan"])
             self.settings["udt_on_scan"] = udtbutton.get_active()
-            self.settings["current_udt"] = self._scan_udt_cmbx.get_active_text()
+            self.settings["current_udt"] = udt_cmbx.get_active_text()
             logger.info("UDT %s", self.settings["udt_on_scan"])
             if "current_udt" in self.settings:
                 logger.info("Current UDT %s", self.settings["current_udt"])
@@ -187,6 +278,12 @@ class ScanMenuItemMixins:
                 )
                 self.settings["threshold tool"] = ocr_controls.threshold_value
 
+            # Each scan dialog keeps the settings its pages are processed with,
+            # in case another one is scanning at the same time
+            widget.postprocessing_settings = {
+                key: self.settings[key] for key in POSTPROCESSING_SETTINGS
+            }
+
         widget.connect("clicked-scan-button", clicked_scan_button_cb)
         # self->{notebook}->get_nth_page(1)->show_all;
 
@@ -261,7 +358,9 @@ class ScanMenuItemMixins:
         # widget is windows
         logger.info("signal 'changed-device' emitted with data: '%s'", device)
         if device is not None:
-            self.settings["device"] = device
+            # Additional scan dialogs don't change the default device
+            if widget not in self._extra_scan_windows:
+                self.settings["device"] = device
 
             # Can't set the profile until the options have been loaded. This
             # should only be called the first time after loading the available
@@ -330,9 +429,35 @@ class ScanMenuItemMixins:
                 if not libusb:
                     self.settings["device list"] = device_list
 
+            # Additional scan dialogs default to the first device not already
+            # open in another scan dialog
+            if widget in self._extra_scan_windows:
+                in_use = [
+                    w.device
+                    for w in [self._windows] + self._extra_scan_windows
+                    if w is not None and w is not widget
+                ]
+                for d in device_list:
+                    if d.name not in in_use:
+                        widget.device = d.name
+                        return
+                self._show_message_dialog(
+                    parent=self,
+                    message_type="error",
+                    buttons=Gtk.ButtonsType.CLOSE,
+                    page="",
+                    process="get_devices",
+                    text=_(
+                        "No free device: all devices are open in other scan dialogs"
+                    ),
+                    store_response=True,
+                )
+                self._close_extra_scan_dialog(widget)
+                return
+
             # Only set default device if it hasn't been specified on the command line
             # and it is in the the device list
-            if "device" in self.settings:
+            elif "device" in self.settings:
                 for d in device_list:
                     if self.settings["device"] == d.name:
                         widget.device = self.settings["device"]
@@ -340,6 +465,8 @@ class ScanMenuItemMixins:
 
             widget.device = device_list[0].name
 
+        elif widget in self._extra_scan_windows:
+            self._close_extra_scan_dialog(widget)
         else:
             self._windows = None
 
@@ -350,17 +477,27 @@ class ScanMenuItemMixins:
         # widget is windows
         options = widget.available_scan_options
         if options is not None:
-            self._rotate_controls.can_duplex = options.can_duplex()
+            rotate_controls = (
+                widget.rotate_controls
+                if widget in self._extra_scan_windows
+                else self._rotate_controls
+            )
+            rotate_controls.can_duplex = options.can_duplex()
 
-    def _changed_progress_callback(self, _widget, progress, message):
+    def _changed_progress_callback(self, widget, progress, message):
         "Updates the progress bar based on the given progress value and message."
+        pbar = (
+            widget.progress
+            if widget in self._extra_scan_windows
+            else self._scan_progress
+        )
         if progress is not None and (0 < progress <= 1):
-            self._scan_progress.set_fraction(progress)
+            pbar.set_fraction(progress)
         else:
-            self._scan_progress.pulse()
+            pbar.pulse()
         if message is not None:
-            self._scan_progress.set_text(message)
-        self._scan_progress.show()
+            pbar.set_text(message)
+        pbar.show()
 
     def _changed_profile_callback(self, _widget, profile):
         self.settings["default profile"] = profile
@@ -369,44 +506,55 @@ class ScanMenuItemMixins:
         self.settings["profile"][name] = profile.get()
 
     def _new_scan_callback(
-        self, _widget, image_object, insert_after, side, xresolution, yresolution
+        self, widget, image_bytes, insert_after, side, xresolution, yresolution
     ):
-        "Callback function to handle a new scan."
-        if image_object is None:
+        "Callback function to handle a new scan, already encoded for storage."
+        if image_bytes is None:
             return
 
-        rotate = (
-            self.settings["rotate facing"]
-            if side == "facing"
-            else self.settings["rotate reverse"]
+        settings = getattr(widget, "postprocessing_settings", None)
+        if settings is None:
+            settings = self.settings
+        options = self._post_processing_options(settings, side)
+        options.update(
+            {
+                "dir": self.session.name,
+                "queued_callback": self.post_process_progress.queued,
+                "started_callback": self.post_process_progress.update,
+                "finished_callback": self._import_scan_finished_callback,
+                "error_callback": self._error_callback,
+                "image_bytes": image_bytes,
+                "resolution": (xresolution, yresolution, "PixelsPerInch"),
+            }
         )
-        options = {
-            "dir": self.session.name,
-            "rotate": rotate,
-            "ocr": self.settings["OCR on scan"],
-            "engine": self.settings["ocr engine"],
-            "language": self.settings["ocr language"],
-            "queued_callback": self.post_process_progress.queued,
-            "started_callback": self.post_process_progress.update,
-            "finished_callback": self._import_scan_finished_callback,
-            "error_callback": self._error_callback,
-            "image_object": image_object,
-            "resolution": (xresolution, yresolution, "PixelsPerInch"),
-        }
         if insert_after is not None:
             options["insert_after"] = insert_after
-        if self.settings["unpaper on scan"]:
-            options["unpaper"] = self._unpaper
-
-        if self.settings["threshold-before-ocr"]:
-            options["threshold"] = self.settings["threshold tool"]
-
-        if self.settings["udt_on_scan"]:
-            options["udt"] = self.settings["current_udt"]
 
         logger.info("Importing scan with resolution=%s,%s", xresolution, yresolution)
         self.slist.import_scan(**options)
 
+    def _post_processing_options(self, settings, side="facing"):
+        "Return the options for the post-processing chain run on new scans"
+        options = {
+            "rotate": (
+                settings["rotate facing"]
+                if side == "facing"
+                else settings["rotate reverse"]
+            ),
+            "ocr": settings["OCR on scan"],
+            "engine": settings["ocr engine"],
+            "language": settings["ocr language"],
+        }
+        if settings["unpaper on scan"]:
+            options["unpaper"] = self._unpaper
+
+        if settings["threshold-before-ocr"]:
+            options["threshold"] = settings["threshold tool"]
+
+        if settings["udt_on_scan"]:
+            options["udt"] = settings["current_udt"]
+        return options
+
     def _reloaded_scan_options_callback(self, widget):  # widget is windows
         "This should only be called the first time after loading the available options"
         widget.disconnect(widget.reloaded_signal)
@@ -112,6 +112,28 @@ class Options(GObject.Object):
             >= paper["y"] + paper["t"]
         )
 
+    def has_same_layout(self, other):
+        """returns TRUE if other has the same option names and types at the same
+        indices, i.e. widgets built for one can be updated in place for the other"""
+        if other is None or self.num_options() != other.num_options():
+            return False
+        for old, new in zip(self.array, other.array):
+            if old.name != new.name or old.type != new.type:
+                return False
+        return True
+
+    def to_cache(self):
+        """returns the option descriptors in a JSON-serialisable form, suitable for
+        the option cache. Range constraints are tuples, which JSON would otherwise
+        turn into lists, so mark them explicitly."""
+        cache = []
+        for option in self.array:
+            option = list(option)
+            if isinstance(option[-1], tuple):
+                option[-1] = {"range": list(option[-1])}
+            cache.append(option)
+        return cache
+
     def can_duplex(self):
         """returns TRUE if the current options support duplex, even if not currently
         selected. Alternatively expressed, return FALSE if the scanner is not capable
@@ -167,6 +189,17 @@ class Options(GObject.Object):
         )
 
 
+def options_from_cache(cache):
+    "inverse of Options.to_cache()"
+    options = []
+    for option in cache:
+        option = list(option)
+        if isinstance(option[-1], dict):
+            option[-1] = tuple(option[-1]["range"])
+        options.append(option)
+    return Options(options)
+
+
 def within_tolerance(option, current_value, new_value, tolerance=0):
     "helper function, returning whether new_value is within the tolerance of current_value"
     if isinstance(option.constraint, tuple):
@@ -152,13 +152,8 @@ class SessionMixins:
             ["xdg", "stdout", r"xdg-email\s([^\n]+)", ["xdg-email", "--version"]],
             ["djvu", "stderr", r"DjVuLibre-([\d.]+)", ["cjb2", "--version"]],
             ["libtiff", "both", r"LIBTIFF,\sVersion\s([\d.]+)", ["tiffcp", "-h"]],
-            # pdftops and pdfunite are both in poppler-utils, and so the version is
-            # the version is the same.
-            # Both are needed, though to update %dependencies
             ["pdftops", "stderr", r"pdftops\sversion\s([\d.]+)", ["pdftops", "-v"]],
-            ["pdfunite", "stderr", r"pdfunite\sversion\s([\d.]+)", ["pdfunite", "-v"]],
             ["pdf2ps", "stdout", r"([\d.]+)", ["gs", "--version"]],
-            ["qpdf", "stdout", r"([\d.]+)", ["qpdf", "--version"]],
         ]
 
         for name, stream, regex, cmd in dependency_rules:
@@ -199,6 +194,11 @@ class SessionMixins:
             self._scan_progress.disconnect(button_signal)
 
         self._scan_progress.hide()
+        self._prompt_reverse_sides(widget, process)
+
+    def _prompt_reverse_sides(self, widget, process):
+        """After scanning one side of double-sided pages, offer to scan the
+        other side"""
         if process == "scan_pages" and widget.sided == "double":
 
             def prompt_reverse_sides():
@@ -5,10 +5,10 @@ import os
 import subprocess
 import tempfile
 from unittest.mock import patch
-from PIL import Image
+from PIL import Image, ImageChops, ImageDraw, TiffImagePlugin
 import config
 from const import VERSION
-from page import Page, _prepare_scale
+from page import Page, _prepare_scale, classify_image, encode_for_storage
 from helpers import Proc
 from gi.repository import GdkPixbuf
 import pytest
@@ -143,14 +143,10 @@ def test_1(temp_pnm, temp_jpg):
         assert page.export_djvu_txt() is None, "export_djvu_txt() without bboxes"
         assert page.export_text() == "", "export_text() without bboxes"
         assert page.export_djvu_ann() is None, "export_djvu_ann() without bboxes"
+        assert page.djvused_layers() == "", "djvused_layers() without bboxes"
         page.text_layer = ""
-        assert (
-            page._add_txt_to_djvu("file.djvu", dirname) is None
-        ), "_add_txt_to_djvu() without bboxes"
         page.annotations = ""
-        assert (
-            page._add_ann_to_djvu("file.djvu", dirname) is None
-        ), "_add_ann_to_djvu() without bboxes"
+        assert page.djvused_layers() == "", "djvused_layers() with empty layers"
 
 
 def test_2(temp_pnm):
@@ -305,6 +301,10 @@ def test_2(temp_pnm):
             '{"type": "word", "depth": 1, "text": "()", "bbox": [157, -2798, 241, -2733]}]'
         ), "import_djvu_ann() basic functionality"
         assert page.export_djvu_ann() == ann, "export_djvu_ann()"
+        assert (
+            page.djvused_layers()
+            == f"set-txt\n{page.export_djvu_txt()}\n.\nset-ant\n{ann}\n.\n"
+        ), "djvused_layers()"
 
         #########################
 
@@ -343,18 +343,22 @@ def test_write_image_for_djvu():
         assert os.path.isfile(filename.name), "write_image_for_djvu() creates a file"
 
 
-def test_write_image_for_tiff():
-    "Test write_image_for_djvu()"
-    with (
-        tempfile.TemporaryDirectory() as dirname,
-        tempfile.NamedTemporaryFile(suffix=".tif") as filename,
-    ):
-        page = Page(image_object=Image.new("RGB", (210, 297)))
-        page.resolution = (300, 300, "PixelsPerInch")
-        page.write_image_for_tiff(
-            filename.name, {"dir": dirname, "options": {"compression": "jpeg"}}
-        )
-        assert os.path.isfile(filename.name), "write_image_for_tiff() creates a file"
+def test_tiff_frame():
+    "Test tiff_frame()"
+    page = Page(image_object=Image.new("RGBA", (210, 297), "white"))
+    page.resolution = (300, 150, "PixelsPerInch")
+    image, dpi = page.tiff_frame({"options": {"compression": "lzw"}})
+    assert (image.mode, dpi) == ("RGB", (300, 150)), "alpha removed"
+    image, dpi = page.tiff_frame({"options": {"compression": "g4"}})
+    assert image.mode == "1", "thresholded for group 4"
+    assert image.getpixel((0, 0)) == 255, "white stays white"
+
+    page = Page(image_object=Image.new("1", (210, 297)))
+    page.resolution = (300, 300, "PixelsPerInch")
+    image, _dpi = page.tiff_frame({"options": {"compression": "jpeg"}})
+    assert image.mode == "L", "8-bit for JPEG"
+    image, _dpi = page.tiff_frame({"options": {}})
+    assert image.mode == "1", "bilevel kept without compression"
 
 
 def test_write_image_for_djvu_error(mocker):
@@ -429,6 +433,16 @@ def test_to_stored_bytes_jpeg_file_passthrough(temp_jpg):
     assert page.to_stored_bytes() == original
 
 
+def test_image_bytes_passthrough():
+    "pages created from encoded bytes store them without re-encoding"
+    blob = encode_for_storage(Image.new("1", (210, 297), 0))
+    page = Page(image_bytes=blob, resolution=300)
+    assert page.image_object.size == (210, 297)
+    assert page.to_stored_bytes() is blob
+    with pytest.raises(ValueError):
+        Page(image_bytes=blob, image_object=page.image_object)
+
+
 def test_to_stored_bytes_png_file_passthrough(temp_png):
     "importing a PNG file stores the original bytes"
     Image.new("RGB", (210, 297)).save(temp_png.name, format="PNG")
@@ -456,10 +470,18 @@ def test_get_pixbuf_at_scale_downscales_before_save(mocker):
     assert saved_sizes == [(100, 100)], "image downscaled before save"
 
 
+def colour_image(size=(210, 297)):
+    "return an image with colour gradients"
+    gradient = Image.linear_gradient("L").resize(size)
+    return Image.merge(
+        "RGB", (gradient, gradient.transpose(Image.Transpose.ROTATE_180), gradient)
+    )
+
+
 def test_write_image_for_pdf_passthrough():
     "stored JPEG bytes are written to the PDF without re-encoding"
     buf = io.BytesIO()
-    Image.new("RGB", (210, 297)).save(buf, format="JPEG", quality=92)
+    colour_image().save(buf, format="JPEG", quality=92)
     stored = buf.getvalue()
     page = Page.from_bytes(stored)
     page.resolution = (72, 72, "PixelsPerInch")
@@ -469,6 +491,81 @@ def test_write_image_for_pdf_passthrough():
             assert fhd.read() == stored, "bytes passed through"
 
 
+def test_write_image_for_pdf_bilevel():
+    """bilevel images are written as CCITT G4, unless Flate is requested, in
+    which case stored bilevel PNG bytes are written without re-encoding"""
+    buf = io.BytesIO()
+    Image.new("1", (210, 297)).save(buf, format="PNG")
+    stored = buf.getvalue()
+    page = Page.from_bytes(stored)
+    page.resolution = (72, 72, "PixelsPerInch")
+    with tempfile.NamedTemporaryFile(suffix=".png") as filename:
+        assert page.write_image_for_pdf(filename.name, None), "embedded verbatim"
+        with Image.open(filename.name) as image:
+            assert image.format == "TIFF"
+            assert image.info["compression"] == "group4"
+            assert image.tag_v2[TiffImagePlugin.ROWSPERSTRIP] == 297, "single strip"
+    with tempfile.NamedTemporaryFile(suffix=".png") as filename:
+        options = {"options": {"compression": "png"}}
+        assert not page.write_image_for_pdf(filename.name, options)
+        with open(filename.name, "rb") as fhd:
+            assert fhd.read() == stored, "bytes passed through"
+
+
+def test_classify_image():
+    "Test telling colour, greyscale and black & white pages apart"
+    image = Image.new("RGB", (600, 600), "white")
+    draw = ImageDraw.Draw(image)
+    for y in range(50, 550, 25):
+        draw.line((50, y, 550, y), fill="black", width=3)
+    assert classify_image(image, (300, 300)) == "bilevel"
+    assert classify_image(image.convert("1"), (300, 300)) == "bilevel"
+    draw.rectangle((100, 100, 300, 300), fill=(128, 128, 128))
+    assert classify_image(image, (300, 300)) == "grey"
+    assert classify_image(image.convert("L"), (300, 300)) == "grey"
+
+    # the colour fringes of a scanner around text are not colour, but a stamp is
+    red, green, blue = image.split()
+    fringed = Image.merge("RGB", (ImageChops.offset(red, 1, 1), green, blue))
+    assert classify_image(fringed, (300, 300)) == "grey"
+    draw.ellipse((400, 400, 500, 500), outline=(200, 0, 0), width=8)
+    assert classify_image(image, (300, 300)) == "colour"
+
+
+def test_write_image_for_pdf_auto():
+    "automatic compression chooses the codec from the content of the page"
+    image = Image.new("RGB", (210, 297), "white")
+    ImageDraw.Draw(image).rectangle((20, 20, 190, 40), fill="black")
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=92)
+    page = Page.from_bytes(buf.getvalue())
+    page.resolution = (72, 72, "PixelsPerInch")
+    with tempfile.NamedTemporaryFile(suffix=".png") as filename:
+        assert page.write_image_for_pdf(filename.name, None), "embedded verbatim"
+        with Image.open(filename.name) as output:
+            assert output.info["compression"] == "group4", "black & white as G4"
+
+    image = Image.linear_gradient("L").resize((210, 297)).convert("RGB")
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=92)
+    page = Page.from_bytes(buf.getvalue())
+    page.resolution = (72, 72, "PixelsPerInch")
+    with tempfile.NamedTemporaryFile(suffix=".png") as filename:
+        options = {"options": {"compression": "auto", "quality": 50}}
+        assert page.write_image_for_pdf(filename.name, options)
+        with Image.open(filename.name) as output:
+            assert (output.format, output.mode) == ("JPEG", "L"), "grey as grey JPEG"
+
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    page = Page.from_bytes(buf.getvalue())
+    page.resolution = (72, 72, "PixelsPerInch")
+    with tempfile.NamedTemporaryFile(suffix=".png") as filename:
+        assert not page.write_image_for_pdf(filename.name, None)
+        with Image.open(filename.name) as output:
+            assert (output.format, output.mode) == ("PNG", "L"), "lossless grey"
+
+
 def test_write_image_for_pdf_reenocodes_with_options():
     "downsampling or compression forces a re-encode"
     buf = io.BytesIO()
@@ -489,7 +586,9 @@ def test_write_image_for_pdf_reenocodes_with_options():
         with open(filename.name, "rb") as fhd:
             output = fhd.read()
         assert output != stored, "compressed image re-encoded"
-        assert Image.open(io.BytesIO(output)).mode == "1", "thresholded to bilevel"
+        image = Image.open(io.BytesIO(output))
+        assert image.mode == "1", "thresholded to bilevel"
+        assert image.info["compression"] == "group4", "CCITT G4"
 
 
 def test_from_bytes_png_blob_readable():
@@ -1,5 +1,6 @@
 "test frontend/image_sane.py"
 
+import io
 import threading
 
 import pytest
@@ -601,6 +602,69 @@ def test_get_option_value_timeout():
     thread.join(timeout=1)
 
 
+def test_cached_option_values():
+    "get_option_value serves cached values without waiting for the worker"
+    thread = SaneThread()
+    thread.cached_option_values = {"mode": "Color"}
+    assert thread.get_option_value("mode") == "Color"
+    with pytest.raises(AttributeError):
+        thread.get_option_value("resolution")
+    with patch.object(thread, "send") as mock_send:
+        thread.set_option("mode", "Gray")
+    mock_send.assert_called_once()
+    assert thread.get_option_value("mode") == "Gray", "set_option updates cache"
+
+
+def test_get_option_values():
+    "do_get_option_values skips groups, buttons and inactive options"
+    thread = SaneThread()
+    thread.device_handle = MagicMock()
+    thread.device_handle.get_options.return_value = [
+        (0, "", "Number of options", "", enums.TYPE_INT, 0, 4, 4, None),
+        (1, "geometry", "Geometry", "", enums.TYPE_GROUP, 0, 0, 0, None),
+        (2, "mode", "Mode", "", enums.TYPE_STRING, 0, 1, 5, ["Gray", "Color"]),
+        (3, "calibrate", "Calibrate", "", enums.TYPE_BUTTON, 0, 0, 5, None),
+        (4, "tl-x", "Top-left x", "", enums.TYPE_FIXED, 3, 1, 37, (0, 200, 0)),
+    ]
+    thread.device_handle.mode = "Color"
+    assert thread.do_get_option_values(None) == {"mode": "Color"}
+
+
+def test_scan_page_encode():
+    "scan_page can return the frame already encoded in the storage format"
+    thread = SaneThread()
+    thread.device_handle = MagicMock()
+    thread.device_handle.get_parameters.return_value = ("gray", 1, (100, 10), 8, 30)
+    thread.device_handle.snap.return_value = PIL.Image.new("L", (100, 10))
+
+    image = thread.do_scan_page(SimpleNamespace(args=(False, False)))
+    assert isinstance(image, PIL.Image.Image), "raw frame by default"
+
+    blob = thread.do_scan_page(SimpleNamespace(args=(False, True)))
+    assert isinstance(blob, bytes), "encoded frame"
+    assert PIL.Image.open(io.BytesIO(blob)).format == "JPEG"
+
+
+def test_scan_page_compressed_frames():
+    "scan_page falls back to uncompressed frames, which python-sane can read"
+    thread = SaneThread()
+    thread.device_handle = MagicMock()
+    thread.device_handle.get_parameters.return_value = ("color", 1, (100, 10), 8, 30)
+    thread.device_handle.snap.return_value = PIL.Image.new("RGB", (100, 10))
+    thread.device_handle.opt = {
+        "compression": SimpleNamespace(constraint=["None", "JPEG"], cap=5)
+    }
+    thread.device_handle.compression = "JPEG"
+
+    thread.do_scan_page(SimpleNamespace(args=(False, True)))
+    assert thread.device_handle.compression == "None"
+
+    thread.device_handle.opt["compression"].cap = enums.CAP_INACTIVE
+    thread.device_handle.compression = "JPEG"
+    thread.do_scan_page(SimpleNamespace(args=(False, True)))
+    assert thread.device_handle.compression == "JPEG", "inactive option untouched"
+
+
 def _run_with_fake(fake, scan_kwargs):
     "open a fake device, run scan_pages with the given kwargs, then quit"
     thread = SaneThread()
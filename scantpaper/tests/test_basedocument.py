@@ -37,6 +37,10 @@ def mock_thread(mocker):
     mock_inst.lock = threading.Lock()
     mock_inst._dir = "/tmp"
     mock_inst._con = MagicMock()
+    mock_inst.exporter.requests = queue.Queue()
+    mock_inst.exporter.responses = queue.Queue()
+    mock_inst.exporter.running_pids = {}
+    mock_inst.exporter.lock = threading.Lock()
 
     # Mock DocThread.send to avoid blocking on queues
     def mock_send(_process, *args, **kwargs):
@@ -99,6 +103,17 @@ def test_cancel(mock_thread):
         assert "dummy.pid" not in slist.thread.running_pids
 
 
+def test_cancel_exporter(mock_thread):
+    "Test that cancel also cancels the export thread"
+    mock_thread.exporter.requests.put("save_pdf")
+    slist = Document()
+    slist.cancel(MagicMock())
+
+    assert slist.thread.exporter.cancel is True
+    assert slist.thread.exporter.requests.empty()
+    mock_thread.exporter.send.assert_called_once_with("cancel")
+
+
 def test_add_page_extra():
     "Test add_page with replace and insert-after"
     slist = Document()
@@ -512,6 +527,7 @@ def test_set_paper_sizes(mock_thread):
 
     assert slist.paper_sizes == sizes
     mock_thread.send.assert_called_with("set_paper_sizes", sizes)
+    mock_thread.exporter.send.assert_called_with("set_paper_sizes", sizes)
 
 
 def test_paste_selection_default_dest(mock_thread):
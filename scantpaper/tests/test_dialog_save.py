@@ -180,6 +180,12 @@ def test_pdf_compression_changed_callback():
     dialog._pdf_compression_changed_callback(mock_combo, mock_hboxq)
     mock_hboxq.hide.assert_called()
 
+    # Set to MRC (should show quality for the background)
+    mock_hboxq.reset_mock()
+    mock_combo.get_active_index.return_value = "mrc"
+    dialog._pdf_compression_changed_callback(mock_combo, mock_hboxq)
+    mock_hboxq.show.assert_called()
+
 
 def test_encrypt_clicked_callback(mocker):
     "Test encryption dialog creation and callbacks"
@@ -498,3 +504,29 @@ def test_meta_datetime_when_initial_is_none():
 
     dialog.include_time = False
     assert dialog.meta_datetime == dt.date(2026, 5, 8)
+
+
+def test_estimated_size(mocker):
+    "Test that the estimated size is requested and shown once options settle"
+    # run the debounced callback immediately
+    mocker.patch(
+        "dialog.save.GLib.timeout_add", side_effect=lambda _ms, cb: cb() or None
+    )
+    dialog = Save(image_types=["pdf", "tif"], image_type="pdf")
+    dialog.add_image_type()
+    callback = MagicMock()
+    dialog.connect("changed-save-options", callback)
+
+    dialog.pdf_compression = "g4"
+    serial = callback.call_args[0][1]
+    dialog.set_estimated_size(serial, 2 * 1024 * 1024)
+    assert dialog._estimate_label.get_visible()
+    assert dialog._estimate_label.get_text() == "Estimated size: 2.1 MB"
+
+    # a late estimate for previous options is ignored
+    dialog.image_type = "tif"
+    dialog.set_estimated_size(serial, 1)
+    assert dialog._estimate_label.get_text() == "Estimating size..."
+
+    dialog.set_estimated_size(callback.call_args[0][1], None)
+    assert not dialog._estimate_label.get_visible()
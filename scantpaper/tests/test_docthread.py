@@ -1,5 +1,6 @@
 "Tests for DocThread"
 
+import queue
 import sqlite3
 import subprocess
 import threading
@@ -1305,3 +1306,133 @@ def test_do_rotate_not_90(mocker):
     assert page.width == 100
     assert page.height == 200
     mock_replace.assert_called_once()
+
+
+def test_export_routed_to_exporter(mocker):
+    "Test that exports are sent to the export thread with the current action_id"
+    thread = DocThread(db=":memory:")
+    send = mocker.patch.object(thread, "send")
+    exporter_send = mocker.patch.object(thread.exporter, "send")
+    finished_callback = mocker.Mock()
+
+    thread.save_pdf(
+        path="test.pdf", list_of_pages=[1], finished_callback=finished_callback
+    )
+
+    assert send.call_args.args == ("get_export_snapshot",)
+    exporter_send.assert_not_called()
+    response = mocker.Mock()
+    snapshot = mocker.Mock()
+    response.info = (3, snapshot)
+    send.call_args.kwargs["finished_callback"](response)
+    exporter_send.assert_called_once_with(
+        "save_pdf",
+        {"path": "test.pdf", "list_of_pages": [1]},
+        3,
+        snapshot,
+        finished_callback=finished_callback,
+    )
+
+
+def test_export_reads_snapshot(temp_db):
+    "Test that an export sees the document as it was when it started"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    _, _, page_id = thread.add_page(Page(image_object=Image.new("RGB", (10, 10))))
+
+    opened, deleted = threading.Event(), threading.Event()
+
+    def handler(_request):
+        opened.set()
+        deleted.wait(5)
+        return thread.exporter.get_page(id=page_id)
+
+    request = Request(
+        "save_image", ({}, *thread.do_get_export_snapshot(None)), queue.Queue()
+    )
+    worker = threading.Thread(
+        target=thread.exporter.handler_wrapper, args=(request, handler)
+    )
+    worker.start()
+    opened.wait(5)
+    thread._execute("DELETE FROM page_order")
+    thread._con[threading.get_native_id()].commit()
+    deleted.set()
+    worker.join(5)
+
+    response = request.return_queue.get(False)
+    assert response.status is None
+    assert response.info.id == page_id
+    with pytest.raises(ValueError):
+        thread.get_page(id=page_id)
+
+
+def test_export_queued_undo_edit(temp_db):
+    """Test that an export sees the document as it was when it was requested,
+    even if the action is undone and the action_id reused by an edit before the
+    export thread reaches it"""
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    _, _, page_id = thread.add_page(Page(image_object=Image.new("RGB", (10, 10))))
+    thread.replace_page(Page(image_object=Image.new("RGB", (20, 20))), page_id)
+    action_id, snapshot = thread.do_get_export_snapshot(None)
+
+    # whilst the export is queued, the edit is undone and replaced by another
+    thread.do_undo(None)
+    thread.replace_page(Page(image_object=Image.new("RGB", (30, 30))), page_id)
+    thread._con[threading.get_native_id()].commit()
+    assert thread._action_id == action_id
+
+    request = Request("save_image", ({}, action_id, snapshot), queue.Queue())
+    thread.exporter.handler_wrapper(
+        request, lambda _request: thread.exporter.get_page(id=page_id)
+    )
+    response = request.return_queue.get(False)
+    assert response.status is None
+    assert response.info.image_object.size == (20, 20)
+
+
+def test_export_edit_before_finished(temp_db, mocker, tmp_path):
+    """Test that a page edited between requesting an export and its finished
+    callback is not marked as saved"""
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    _, _, page_id = thread.add_page(Page(image_object=Image.new("RGB", (10, 10))))
+    action_id, snapshot = thread.do_get_export_snapshot(None)
+
+    put = mocker.patch.object(thread.requests, "put")
+    options = {"path": str(tmp_path / "out.txt"), "list_of_pages": [page_id]}
+    request = Request("save_text", (options, action_id, snapshot), queue.Queue())
+    thread.exporter.handler_wrapper(request, thread.exporter.do_save_text)
+    response = request.return_queue.get(False)
+    assert response.status is None
+
+    # the page is edited before the DocThread marks the exported pages as saved
+    thread.replace_page(Page(image_object=Image.new("RGB", (20, 20))), page_id)
+    for call in put.call_args_list:
+        thread.do_set_saved(call.args[0])
+    assert not thread.pages_saved()
+    thread._action_id = action_id
+    assert thread.pages_saved()
+
+
+def test_export_set_saved(temp_db, mocker):
+    "Test that only the exported versions of pages are marked as saved"
+    thread = DocThread(db=temp_db.name)
+    thread._write_tid = threading.get_native_id()
+    _, _, page_id = thread.add_page(Page(image_object=Image.new("RGB", (10, 10))))
+    exported_action_id = thread._action_id
+
+    put = mocker.patch.object(thread.requests, "put")
+    thread.exporter._action_id = exported_action_id
+    thread.exporter.do_set_saved(Request("set_saved", ([page_id], True), None))
+    request = put.call_args.args[0]
+    assert request.args == ([page_id], True, exported_action_id)
+
+    # the page is edited before the DocThread marks it as saved
+    thread._take_snapshot()
+    thread.replace_page(Page(image_object=Image.new("RGB", (10, 10))), page_id)
+    thread.do_set_saved(request)
+    assert not thread.pages_saved()
+    thread._action_id = exported_action_id
+    assert thread.pages_saved()
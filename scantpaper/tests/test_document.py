@@ -211,6 +211,71 @@ def test_import_scan():
         mock_pps.assert_called()
 
 
+def test_import_file_post_process():
+    """test that import_file runs the post-processing chain on each imported
+    page, and only calls finished_callback once every chain has finished"""
+    doc = create_doc()
+    finished_callback = unittest.mock.Mock()
+    error_callback = unittest.mock.Mock()
+    with unittest.mock.patch.object(doc, "_post_process_scan") as mock_pps:
+        doc.import_file(
+            info={},
+            first_page=1,
+            last_page=2,
+            post_process={"rotate": 90, "ocr": False},
+            finished_callback=finished_callback,
+            error_callback=error_callback,
+        )
+        kwargs = doc.thread.import_file.call_args[1]
+        assert "post_process" not in kwargs
+        for uuid in ["uuid1", "uuid2"]:
+            kwargs["data_callback"](MockResponse({"type": "page", "row": [0, 0, uuid]}))
+        assert [call.args[0] for call in mock_pps.call_args_list] == [
+            "uuid1",
+            "uuid2",
+        ]
+        assert mock_pps.call_args[0][1]["rotate"] == 90
+
+    kwargs["finished_callback"]("response")
+    finished_callback.assert_not_called()
+
+    mock_pps.call_args_list[0][0][1]["finished_callback"](None)
+    # a chain that fails counts as finished, but only once
+    mock_pps.call_args_list[1][0][1]["error_callback"]("error")
+    mock_pps.call_args_list[1][0][1]["error_callback"]("error")
+    error_callback.assert_called_with("error")
+    finished_callback.assert_called_once_with("response")
+
+
+def test_import_file_added_page_callback():
+    "test that import_file reports the id of each page it adds"
+    doc = create_doc()
+    added_page_callback = unittest.mock.Mock()
+    doc.import_file(
+        info={}, first_page=1, last_page=1, added_page_callback=added_page_callback
+    )
+    kwargs = doc.thread.import_file.call_args[1]
+    assert "added_page_callback" not in kwargs
+    kwargs["data_callback"](MockResponse({"type": "page", "row": [0, 0, "uuid1"]}))
+    kwargs["data_callback"](MockResponse("message"))
+    added_page_callback.assert_called_once_with("uuid1")
+
+
+def test_import_file_post_process_no_pages():
+    "test that import_file finishes if no pages were imported to post-process"
+    doc = create_doc()
+    finished_callback = unittest.mock.Mock()
+    doc.import_file(
+        info={},
+        first_page=1,
+        last_page=1,
+        post_process={"ocr": True},
+        finished_callback=finished_callback,
+    )
+    doc.thread.import_file.call_args[1]["finished_callback"]("response")
+    finished_callback.assert_called_once_with("response")
+
+
 def test_split_page():
     "test split_page"
     doc = create_doc()
@@ -25,6 +25,7 @@ def mock_edit_window(mocker):
         _windowp = None
         _windowr = None
         _windows = None
+        _extra_scan_windows = []
         _windowi = None
         _pref_udt_cmbx = None
         _scan_udt_cmbx = None
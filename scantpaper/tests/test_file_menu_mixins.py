@@ -1,5 +1,6 @@
 "test file_menu_mixins"
 
+import collections
 import datetime
 import os
 import unittest.mock
@@ -13,6 +14,7 @@ from file_menu_mixins import (
     file_exists,
     launch_default_for_file,
 )
+from importthread import IMPORT_WARNING
 
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk  # pylint: disable=wrong-import-position
@@ -113,6 +115,7 @@ class MockApp(unittest.mock.Mock, FileMenuMixins):
         self.t_canvas = MockCanvas()
         self.a_canvas = MockCanvas()
         self._windows = MockWindows()
+        self._extra_scan_windows = []
         self.session = unittest.mock.Mock()
         self.post_process_progress = unittest.mock.Mock()
         self._dependencies = {}
@@ -231,6 +234,7 @@ class TestFileMenuMixins:
             "quality": 80,
             "set_timestamp": True,
             "convert whitespace to underscores": True,
+            "pdfa": False,
             "current_psh": "tool",
             "tiff compression": "jpeg",
             "default filename": "default",
@@ -251,12 +255,10 @@ class TestFileMenuMixins:
             "user_defined_tools": ["tool"],
         }
         app._dependencies = {
-            "pdfunite": True,
             "djvu": True,
             "libtiff": True,
             "pdf2ps": True,
             "pdftops": True,
-            "qpdf": True,
         }
         app.session = unittest.mock.Mock()
         app.session.name = str(tmp_path)
@@ -611,6 +613,102 @@ class TestFileMenuMixins:
             db="/some/path", delete=False, error_callback=app._error_callback
         )
 
+    def test_watch_folder_stop(self, app):
+        "Test that activating the watch-folder action again stops watching."
+        hot_folder = unittest.mock.Mock()
+        app._hot_folder = hot_folder
+        action = unittest.mock.Mock()
+
+        app.watch_folder(action, None)
+
+        hot_folder.stop.assert_called_once()
+        assert app._hot_folder is None
+        assert not action.set_state.call_args[0][0].get_boolean()
+
+    @unittest.mock.patch("file_menu_mixins.HotFolder")
+    def test_watch_folder_start(self, mock_hot_folder, app):
+        "Test that the folder chosen in the dialog is watched."
+        app._hot_folder = None
+        app._watch_folder_dialog = unittest.mock.Mock(return_value=True)
+        app.settings["hot folder"] = "/in"
+        action = unittest.mock.Mock()
+
+        app.watch_folder(action, None)
+
+        mock_hot_folder.assert_called_once_with("/in", app._hot_folder_files_callback)
+        mock_hot_folder.return_value.start.assert_called_once()
+        assert action.set_state.call_args[0][0].get_boolean()
+
+    def test_hot_folder_files_imported_concurrently(self, app):
+        "Test that new files are all imported at once if they are not saved."
+        app.slist.import_files = unittest.mock.Mock()
+        app._post_processing_options = unittest.mock.Mock(return_value={"ocr": 1})
+        app.settings["hot folder save dir"] = None
+        app.settings["hot folder post-processing"] = True
+        app._hot_folder = unittest.mock.Mock()
+
+        app._hot_folder_files_callback(["/in/a.pdf", "/in/b.jpg"])
+
+        assert [call[1]["paths"] for call in app.slist.import_files.call_args_list] == [
+            ["/in/a.pdf"],
+            ["/in/b.jpg"],
+        ]
+        kwargs = app.slist.import_files.call_args[1]
+        assert kwargs["post_process"] == {"ocr": 1}
+        assert kwargs["pagerange_callback"]({"pages": 3}) == (1, 3)
+
+        kwargs["finished_callback"](None)
+        app._hot_folder.archive.assert_called_once_with("/in/b.jpg", False)
+
+    @unittest.mock.patch("file_menu_mixins.os.path.exists", return_value=False)
+    def test_hot_folder_files_saved_one_at_a_time(self, _mock_exists, app):
+        "Test that each new file is saved as a PDF before the next is imported."
+        app.slist.import_files = unittest.mock.Mock()
+        app.slist.save_pdf = unittest.mock.Mock()
+        app.settings["hot folder save dir"] = "/out"
+        app.settings["hot folder post-processing"] = False
+        app._hot_folder = unittest.mock.Mock()
+        app._hot_folder_queue = collections.deque()
+        app._hot_folder_busy = False
+
+        app._hot_folder_files_callback(["/in/a.pdf", "/in/b.jpg"])
+
+        app.slist.import_files.assert_called_once()
+        kwargs = app.slist.import_files.call_args[1]
+        assert kwargs["paths"] == ["/in/a.pdf"]
+        assert "post_process" not in kwargs
+
+        # the pages of the file are the ones added by its import, not those
+        # scanned in the meantime
+        app.slist.data.append([4, None, "uuid4"])
+        kwargs["added_page_callback"]("uuid4")
+        app.slist.data.append([5, None, "uuid5"])
+
+        # warnings do not stop the import
+        warning = unittest.mock.Mock()
+        warning.info = IMPORT_WARNING
+        warning.request.process = "import_file"
+        kwargs["error_callback"](warning)
+        app.slist.save_pdf.assert_not_called()
+        app._hot_folder.archive.assert_not_called()
+
+        kwargs["finished_callback"](None)
+        save_kwargs = app.slist.save_pdf.call_args[1]
+        assert save_kwargs["path"] == "/out/a.pdf"
+        assert save_kwargs["list_of_pages"] == ["uuid4"]
+        app.slist.import_files.assert_called_once()
+
+        save_kwargs["finished_callback"](None)
+        app._hot_folder.archive.assert_called_once_with("/in/a.pdf", False)
+        assert app.slist.import_files.call_args[1]["paths"] == ["/in/b.jpg"]
+
+        # a failed import is archived as failed, and the queue moves on
+        response = unittest.mock.Mock()
+        response.request.process = "import_file"
+        app.slist.import_files.call_args[1]["error_callback"](response)
+        app._hot_folder.archive.assert_called_with("/in/b.jpg", True)
+        assert not app._hot_folder_busy
+
     @unittest.mock.patch("file_menu_mixins.datetime")
     @unittest.mock.patch("file_menu_mixins.SaveDialog")
     def test_save_dialog(self, mock_save_dialog, mock_datetime, app):
@@ -953,6 +1051,7 @@ class TestFileMenuMixins:
                 "user-password": "password",
                 "set_timestamp": True,
                 "convert whitespace to underscores": True,
+                "pdfa": False,
                 "post_save_hook": "tool",
             },
             queued_callback=app.post_process_progress.queued,
@@ -981,7 +1080,7 @@ class TestFileMenuMixins:
 
     @unittest.mock.patch("file_menu_mixins.launch_default_for_file")
     def test_save_pdf_finished_callback(self, mock_launch, app):
-        "Test finished callback for _save_pdf launches file and sets saved."
+        "Test finished callback for _save_pdf launches file."
         response = unittest.mock.Mock()
         app.slist.thread.send = unittest.mock.Mock()
         app._windowi = unittest.mock.Mock()
@@ -993,7 +1092,8 @@ class TestFileMenuMixins:
         app._save_pdf("file.pdf", ["uuid1"], "pdf")
 
         app.post_process_progress.finish.assert_called_with(response)
-        app.slist.thread.send.assert_called_with("set_saved", ["uuid1"])
+        # the exporter marks the pages it saved, pinned to its snapshot
+        app.slist.thread.send.assert_not_called()
         mock_launch.assert_called_with("file.pdf")
 
     @unittest.mock.patch("file_menu_mixins.launch_default_for_file")
@@ -1010,12 +1110,13 @@ class TestFileMenuMixins:
         app._save_pdf("file.ps", ["uuid1"], "ps")
 
         app.post_process_progress.finish.assert_called_with(response)
-        app.slist.thread.send.assert_called_with("set_saved", ["uuid1"])
+        # the exporter marks the pages it saved, pinned to its snapshot
+        app.slist.thread.send.assert_not_called()
         mock_launch.assert_called_with("file.ps")
 
     @unittest.mock.patch("file_menu_mixins.launch_default_for_file")
     def test_save_djvu_finished_callback(self, mock_launch, app):
-        "Test finished callback for _save_djvu launches file and sets saved."
+        "Test finished callback for _save_djvu launches file."
         response = unittest.mock.Mock()
         response.request.args = [{"path": "file.djvu"}]
         app.slist.thread.send = unittest.mock.Mock()
@@ -1028,7 +1129,8 @@ class TestFileMenuMixins:
         app._save_djvu("file.djvu", ["uuid1"])
 
         app.post_process_progress.finish.assert_called_with(response)
-        app.slist.thread.send.assert_called_with("set_saved", ["uuid1"])
+        # the exporter marks the pages it saved, pinned to its snapshot
+        app.slist.thread.send.assert_not_called()
         mock_launch.assert_called_with("file.djvu")
 
     @unittest.mock.patch("file_menu_mixins.Gtk")
@@ -1304,7 +1406,8 @@ class TestFileMenuMixins:
         app._save_tif("file.tif", ["uuid1"])
 
         app.post_process_progress.finish.assert_called_with(response)
-        app.slist.thread.send.assert_called_with("set_saved", ["uuid1"])
+        # the exporter marks the pages it saved, pinned to its snapshot
+        app.slist.thread.send.assert_not_called()
         mock_launch.assert_called_with("file.tif")
 
     @unittest.mock.patch("file_menu_mixins.launch_default_for_file")
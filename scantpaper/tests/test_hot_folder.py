@@ -0,0 +1,90 @@
+"Tests for HotFolder"
+
+import os
+import unittest.mock
+
+from hot_folder import HotFolder
+
+
+def test_queue_filters(tmp_path):
+    "Test that only importable files directly in the folder are queued"
+    hot_folder = HotFolder(str(tmp_path), unittest.mock.Mock())
+    for name in ["a.pdf", "b.TIF", "c.txt", ".d.pdf"]:
+        hot_folder._queue(str(tmp_path / name))
+    hot_folder._queue(str(tmp_path / "imported" / "e.pdf"))
+    hot_folder._queue(None)
+    assert sorted(hot_folder._pending) == [
+        str(tmp_path / "a.pdf"),
+        str(tmp_path / "b.TIF"),
+    ]
+
+
+def test_check_pending_waits_for_complete_files(tmp_path):
+    "Test that files are only passed on once their size has settled"
+    callback = unittest.mock.Mock()
+    hot_folder = HotFolder(str(tmp_path), callback, settle_time=0)
+    (tmp_path / "b.png").write_bytes(b"png")
+    (tmp_path / "a.pdf").write_bytes(b"pdf")
+    (tmp_path / "empty.jpg").write_bytes(b"")
+    hot_folder._rescan()
+
+    # the first check records the sizes
+    hot_folder._check_pending()
+    callback.assert_not_called()
+
+    # a file that has grown in the meantime is held back
+    with open(tmp_path / "b.png", "ab") as fhd:
+        fhd.write(b" more")
+    hot_folder._check_pending()
+    callback.assert_called_once_with([str(tmp_path / "a.pdf")])
+
+    callback.reset_mock()
+    hot_folder._check_pending()
+    callback.assert_called_once_with([str(tmp_path / "b.png")])
+
+    # files are only passed on once, and empty files not at all
+    callback.reset_mock()
+    hot_folder._rescan()
+    hot_folder._check_pending()
+    hot_folder._check_pending()
+    callback.assert_not_called()
+    assert list(hot_folder._pending) == [str(tmp_path / "empty.jpg")]
+
+
+def test_check_pending_settle_time(tmp_path):
+    "Test that recently modified files are held back"
+    callback = unittest.mock.Mock()
+    hot_folder = HotFolder(str(tmp_path), callback, settle_time=3600)
+    (tmp_path / "a.pdf").write_bytes(b"pdf")
+    hot_folder._rescan()
+    hot_folder._check_pending()
+    hot_folder._check_pending()
+    callback.assert_not_called()
+
+
+def test_check_pending_deleted_file(tmp_path):
+    "Test that files deleted before they were passed on are forgotten"
+    callback = unittest.mock.Mock()
+    hot_folder = HotFolder(str(tmp_path), callback, settle_time=0)
+    hot_folder._queue(str(tmp_path / "a.pdf"))
+    hot_folder._check_pending()
+    assert not hot_folder._pending
+    callback.assert_not_called()
+
+
+def test_archive(tmp_path):
+    "Test that processed files are moved to the imported and failed subfolders"
+    hot_folder = HotFolder(str(tmp_path), unittest.mock.Mock())
+    for name in ["a.pdf", "b.pdf"]:
+        (tmp_path / name).write_bytes(b"pdf")
+    (tmp_path / "imported").mkdir()
+    (tmp_path / "imported" / "a.pdf").write_bytes(b"old")
+
+    assert hot_folder.archive(str(tmp_path / "a.pdf")) == str(
+        tmp_path / "imported" / "a-1.pdf"
+    )
+    assert hot_folder.archive(str(tmp_path / "b.pdf"), failed=True) == str(
+        tmp_path / "failed" / "b.pdf"
+    )
+    assert sorted(os.listdir(tmp_path)) == ["failed", "imported"]
+    assert hot_folder.archive(str(tmp_path / "c.pdf")) is None
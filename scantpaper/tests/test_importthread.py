@@ -1,15 +1,24 @@
 "Tests for Importhread"
 
+import io
+import pathlib
+import sqlite3
 import subprocess
+import time
 import unittest.mock
 from types import SimpleNamespace
 import pytest
-from PIL import Image
+from PIL import Image, TiffImagePlugin
+import img2pdf
+import pikepdf
 from importthread import (
+    IMPORT_WARNING,
+    CancelledError,
     Importhread,
     _composite_over_white,
     _correlate_pdf_images,
     _parse_pdfimages_list,
+    _sniff_format,
 )
 from helpers import Proc
 
@@ -79,7 +88,7 @@ def test_parse_pdfimages_list_inline():
     ]
 
 
-def test_composite_over_white_opaque_and_transparent(tmp_path):
+def test_composite_over_white_opaque_and_transparent():
     "Test that compositing over white keeps opaque pixels and makes transparent ones white"
     image = Image.new("L", (2, 1))
     image.putpixel((0, 0), 200)
@@ -87,100 +96,87 @@ def test_composite_over_white_opaque_and_transparent(tmp_path):
     mask = Image.new("L", (2, 1))
     mask.putpixel((0, 0), 255)
     mask.putpixel((1, 0), 0)
-    image_path = tmp_path / "img.pgm"
-    mask_path = tmp_path / "mask.pgm"
-    image.save(image_path)
-    mask.save(mask_path)
 
-    assert _composite_over_white(image_path, mask_path) is True
+    result = _composite_over_white(image, mask)
 
-    result = Image.open(image_path)
+    assert result.mode == "L", "gray image stays gray"
     assert result.getpixel((0, 0)) == 200, "opaque mask keeps the image value"
     assert result.getpixel((1, 0)) == 255, "transparent mask becomes white"
 
 
-def test_composite_over_white_half_alpha(tmp_path):
+def test_composite_over_white_half_alpha():
     "Test that a 50% mask blends image and white to the midpoint"
-    image_path = tmp_path / "img.pgm"
-    mask_path = tmp_path / "mask.pgm"
-    Image.new("L", (1, 1), 200).save(image_path)
-    Image.new("L", (1, 1), 128).save(mask_path)
-
-    assert _composite_over_white(image_path, mask_path) is True
-
-    result = Image.open(image_path)
+    result = _composite_over_white(
+        Image.new("L", (1, 1), 200), Image.new("L", (1, 1), 128)
+    )
     assert result.getpixel((0, 0)) == 227  # (200*128 + 255*127) // 255
 
 
-def test_composite_over_white_color(tmp_path):
+def test_composite_over_white_color():
     "Test that a color image is composited per channel"
-    image_path = tmp_path / "img.ppm"
-    mask_path = tmp_path / "mask.pgm"
-    Image.new("RGB", (1, 1), (10, 20, 30)).save(image_path)
-    Image.new("L", (1, 1), 128).save(mask_path)
-
-    assert _composite_over_white(image_path, mask_path) is True
-
-    result = Image.open(image_path)
+    result = _composite_over_white(
+        Image.new("RGB", (1, 1), (10, 20, 30)), Image.new("L", (1, 1), 128)
+    )
     assert result.getpixel((0, 0)) == (132, 137, 142)
 
 
-def test_composite_over_white_size_mismatch(tmp_path):
-    "Test that a size mismatch returns False and leaves the files untouched"
-    image_path = tmp_path / "img.pgm"
-    mask_path = tmp_path / "mask.pgm"
-    Image.new("L", (2, 2), 200).save(image_path)
-    Image.new("L", (3, 3), 128).save(mask_path)
-    before_image = image_path.read_bytes()
-    before_mask = mask_path.read_bytes()
-
-    assert _composite_over_white(image_path, mask_path) is False
-    assert image_path.read_bytes() == before_image, "image file untouched"
-    assert mask_path.read_bytes() == before_mask, "mask file untouched"
+def test_composite_over_white_size_mismatch():
+    "Test that a size mismatch returns None"
+    assert (
+        _composite_over_white(Image.new("L", (2, 2), 200), Image.new("L", (3, 3), 128))
+        is None
+    )
 
 
-def test_correlate_pdf_images_pairs_smask(mocker):
+def test_correlate_pdf_images_pairs_smask():
     "Test that an image entry is paired with the smask that follows it"
-    mocker.patch("importthread.glob.glob", return_value=["x-000.pnm", "x-001.pnm"])
-    remove = mocker.patch("importthread.os.remove")
     entries = [
         {"page": 1, "num": 0, "type": "image", "x_ppi": 300.0, "y_ppi": 300.0},
         {"page": 1, "num": 1, "type": "smask", "x_ppi": 300.0, "y_ppi": 300.0},
     ]
-
-    result, warning = _correlate_pdf_images(entries)
-
-    assert warning is False
+    result = _correlate_pdf_images(["x-000.pnm", "x-001.pnm"], entries)
     assert result == [("x-000.pnm", 300.0, 300.0, "x-001.pnm")]
-    remove.assert_not_called(), "paired mask is not removed by the correlator"
 
 
-def test_correlate_pdf_images_removes_unpaired_smask(mocker):
-    "Test that an smask without a preceding image is removed"
-    mocker.patch("importthread.glob.glob", return_value=["x-000.pnm", "x-001.pnm"])
-    remove = mocker.patch("importthread.os.remove")
+def test_correlate_pdf_images_ignores_unpaired_smask():
+    "Test that an smask without a preceding image is ignored"
     entries = [
         {"page": 1, "num": 0, "type": "smask", "x_ppi": 300.0, "y_ppi": 300.0},
         {"page": 1, "num": 1, "type": "image", "x_ppi": 300.0, "y_ppi": 300.0},
     ]
+    result = _correlate_pdf_images(["x-000.pnm", "x-001.pnm"], entries)
+    assert result == [("x-001.pnm", 300.0, 300.0, None)]
 
-    result, warning = _correlate_pdf_images(entries)
 
-    assert warning is False
-    assert result == [("x-001.pnm", 300.0, 300.0, None)]
-    remove.assert_any_call("x-000.pnm")
+def test_correlate_pdf_images_count_mismatch():
+    "Test that a count mismatch returns every file with the first resolution"
+    entries = [
+        {"page": 1, "num": 0, "type": "image", "x_ppi": 150.0, "y_ppi": 150.0},
+    ]
+    result = _correlate_pdf_images(["x-000.pnm", "x-001.pnm"], entries)
+    assert result == [
+        ("x-000.pnm", 150.0, 150.0, None),
+        ("x-001.pnm", 150.0, 150.0, None),
+    ]
 
 
-def test_get_file_info_session(mocker, temp_db):
-    "Test that a SQLite database is identified as a session file"
+def test_sniff_format():
+    "Test that the formats needing specific readers are identified from their magic"
+    assert _sniff_format(b"SQLite format 3\x00\x10\x00") == "session file"
+    assert _sniff_format(b"AT&TFORM\x00\x00\x01\x00DJVMDIRM") == "DJVU"
+    assert _sniff_format(b"AT&TFORM\x00\x00\x01\x00DJVUINFO") == "DJVU"
+    assert _sniff_format(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3") == "Portable Document Format"
+    assert _sniff_format(b"II*\x00\x08\x00\x00\x00") == "Tagged Image File Format"
+    assert _sniff_format(b"MM\x00*\x00\x00\x00\x08") == "Tagged Image File Format"
+    assert _sniff_format(b"\x89PNG\r\n\x1a\n") is None
+    assert _sniff_format(b"AT&TFORM\x00\x00\x01\x00AIFF") is None
 
-    # Mock exec_command to return SQLite signature
-    mock_exec = mocker.patch("importthread.exec_command")
-    mock_exec.return_value = Proc(
-        returncode=0,
-        stdout="SQLite 3.x database, last consolidated Tue Sep 14 10:23:44 2021",
-        stderr="",
-    )
+
+def test_get_file_info_session(temp_db):
+    "Test that a SQLite database is identified as a session file"
+    with sqlite3.connect(temp_db.name) as con:
+        con.execute("CREATE TABLE page (id INTEGER)")
+    con.close()
 
     thread = Importhread()
 
@@ -202,15 +198,12 @@ def test_get_file_info_file_not_found():
         thread.do_get_file_info(request)
 
 
-def test_get_file_info_zero_length(mocker, tmp_path):
+def test_get_file_info_zero_length(tmp_path):
     "Test that a zero-length file raises a RuntimeError"
 
     empty_file = tmp_path / "empty.txt"
     empty_file.write_text("", encoding="utf-8")
 
-    mock_exec = mocker.patch("importthread.exec_command")
-    mock_exec.return_value = Proc(returncode=0, stdout="empty", stderr="")
-
     thread = Importhread()
 
     request = SimpleNamespace(args=(str(empty_file), None))
@@ -218,14 +211,64 @@ def test_get_file_info_zero_length(mocker, tmp_path):
         thread.do_get_file_info(request)
 
 
-def test_get_file_info_no_stdout(mocker):
-    "Test that a zero-length file raises a RuntimeError"
+def test_get_file_info_image(tmp_path):
+    "Test that other images are read with PIL without running any tools"
+    path = tmp_path / "file.png"
+    Image.new("RGB", (30, 20)).save(path)
+    thread = Importhread()
+    request = SimpleNamespace(args=(str(path), None))
+    with unittest.mock.patch("importthread.exec_command") as mock_exec:
+        info = thread.do_get_file_info(request)
+    mock_exec.assert_not_called()
+    assert info == {
+        "format": "PNG",
+        "width": [30],
+        "height": [20],
+        "pages": 1,
+        "path": str(path),
+    }
 
-    mock_exec = mocker.patch("importthread.exec_command")
-    mock_exec.return_value = Proc(returncode=-1, stdout=None, stderr="not found")
+
+def test_get_file_info_unknown(tmp_path):
+    "Test that a file that is neither a document nor an image raises an error"
+    path = tmp_path / "file.txt"
+    path.write_text("not an image", encoding="utf-8")
     thread = Importhread()
-    request = SimpleNamespace(args=("", None))
-    with pytest.raises(RuntimeError, match="Error getting file info for : not found"):
+    request = SimpleNamespace(args=(str(path), None))
+    with pytest.raises(OSError):
+        thread.do_get_file_info(request)
+
+
+def test_get_file_info_probed_ahead(tmp_path):
+    """Test that get_file_info() probes the file before its request reaches
+    the thread, and that the responses of the probe are sent on the request"""
+    path = _multipage_tiff(tmp_path / "file.tif")
+    thread = Importhread()
+    thread.send = unittest.mock.Mock()
+    thread.get_file_info(path, None, finished_callback="callback")
+
+    args, kwargs = thread.send.call_args
+    assert args[:3] == ("get_file_info", path, None)
+    assert kwargs == {"finished_callback": "callback"}
+    args[3][1].result()
+
+    request = unittest.mock.Mock(args=args[1:])
+    info = thread.do_get_file_info(request)
+    assert info["pages"] == 2
+    assert request.data.call_args_list == [
+        unittest.mock.call("Page 1 is 64x32", None),
+        unittest.mock.call("Page 2 is 40x50", None),
+    ]
+
+
+def test_get_file_info_probed_ahead_error(tmp_path):
+    "Test that an error probing a file ahead of its request is raised by it"
+    thread = Importhread()
+    thread.send = unittest.mock.Mock()
+    path = tmp_path / "missing.pdf"
+    thread.get_file_info(str(path), None)
+    request = SimpleNamespace(args=thread.send.call_args[0][1:])
+    with pytest.raises(FileNotFoundError):
         thread.do_get_file_info(request)
 
 
@@ -263,19 +306,101 @@ def test_get_djvu_info_no_djvused(mocker):
         )
 
 
-def test_get_tif_info_no_tiffinfo(mocker):
-    "Test that error is raised when tiffinfo is not found"
-    mock_exec = mocker.patch("importthread.exec_command")
-    mock_exec.return_value = Proc(
-        returncode=-1,
-        stdout=None,
-        stderr="not found",
+def _multipage_tiff(path):
+    "write a TIFF with a G4 bilevel frame followed by a gray frame"
+    bilevel = Image.new("1", (64, 32), 1)
+    bilevel.paste(0, (0, 0, 20, 10))
+    with TiffImagePlugin.AppendingTiffWriter(path, True) as tiff:
+        bilevel.save(tiff, format="TIFF", compression="group4", dpi=(300, 300))
+        tiff.newFrame()
+        Image.new("L", (40, 50), 128).save(tiff, format="TIFF")
+    return str(path)
+
+
+def test_get_tif_info(tmp_path):
+    "Test that the number and sizes of the pages are read without tiffinfo"
+    path = _multipage_tiff(tmp_path / "file.tif")
+    thread = Importhread()
+    mock_request = unittest.mock.Mock()
+    info = {}
+
+    thread._get_tif_info(info, path, mock_request)
+
+    assert info == {
+        "format": "Tagged Image File Format",
+        "pages": 2,
+        "width": [64, 40],
+        "height": [32, 50],
+    }
+    mock_request.data.assert_any_call("Page 2 is 40x50")
+
+
+def _tiff_import_request(path, first, last):
+    "return a mocked request to import pages of a multipage TIFF"
+    mock_request = unittest.mock.Mock()
+    mock_request.args = (
+        {
+            "first": first,
+            "last": last,
+            "dir": "/tmp",
+            "info": {
+                "path": path,
+                "format": "Tagged Image File Format",
+                "width": [64, 40],
+                "height": [32, 50],
+            },
+        },
+        None,
     )
+    return mock_request
+
+
+@unittest.mock.patch("subprocess.run")
+@unittest.mock.patch("importthread.Page")
+def test_import_multipage_tiff_in_process(mock_page, mock_run, tmp_path):
+    "Test that the frames of a TIFF are decoded without tiffcp"
+    path = _multipage_tiff(tmp_path / "file.tif")
     thread = Importhread()
-    with pytest.raises(
-        RuntimeError, match="Please install libtiff-tools in order to open TIFF files"
-    ):
-        thread._get_tif_info({}, None, None)
+    thread.add_page = unittest.mock.Mock()
+    mock_request = _tiff_import_request(path, 1, 2)
+
+    thread.do_import_file(mock_request)
+
+    mock_run.assert_not_called()
+    assert mock_page.call_count == 2
+    first, second = [
+        Image.open(io.BytesIO(call.kwargs["image_bytes"]))
+        for call in mock_page.call_args_list
+    ]
+    assert first.mode == "1" and first.format == "PNG", "G4 frame kept bilevel"
+    assert first.getpixel((0, 0)) == 0 and first.getpixel((30, 20)) == 255
+    assert mock_page.call_args_list[0].kwargs["resolution"] == (
+        300.0,
+        300.0,
+        "PixelsPerInch",
+    )
+    assert second.size == (40, 50)
+    assert mock_page.call_args_list[1].kwargs["width"] == 40
+
+
+@unittest.mock.patch("subprocess.run")
+@unittest.mock.patch("importthread._page_from_image")
+@unittest.mock.patch("importthread._page_from_file")
+def test_import_multipage_tiff_fallback(
+    mock_from_file, mock_from_image, mock_run, tmp_path
+):
+    "Test that frames that PIL cannot decode are split out with tiffcp"
+    path = _multipage_tiff(tmp_path / "file.tif")
+    mock_from_image.side_effect = OSError("cannot decode")
+    thread = Importhread()
+    thread.add_page = unittest.mock.Mock()
+    mock_request = _tiff_import_request(path, 2, 2)
+
+    thread.do_import_file(mock_request)
+
+    assert mock_run.call_args.args[0][:2] == ["tiffcp", f"{path},1"]
+    assert mock_from_file.call_count == 1
+    thread.add_page.assert_called_once_with(mock_from_file.return_value)
 
 
 def test_get_djvu_info_corrupt(mocker):
@@ -305,7 +430,7 @@ def test_get_djvu_info_corrupt(mocker):
 
 @unittest.mock.patch("subprocess.run")
 @unittest.mock.patch("subprocess.check_output")
-@unittest.mock.patch("importthread.Page")
+@unittest.mock.patch("importthread._page_from_file")
 def test_do_import_djvu_annotation_error(mock_page, mock_co, mock_run):
     "Test that error is raised when import_djvu_ann raises an error"
     mock_run.return_value = Proc(
@@ -313,11 +438,7 @@ def test_do_import_djvu_annotation_error(mock_page, mock_co, mock_run):
         stdout="",
         stderr="",
     )
-    mock_co.return_value = Proc(
-        returncode=0,
-        stdout="",
-        stderr="",
-    )
+    mock_co.return_value = "1\n1\n"
     # Configure the mock Page instance
     mock_page_instance = mock_page.return_value
     mock_page_instance.import_djvu_ann.side_effect = PermissionError(
@@ -334,6 +455,7 @@ def test_do_import_djvu_annotation_error(mock_page, mock_co, mock_run):
             "dir": "/tmp",
             "info": {
                 "path": "/to/file.djvu",
+                "pages": 1,
                 "ppi": [300],
                 "width": [100],
                 "height": [100],
@@ -347,19 +469,100 @@ def test_do_import_djvu_annotation_error(mock_page, mock_co, mock_run):
     mock_request.error.assert_called_once_with("Error: parsing DjVU annotation layer")
 
 
-@unittest.mock.patch("subprocess.run")
-def test_get_pdf_info_error(mock_run):
-    "Test that request.error is thrown when pdfinfo returns error"
-    mock_run.side_effect = subprocess.CalledProcessError(
-        returncode=1,
-        cmd=["pdfinfo", "-isodates", "path/to/file.pdf"],
-        output="",
-        stderr="Permission denied",
-    )
+def test_import_pages_in_order():
+    "Test that pages prepared in parallel are added in document order"
+    thread = Importhread()
+    thread.add_page = unittest.mock.Mock(side_effect=lambda page: page)
+    mock_request = unittest.mock.Mock()
+
+    def prepare(i):
+        # later pages finish first
+        time.sleep((10 - i) * 0.005)
+        return [f"page {i}"]
+
+    thread._import_pages(mock_request, range(1, 10), prepare)
+
+    assert [call.args[0] for call in thread.add_page.call_args_list] == [
+        f"page {i}" for i in range(1, 10)
+    ]
+    assert [call.args[0]["row"] for call in mock_request.data.call_args_list] == [
+        f"page {i}" for i in range(1, 10)
+    ]
+
+
+@unittest.mock.patch("importthread.os.cpu_count", return_value=2)
+def test_import_pages_cancelled(_mock_cpu_count):
+    "Test that cancelling stops adding pages and does not prepare the rest"
+    thread = Importhread()
+    thread.add_page = unittest.mock.Mock()
+    mock_request = unittest.mock.Mock()
+    prepared = []
+
+    def prepare(i):
+        prepared.append(i)
+        if i == 2:
+            thread.cancel = True
+        return [i]
+
+    with pytest.raises(CancelledError):
+        thread._import_pages(mock_request, range(1, 101), prepare)
+
+    assert thread.add_page.call_count < 2
+    assert len(prepared) < 100, "remaining pages not prepared"
+
+
+def test_get_pdf_info_error(tmp_path):
+    "Test that request.error is thrown when the PDF cannot be opened"
+    path = tmp_path / "file.pdf"
+    path.write_bytes(b"%PDF-1.4\nnot really a PDF")
     thread = Importhread()
     mock_request = unittest.mock.Mock()
-    thread._get_pdf_info({}, None, None, mock_request)
-    mock_request.error.assert_called_once_with("Permission denied")
+    info = {}
+    thread._get_pdf_info(info, str(path), None, mock_request)
+    mock_request.error.assert_called_once()
+    assert "pages" not in info
+
+
+def test_get_pdf_info(tmp_path):
+    "Test that the page count, size and metadata are read with pikepdf"
+    path = tmp_path / "file.pdf"
+    pdf = pikepdf.new()
+    pdf.add_blank_page(page_size=(200, 100))
+    pdf.add_blank_page(page_size=(300, 300))
+    pdf.pages[0].obj.Rotate = 90
+    pdf.docinfo["/Title"] = "The title"
+    pdf.docinfo["/Author"] = "The author"
+    pdf.docinfo["/Subject"] = ""
+    pdf.docinfo["/CreationDate"] = "D:20260102030405+01'00'"
+    pdf.save(path)
+    thread = Importhread()
+    info = {}
+    thread._get_pdf_info(info, str(path), None, unittest.mock.Mock())
+    assert info == {
+        "format": "Portable Document Format",
+        "pages": 2,
+        "page_size": [100.0, 200.0, "pts"],
+        "title": "The title",
+        "author": "The author",
+        "datetime": "2026-01-02T03:04:05+01:00",
+    }
+
+
+def test_get_pdf_info_encrypted(tmp_path):
+    "Test that a PDF needing a password is flagged, and read with the password"
+    path = tmp_path / "file.pdf"
+    pdf = pikepdf.new()
+    pdf.add_blank_page()
+    pdf.save(path, encryption=pikepdf.Encryption(user="secret", owner="owner"))
+    thread = Importhread()
+    info = {}
+    thread._get_pdf_info(info, str(path), None, unittest.mock.Mock())
+    assert info == {"format": "Portable Document Format", "encrypted": True}
+
+    info = {}
+    thread._get_pdf_info(info, str(path), "secret", unittest.mock.Mock())
+    assert info["pages"] == 1
+    assert "encrypted" not in info
 
 
 @unittest.mock.patch("subprocess.run")
@@ -394,274 +597,414 @@ def test_get_pdf_images_error(mock_co, mock_run):
     mock_request.error.assert_called_once_with("Error extracting images from PDF")
 
 
-@unittest.mock.patch("subprocess.run")
-@unittest.mock.patch("subprocess.check_output")
-@unittest.mock.patch("glob.glob")
-@unittest.mock.patch("importthread.Page")
-def test_import_pdf_image_error(mock_page, mock_glob, mock_co, _mock_run):
-    "Test that request.error is thrown when importing individual images fails"
-    mock_co.return_value = """page   num  type   width height color comp bpc  enc interp  object ID x-ppi y-ppi size ratio
---------------------------------------------------------------------------------------------
-   1     0 image     157   196  gray    1   1  ccitt  no   [inline]      72    72    0B 0.0%
-"""
-
-    # Simulate the presence of image files
-    mock_glob.side_effect = [[], ["x-01.pnm"]]
-
-    # Simulate an error during Page initialization
-    mock_page.side_effect = PermissionError("Error importing PDF")
-
-    thread = Importhread()
-    mock_request = unittest.mock.Mock()
-    mock_request.args = (
-        {
-            "first": 1,
-            "last": 1,
-            "dir": "/tmp",
-            "password": "",
-            "info": {
-                "path": "/to/file.pdf",
-            },
-        },
-        None,
+def _image_stream(pdf, image, **kwargs):
+    "return an uncompressed image XObject for the given PIL image"
+    colorspace = (
+        pikepdf.Name.DeviceRGB if image.mode == "RGB" else pikepdf.Name.DeviceGray
+    )
+    return pdf.make_stream(
+        image.tobytes(),
+        Type=pikepdf.Name.XObject,
+        Subtype=pikepdf.Name.Image,
+        Width=image.width,
+        Height=image.height,
+        ColorSpace=colorspace,
+        BitsPerComponent=8,
+        **kwargs,
     )
 
-    # Call the method
-    thread._do_import_pdf(mock_request)
-
-    # Assert that the error was logged and the request.error was called
-    mock_request.error.assert_called_once_with("Error importing PDF")
 
+def _write_pdf(path, content, xobjects):
+    """write a one-page PDF with the given content stream and XObjects, which
+    are given as functions of the PDF that return the stream"""
+    pdf = pikepdf.new()
+    pdf.add_blank_page(page_size=(612, 792))
+    page = pdf.pages[0]
+    page.obj.Resources = pikepdf.Dictionary(
+        XObject=pikepdf.Dictionary(
+            **{name: factory(pdf) for name, factory in xobjects.items()}
+        )
+    )
+    page.obj.Contents = pdf.make_stream(content)
+    pdf.save(path)
+    return str(path)
 
-_LIST_IMAGE = _pdfimages_list(
-    "   1     0 image     600   200  gray    1   8  image  no        20  0    72    72  992B 0.8%"
-)
 
-_LIST_IMAGE_SMASK = _pdfimages_list(
-    "   1     0 image     600   200  gray    1   8  image  no        20  0    72    72  992B 0.8%",
-    "   1     1 smask     600   200  gray    1   8  image  no        20  0    72    72 8624B 7.2%",
-)
+def _pdf_import_thread():
+    "return an Importhread that does not extract text or store pages"
+    thread = Importhread()
+    thread.add_page = unittest.mock.Mock()
+    thread._extract_text_from_pdf = unittest.mock.Mock(
+        side_effect=lambda _request, first, last: [""] * (last - first + 1)
+    )
+    return thread
 
-_LIST_IMAGE_SMASK_DIFFERENT_PPI = _pdfimages_list(
-    "   1     0 image     600   200  gray    1   8  image  no        20  0   150   150  992B 0.8%",
-    "   1     1 smask     600   200  gray    1   8  image  no        20  0    72    72 8624B 7.2%",
-)
 
-_LIST_TWO_IMAGES = _pdfimages_list(
-    "   1     0 image     600   200  gray    1   8  image  no        20  0    72    72  992B 0.8%",
-    "   1     1 image     600   200  gray    1   8  image  no        20  0    72    72  992B 0.8%",
-)
+def _imported_image(mock_page):
+    "return the image passed to the last page created"
+    return Image.open(io.BytesIO(mock_page.call_args.kwargs["image_bytes"]))
 
 
-def _pdf_import_args(first, last):
+def _pdf_import_args(path, first=1, last=1):
     "build the args for _do_import_pdf"
     return {
         "first": first,
         "last": last,
         "dir": "/tmp",
         "password": "",
-        "info": {"path": "/to/file.pdf"},
+        "info": {"path": path, "format": "Portable Document Format"},
     }
 
 
-def _pdf_import_request(mock_request, first, last):
+def _pdf_import_request(mock_request, path, first=1, last=1):
     "attach args to a mocked request"
-    mock_request.args = (_pdf_import_args(first, last), None)
+    mock_request.args = (_pdf_import_args(path, first, last), None)
+
+
+@unittest.mock.patch("importthread.Page")
+def test_import_pdf_image_error(mock_page, tmp_path):
+    "Test that request.error is thrown when importing individual images fails"
+    path = _write_pdf(
+        tmp_path / "file.pdf",
+        b"q 72 0 0 72 0 0 cm /Im0 Do Q",
+        {"Im0": lambda pdf: _image_stream(pdf, Image.new("L", (72, 72)))},
+    )
+    mock_page.side_effect = PermissionError("Error importing PDF")
+
+    thread = _pdf_import_thread()
+    mock_request = unittest.mock.Mock()
+    _pdf_import_request(mock_request, path)
+    thread._do_import_pdf(mock_request)
+
+    mock_request.error.assert_called_once_with("Error importing PDF")
 
 
-@unittest.mock.patch("importthread.os.remove")
 @unittest.mock.patch("subprocess.run")
 @unittest.mock.patch("subprocess.check_output")
-@unittest.mock.patch("glob.glob")
 @unittest.mock.patch("importthread.Page")
-def test_import_pdf_skips_smask(mock_page, mock_glob, mock_co, mock_run, _mock_remove):
-    "Test that a soft mask is not imported as a page"
-    mock_co.return_value = _LIST_IMAGE_SMASK
-    mock_glob.side_effect = [[], ["x-000.pnm", "x-001.pnm"]]
-    mock_run.return_value = unittest.mock.Mock(returncode=0)
-
-    thread = Importhread()
-    thread.add_page = unittest.mock.Mock()
+def test_import_pdf_in_process(mock_page, mock_co, mock_run, tmp_path):
+    "Test that images are extracted without running pdfimages"
+    path = _write_pdf(
+        tmp_path / "file.pdf",
+        b"q 144 0 0 72 0 0 cm /Im0 Do Q",
+        {"Im0": lambda pdf: _image_stream(pdf, Image.new("L", (600, 200)))},
+    )
+    thread = _pdf_import_thread()
     mock_request = unittest.mock.Mock()
-    _pdf_import_request(mock_request, 1, 1)
+    _pdf_import_request(mock_request, path)
 
     thread._do_import_pdf(mock_request)
 
-    assert mock_page.call_count == 1, "only the image is imported as a page"
-    assert mock_page.call_args.kwargs["filename"] == "x-000.pnm"
-    _mock_remove.assert_any_call("x-001.pnm")
+    mock_co.assert_not_called()
+    mock_run.assert_not_called()
+    assert mock_page.call_count == 1
+    assert _imported_image(mock_page).size == (600, 200)
+    assert mock_page.call_args.kwargs["resolution"] == (300, 200, "PixelsPerInch")
     mock_request.error.assert_not_called()
 
 
-@unittest.mock.patch("importthread.os.remove")
-@unittest.mock.patch("subprocess.run")
-@unittest.mock.patch("subprocess.check_output")
-@unittest.mock.patch("glob.glob")
 @unittest.mock.patch("importthread.Page")
-def test_import_pdf_no_warning_for_smask(
-    _mock_page, mock_glob, mock_co, mock_run, _mock_remove
-):
-    "Test that an image plus soft mask does not trigger a warning"
-    mock_co.return_value = _LIST_IMAGE_SMASK
-    mock_glob.side_effect = [[], ["x-000.pnm", "x-001.pnm"]]
-    mock_run.return_value = unittest.mock.Mock(returncode=0)
+def test_import_pdf_resolution_from_ctm(mock_page, tmp_path):
+    "Test that the resolution accounts for rotation, nesting and forms"
+    path = _write_pdf(
+        tmp_path / "file.pdf",
+        b"q 2 0 0 2 0 0 cm q 0 36 -36 0 0 0 cm /Im0 Do Q Q",
+        {"Im0": lambda pdf: _image_stream(pdf, Image.new("L", (100, 50)))},
+    )
+    thread = _pdf_import_thread()
+    mock_request = unittest.mock.Mock()
+    _pdf_import_request(mock_request, path)
 
-    thread = Importhread()
-    thread.add_page = unittest.mock.Mock()
+    thread._do_import_pdf(mock_request)
+
+    assert mock_page.call_args.kwargs["resolution"] == (100, 50, "PixelsPerInch")
+
+
+@unittest.mock.patch("importthread.Page")
+def test_import_pdf_form_xobject(mock_page, tmp_path):
+    "Test that images drawn by form XObjects are imported"
+
+    def form(pdf):
+        return pdf.make_stream(
+            b"q 2 0 0 1 0 0 cm /Im0 Do Q",
+            Type=pikepdf.Name.XObject,
+            Subtype=pikepdf.Name.Form,
+            BBox=[0, 0, 2, 1],
+            Matrix=[0.5, 0, 0, 0.5, 0, 0],
+            Resources=pikepdf.Dictionary(
+                XObject=pikepdf.Dictionary(
+                    Im0=_image_stream(pdf, Image.new("L", (200, 100)))
+                )
+            ),
+        )
+
+    path = _write_pdf(
+        tmp_path / "file.pdf", b"q 72 0 0 72 0 0 cm /Fm0 Do Q", {"Fm0": form}
+    )
+    thread = _pdf_import_thread()
     mock_request = unittest.mock.Mock()
-    _pdf_import_request(mock_request, 1, 1)
+    _pdf_import_request(mock_request, path)
 
     thread._do_import_pdf(mock_request)
 
+    assert mock_page.call_count == 1
+    assert _imported_image(mock_page).size == (200, 100)
+    assert mock_page.call_args.kwargs["resolution"] == (200, 200, "PixelsPerInch")
+
+
+@unittest.mock.patch("importthread.Page")
+def test_import_pdf_skips_stencil(mock_page, tmp_path):
+    "Test that a stencil mask is not imported as a page"
+
+    def stencil(pdf):
+        return pdf.make_stream(
+            b"\x00",
+            Type=pikepdf.Name.XObject,
+            Subtype=pikepdf.Name.Image,
+            Width=8,
+            Height=1,
+            ImageMask=True,
+        )
+
+    path = _write_pdf(
+        tmp_path / "file.pdf",
+        b"q 72 0 0 72 0 0 cm /Im0 Do /Im1 Do Q",
+        {
+            "Im0": lambda pdf: _image_stream(pdf, Image.new("L", (72, 72))),
+            "Im1": stencil,
+        },
+    )
+    thread = _pdf_import_thread()
+    mock_request = unittest.mock.Mock()
+    _pdf_import_request(mock_request, path)
+
+    thread._do_import_pdf(mock_request)
+
+    assert mock_page.call_count == 1, "only the image is imported as a page"
     mock_request.error.assert_not_called()
 
 
-@unittest.mock.patch("importthread.os.remove")
-@unittest.mock.patch("subprocess.run")
-@unittest.mock.patch("subprocess.check_output")
-@unittest.mock.patch("glob.glob")
 @unittest.mock.patch("importthread.Page")
-def test_import_pdf_warning_for_two_images(
-    mock_page, mock_glob, mock_co, mock_run, _mock_remove
-):
+def test_import_pdf_warning_for_two_images(mock_page, tmp_path):
     "Test that two real images on a page trigger a warning"
-    mock_co.return_value = _LIST_TWO_IMAGES
-    mock_glob.side_effect = [[], ["x-000.pnm", "x-001.pnm"]]
-    mock_run.return_value = unittest.mock.Mock(returncode=0)
-
-    thread = Importhread()
-    thread.add_page = unittest.mock.Mock()
+    path = _write_pdf(
+        tmp_path / "file.pdf",
+        b"q 72 0 0 72 0 0 cm /Im0 Do /Im1 Do Q",
+        {
+            "Im0": lambda pdf: _image_stream(pdf, Image.new("L", (72, 72))),
+            "Im1": lambda pdf: _image_stream(pdf, Image.new("RGB", (72, 72))),
+        },
+    )
+    thread = _pdf_import_thread()
     mock_request = unittest.mock.Mock()
-    _pdf_import_request(mock_request, 1, 1)
+    _pdf_import_request(mock_request, path)
 
     thread._do_import_pdf(mock_request)
 
     assert mock_page.call_count == 2, "both images imported as pages"
     args, _kwargs = mock_request.error.call_args
-    assert args[0] is None, "warning not an error"
+    assert args[0] == IMPORT_WARNING, "warning not a failure"
     assert "expects one image per page" in args[1]
 
 
-@unittest.mock.patch("importthread.os.remove")
-@unittest.mock.patch("subprocess.run")
-@unittest.mock.patch("subprocess.check_output")
-@unittest.mock.patch("glob.glob")
+def test_import_pdf_imports_composited_image(tmp_path):
+    "Test that an image with a soft mask is imported as a single composited page"
+    image = Image.new("L", (2, 1))
+    image.putpixel((0, 0), 200)
+    image.putpixel((1, 0), 0)
+    mask = Image.new("L", (2, 1))
+    mask.putpixel((0, 0), 255)
+    mask.putpixel((1, 0), 0)
+    path = _write_pdf(
+        tmp_path / "file.pdf",
+        b"q 144 0 0 72 0 0 cm /Im0 Do Q",
+        {"Im0": lambda pdf: _image_stream(pdf, image, SMask=_image_stream(pdf, mask))},
+    )
+    thread = _pdf_import_thread()
+    mock_request = unittest.mock.Mock()
+    _pdf_import_request(mock_request, path)
+
+    thread._do_import_pdf(mock_request)
+
+    assert thread.add_page.call_count == 1, "only the composited image is imported"
+    page = thread.add_page.call_args[0][0]
+    assert page.image_object.size == (2, 1)
+    assert (
+        abs(page.image_object.getpixel((0, 0)) - 200) <= 2
+    ), "opaque mask keeps the value"
+    assert (
+        abs(page.image_object.getpixel((1, 0)) - 255) <= 2
+    ), "transparent mask becomes white"
+    mock_request.error.assert_not_called()
+
+
 @unittest.mock.patch("importthread.Page")
-def test_import_pdf_resolution_from_own_entry(
-    mock_page, mock_glob, mock_co, mock_run, _mock_remove
-):
-    "Test that the imported page resolution comes from its own -list entry"
-    mock_co.return_value = _LIST_IMAGE_SMASK_DIFFERENT_PPI
-    mock_glob.side_effect = [[], ["x-000.pnm", "x-001.pnm"]]
-    mock_run.return_value = unittest.mock.Mock(returncode=0)
+def test_import_pdf_jpeg_passthrough(mock_page, tmp_path):
+    "Test that a DCT stream is imported as the original JPEG bytes"
+    buf = io.BytesIO()
+    Image.new("RGB", (300, 150), (10, 200, 30)).save(buf, format="JPEG")
+    jpeg = buf.getvalue()
+
+    def dct(pdf):
+        return pdf.make_stream(
+            jpeg,
+            Type=pikepdf.Name.XObject,
+            Subtype=pikepdf.Name.Image,
+            Width=300,
+            Height=150,
+            ColorSpace=pikepdf.Name.DeviceRGB,
+            BitsPerComponent=8,
+            Filter=pikepdf.Name.DCTDecode,
+        )
 
-    thread = Importhread()
-    thread.add_page = unittest.mock.Mock()
+    path = _write_pdf(
+        tmp_path / "file.pdf", b"q 144 0 0 72 0 0 cm /Im0 Do Q", {"Im0": dct}
+    )
+    thread = _pdf_import_thread()
     mock_request = unittest.mock.Mock()
-    _pdf_import_request(mock_request, 1, 1)
+    _pdf_import_request(mock_request, path)
 
     thread._do_import_pdf(mock_request)
 
     assert mock_page.call_count == 1
-    assert mock_page.call_args.kwargs["resolution"] == (150.0, 150.0, "PixelsPerInch")
+    assert mock_page.call_args.kwargs["image_bytes"] == jpeg, "not re-encoded"
+    assert mock_page.call_args.kwargs["resolution"] == (150, 150, "PixelsPerInch")
 
 
-@unittest.mock.patch("importthread.os.remove")
+@unittest.mock.patch("importthread.Page")
+def test_import_pdf_ccitt_bilevel(mock_page, tmp_path):
+    "Test that a CCITT G4 stream is imported as a bilevel image"
+    image = Image.new("1", (64, 32), 1)
+    image.paste(0, (0, 0, 20, 10))
+    tif = tmp_path / "g4.tif"
+    image.save(tif, compression="group4")
+    path = tmp_path / "file.pdf"
+    with open(path, "wb") as fhd:
+        fhd.write(img2pdf.convert(str(tif)))
+    thread = _pdf_import_thread()
+    mock_request = unittest.mock.Mock()
+    _pdf_import_request(mock_request, str(path))
+
+    thread._do_import_pdf(mock_request)
+
+    imported = _imported_image(mock_page)
+    assert imported.format == "PNG", "stored losslessly"
+    assert imported.mode == "1", "kept bilevel"
+    assert imported.getpixel((0, 0)) == 0
+    assert imported.getpixel((30, 20)) == 255
+
+
+_LIST_IMAGE = _pdfimages_list(
+    "   1     0 image     600   200  gray    1   8  image  no        20  0    72    72  992B 0.8%"
+)
+
+_LIST_IMAGE_SMASK_DIFFERENT_PPI = _pdfimages_list(
+    "   1     0 image     600   200  gray    1   8  image  no        20  0   150   150  992B 0.8%",
+    "   1     1 smask     600   200  gray    1   8  image  no        20  0    72    72 8624B 7.2%",
+)
+
+
+def _fake_pdfimages(*images):
+    "return a subprocess.run side effect that writes images as pdfimages would"
+
+    def run(cmd, **_kwargs):
+        for i, image in enumerate(images):
+            image.save(f"{cmd[-1]}-{i:03d}.pgm")
+        return unittest.mock.Mock(returncode=0)
+
+    return run
+
+
+@unittest.mock.patch("importthread._extract_pdf_page_images", return_value=None)
 @unittest.mock.patch("subprocess.run")
 @unittest.mock.patch("subprocess.check_output")
-@unittest.mock.patch("glob.glob")
 @unittest.mock.patch("importthread.Page")
-def test_import_pdf_count_mismatch_fallback(
-    mock_page, mock_glob, mock_co, mock_run, _mock_remove
+def test_import_pdf_falls_back_to_pdfimages(
+    mock_page, mock_co, mock_run, _mock_extract, tmp_path
 ):
-    "Test that a count mismatch imports every file and warns"
-    mock_co.return_value = _LIST_IMAGE
-    mock_glob.side_effect = [[], ["x-000.pnm", "x-001.pnm"]]
-    mock_run.return_value = unittest.mock.Mock(returncode=0)
-
-    thread = Importhread()
-    thread.add_page = unittest.mock.Mock()
+    "Test that pdfimages extracts into a temporary directory if pikepdf cannot"
+    path = _write_pdf(tmp_path / "file.pdf", b"", {})
+    mock_co.return_value = _LIST_IMAGE_SMASK_DIFFERENT_PPI
+    mock_run.side_effect = _fake_pdfimages(
+        Image.new("L", (600, 200), 0), Image.new("L", (600, 200), 0)
+    )
+    thread = _pdf_import_thread()
     mock_request = unittest.mock.Mock()
-    _pdf_import_request(mock_request, 1, 1)
+    _pdf_import_request(mock_request, path)
+    mock_request.args[0]["dir"] = str(tmp_path)
 
     thread._do_import_pdf(mock_request)
 
-    assert mock_page.call_count == 2, "every extracted file imported"
-    args, _kwargs = mock_request.error.call_args
-    assert args[0] is None, "warning not an error"
-    assert "expects one image per page" in args[1]
+    prefix = mock_run.call_args.args[0][-1]
+    assert pathlib.Path(prefix).parent.parent == tmp_path, "extracted to a temp dir"
+    assert not pathlib.Path(prefix).parent.exists(), "temp dir removed"
+    assert mock_page.call_count == 1, "the soft mask is not imported as a page"
+    kwargs = mock_page.call_args.kwargs
+    assert kwargs["resolution"] == (150.0, 150.0, "PixelsPerInch")
+    assert _imported_image(mock_page).getpixel((0, 0)) == 255, "composited over white"
+    mock_request.error.assert_not_called()
 
 
-@unittest.mock.patch("importthread.os.remove")
+@unittest.mock.patch("importthread._extract_pdf_page_images", return_value=None)
 @unittest.mock.patch("subprocess.run")
 @unittest.mock.patch("subprocess.check_output")
-@unittest.mock.patch("glob.glob")
 @unittest.mock.patch("importthread.Page")
-def test_import_pdf_cleans_up_leftover_files(
-    mock_page, mock_glob, mock_co, mock_run, _mock_remove
+def test_import_pdf_fallback_keeps_jpeg(
+    mock_page, mock_co, mock_run, _mock_extract, tmp_path
 ):
-    "Test that leftover extraction files are removed before the next page"
+    "Test that JPEGs written by pdfimages -j are imported without re-encoding"
+    path = _write_pdf(tmp_path / "file.pdf", b"", {})
     mock_co.return_value = _LIST_IMAGE
-    mock_glob.side_effect = [
-        [],
-        ["x-000.pnm"],
-        ["x-002.pnm"],
-        ["x-000.pnm"],
-    ]
-    mock_run.return_value = unittest.mock.Mock(returncode=0)
+    buf = io.BytesIO()
+    Image.new("L", (600, 200)).save(buf, format="JPEG")
 
-    thread = Importhread()
-    thread.add_page = unittest.mock.Mock()
+    def run(cmd, **_kwargs):
+        with open(f"{cmd[-1]}-000.jpg", "wb") as fhd:
+            fhd.write(buf.getvalue())
+        return unittest.mock.Mock(returncode=0)
+
+    mock_run.side_effect = run
+    thread = _pdf_import_thread()
     mock_request = unittest.mock.Mock()
-    _pdf_import_request(mock_request, 1, 2)
+    _pdf_import_request(mock_request, path)
 
     thread._do_import_pdf(mock_request)
 
-    assert mock_page.call_count == 2, "one page imported per PDF page"
-    _mock_remove.assert_any_call("x-002.pnm")
+    assert "-j" in mock_run.call_args.args[0]
+    assert mock_page.call_args.kwargs["image_bytes"] == buf.getvalue()
+    mock_request.error.assert_not_called()
 
 
-@unittest.mock.patch("importthread.os.remove")
+@unittest.mock.patch("importthread._extract_pdf_page_images", return_value=None)
 @unittest.mock.patch("subprocess.run")
 @unittest.mock.patch("subprocess.check_output")
-@unittest.mock.patch("glob.glob")
-def test_import_pdf_imports_composited_image(
-    mock_glob, mock_co, mock_run, _mock_remove, monkeypatch, tmp_path
+@unittest.mock.patch("importthread.Page")
+def test_import_pdf_count_mismatch_fallback(
+    mock_page, mock_co, mock_run, _mock_extract, tmp_path
 ):
-    "Test that an image with a soft mask is imported as a single composited page"
-    image = Image.new("L", (2, 1))
-    image.putpixel((0, 0), 200)
-    image.putpixel((1, 0), 0)
-    image.save(tmp_path / "x-000.pgm")
-    mask = Image.new("L", (2, 1))
-    mask.putpixel((0, 0), 255)
-    mask.putpixel((1, 0), 0)
-    mask.save(tmp_path / "x-001.pgm")
-    monkeypatch.chdir(tmp_path)
-    mock_co.return_value = _LIST_IMAGE_SMASK
-    mock_glob.side_effect = [[], ["x-000.pgm", "x-001.pgm"]]
-    mock_run.return_value = unittest.mock.Mock(returncode=0)
-
-    thread = Importhread()
-    thread.add_page = unittest.mock.Mock()
+    "Test that a count mismatch imports every file and warns"
+    path = _write_pdf(tmp_path / "file.pdf", b"", {})
+    mock_co.return_value = _LIST_IMAGE
+    mock_run.side_effect = _fake_pdfimages(
+        Image.new("L", (600, 200)), Image.new("L", (600, 200))
+    )
+    thread = _pdf_import_thread()
     mock_request = unittest.mock.Mock()
-    _pdf_import_request(mock_request, 1, 1)
+    _pdf_import_request(mock_request, path)
 
     thread._do_import_pdf(mock_request)
 
-    assert thread.add_page.call_count == 1, "only the composited image is imported"
-    page = thread.add_page.call_args[0][0]
-    assert page.image_object.size == (2, 1)
-    assert page.image_object.getpixel((0, 0)) == 200, "opaque mask keeps the value"
-    assert page.image_object.getpixel((1, 0)) == 255, "transparent mask becomes white"
-    _mock_remove.assert_any_call("x-001.pgm")
+    assert mock_page.call_count == 2, "every extracted file imported"
+    args, _kwargs = mock_request.error.call_args
+    assert args[0] == IMPORT_WARNING, "warning not a failure"
+    assert "expects one image per page" in args[1]
 
 
 @unittest.mock.patch("subprocess.run")
 def test_extract_text_from_pdf_error(mock_run):
     "Test that request.error is thrown when pdftotext fails"
     # Simulate a subprocess error when running pdftotext
-    mock_run.return_value = unittest.mock.Mock(returncode=1)
+    mock_run.return_value = unittest.mock.Mock(returncode=1, stdout="")
 
     thread = Importhread()
     mock_request = unittest.mock.Mock()
@@ -677,5 +1020,100 @@ def test_extract_text_from_pdf_error(mock_run):
     )
 
     # Call the method and check for the error
-    thread._extract_text_from_pdf(mock_request, 1)
+    thread._extract_text_from_pdf(mock_request, 1, 1)
     mock_request.error.assert_called_once_with("Error extracting text layer from PDF")
+
+
+_PDFTOTEXT_HEAD = """<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<title></title>
+</head>
+<body>
+<doc>
+"""
+_PDFTOTEXT_TAIL = """</doc>
+</body>
+</html>
+"""
+_PDFTOTEXT_PAGE1 = """  <page width="612.000000" height="792.000000">
+    <word xMin="1.0" yMin="2.0" xMax="3.0" yMax="4.0">one</word>
+  </page>"""
+_PDFTOTEXT_PAGE2 = """  <page width="612.000000" height="792.000000">
+  </page>"""
+
+
+@unittest.mock.patch("subprocess.run")
+def test_extract_text_from_pdf_range(mock_run):
+    "Test that the text layer of a range is extracted once and split per page"
+    mock_run.return_value = unittest.mock.Mock(
+        returncode=0,
+        stdout=_PDFTOTEXT_HEAD
+        + _PDFTOTEXT_PAGE1
+        + "\n"
+        + _PDFTOTEXT_PAGE2
+        + "\n"
+        + _PDFTOTEXT_TAIL,
+    )
+    thread = Importhread()
+    mock_request = unittest.mock.Mock()
+    mock_request.args = (
+        {"info": {"path": "/to/file.pdf"}, "dir": "/tmp", "password": None},
+        None,
+    )
+
+    texts = thread._extract_text_from_pdf(mock_request, 2, 4)
+
+    mock_run.assert_called_once()
+    cmd = mock_run.call_args.args[0]
+    assert cmd[cmd.index("-f") + 1] == "2" and cmd[cmd.index("-l") + 1] == "4"
+    assert texts == [
+        _PDFTOTEXT_HEAD + _PDFTOTEXT_PAGE1 + "\n" + _PDFTOTEXT_TAIL,
+        _PDFTOTEXT_HEAD + _PDFTOTEXT_PAGE2 + "\n" + _PDFTOTEXT_TAIL,
+        "",
+    ], "one document per page, padded for missing pages"
+
+
+def _djvu_text_request(pages):
+    "return a mocked request to extract the text layers of a DjVu file"
+    mock_request = unittest.mock.Mock()
+    mock_request.args = ({"info": {"path": "/to/file.djvu", "pages": pages}}, None)
+    return mock_request
+
+
+@unittest.mock.patch("subprocess.check_output")
+def test_extract_text_from_djvu_range(mock_co):
+    "Test that the layers of a range are extracted with one djvused run"
+    mock_co.return_value = (
+        '(page 0 0 10 10\n (word 0 0 10 10 "a"))\n12\n'
+        '(maparea "" "x" (rect 0 0 1 1) (xor))\n12\n'
+        "12\n12\n"
+    )
+    thread = Importhread()
+
+    layers = thread._extract_text_from_djvu(_djvu_text_request(12), 3, 4)
+
+    mock_co.assert_called_once()
+    assert mock_co.call_args.args[0][-1] == (
+        "select 3; print-txt; n; print-ant; n; select 4; print-txt; n; print-ant; n"
+    )
+    assert layers == [
+        (
+            '(page 0 0 10 10\n (word 0 0 10 10 "a"))\n',
+            '(maparea "" "x" (rect 0 0 1 1) (xor))\n',
+        ),
+        ("", ""),
+    ]
+
+
+@unittest.mock.patch("subprocess.check_output")
+def test_extract_text_from_djvu_fallback(mock_co):
+    "Test that djvused is run per page if the output cannot be split"
+    mock_co.side_effect = ["unexpected\n", "txt 3", "ant 3", "txt 4", "ant 4"]
+    thread = Importhread()
+
+    layers = thread._extract_text_from_djvu(_djvu_text_request(12), 3, 4)
+
+    assert mock_co.call_count == 5
+    assert mock_co.call_args.args[0][-1] == "select 4; print-ant"
+    assert layers == [("txt 3", "ant 3"), ("txt 4", "ant 4")]
@@ -0,0 +1,84 @@
+"Tests for mrc.py"
+
+import json
+
+import pikepdf
+from PIL import Image, ImageDraw
+from mrc import text_mask, write_pdf_page
+
+
+def draw_page(text_colour=(20, 20, 20)):
+    "return a 300 dpi page with some text and a dark header"
+    image = Image.new("RGB", (600, 400), (250, 240, 220))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((0, 0, 599, 99), fill=(30, 60, 150))
+    for y in range(150, 350, 40):
+        for x in range(50, 550, 30):
+            draw.rectangle((x, y, x + 3, y + 20), fill=text_colour)
+            draw.rectangle((x + 10, y, x + 13, y + 20), fill=text_colour)
+    return image
+
+
+def test_text_mask():
+    "Test finding the text of a page"
+    image = draw_page()
+    mask = text_mask(image, factor=3)
+    assert mask.mode == "1"
+    assert mask.getpixel((51, 160)) == 0, "text stroke in mask"
+    assert mask.getpixel((57, 160)) == 255, "paper between strokes not in mask"
+    assert mask.getpixel((300, 50)) == 255, "thick header not in mask"
+
+    text_layer = json.dumps(
+        [
+            {"type": "page", "bbox": [0, 0, 600, 400], "depth": 0},
+            {"type": "word", "bbox": [45, 145, 120, 175], "depth": 1, "text": "a"},
+        ]
+    )
+    mask = text_mask(image, text_layer)
+    assert mask.getpixel((51, 160)) == 0, "text in word box in mask"
+    assert mask.getpixel((151, 160)) == 255, "text outside word boxes not in mask"
+
+
+def test_write_pdf_page(tmp_path):
+    "Test writing a page as MRC"
+    image = draw_page()
+    write_pdf_page(image, tmp_path / "page.pdf", (144, 96), (300, 300))
+    with pikepdf.open(tmp_path / "page.pdf") as pdf:
+        page = pdf.pages[0]
+        assert page.mediabox == [0, 0, 144, 96]
+        background = page.Resources.XObject.Im0
+        assert background.Filter == pikepdf.Name.DCTDecode
+        assert (background.Width, background.Height) == (200, 134), "at 100 dpi"
+
+        # uniform text is painted through the mask in a single colour
+        stencil = page.Resources.XObject.Im1
+        assert stencil.ImageMask
+        assert stencil.Filter == pikepdf.Name.CCITTFaxDecode
+        assert (stencil.Width, stencil.Height) == (600, 400)
+        assert b" rg " in page.Contents.read_bytes()
+
+
+def test_write_pdf_page_colour_text(tmp_path):
+    "Test that text of several colours is painted from a foreground image"
+    image = draw_page()
+    ImageDraw.Draw(image).rectangle((0, 250, 599, 399), fill=(250, 240, 220))
+    for y in (270, 320):
+        for x in range(50, 550, 30):
+            ImageDraw.Draw(image).rectangle((x, y, x + 3, y + 20), fill=(200, 0, 0))
+    write_pdf_page(image, tmp_path / "page.pdf", (144, 96), (300, 300))
+    with pikepdf.open(tmp_path / "page.pdf") as pdf:
+        page = pdf.pages[0]
+        foreground = page.Resources.XObject.Im1
+        assert foreground.Filter == pikepdf.Name.DCTDecode
+        assert foreground.Mask.ImageMask
+        assert b" rg " not in page.Contents.read_bytes()
+
+
+def test_write_pdf_page_no_text(tmp_path):
+    "Test that a page without text is written as background only"
+    image = Image.new("L", (300, 300), 200)
+    write_pdf_page(image, tmp_path / "page.pdf", (72, 72), (300, 300), quality=50)
+    with pikepdf.open(tmp_path / "page.pdf") as pdf:
+        xobjects = pdf.pages[0].Resources.XObject
+        assert list(xobjects.keys()) == ["/Im0"]
+        assert xobjects.Im0.ColorSpace == pikepdf.Name.DeviceGray
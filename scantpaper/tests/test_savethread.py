@@ -1,26 +1,48 @@
 "Tests for savethread.py"
 
 import datetime
+import io
+import os
+import random
+import shutil
+import subprocess
+import threading
+import time
 from unittest.mock import MagicMock, mock_open, patch
 
+import img2pdf
+import mrc
+import pikepdf
 import pytest
 from basethread import Request
 from i18n import _
+from importthread import CancelledError
 from page import Page
+from PIL import Image, ImageCms, ImageDraw
 from savethread import (
     SaveThread,
-    SaveThreadProgressBar,
     _2GIB,
     _add_annotations_to_pdf,
-    _append_pdf,
-    _current_request_for_progress,
-    _encrypt_pdf,
+    _djvused_script,
+    _layout_fun,
+    _pdf_cache_dir,
+    _proxy,
+    _prune_pdf_cache,
+    _text_layer_content,
+    _write_pdf,
+    _write_pdf_page,
     _post_save_hook,
     _set_timestamp,
-    get_progressbar_class,
     prepare_output_metadata,
 )
 
+TEXT_LAYER = (
+    '[{"bbox": [0, 0, 300, 600], "type": "page", "depth": 0}, '
+    '{"bbox": [10, 20, 290, 60], "type": "line", "baseline": [0, -10], "depth": 1}, '
+    '{"bbox": [10, 20, 100, 60], "type": "word", "text": "Hello", "depth": 2}, '
+    '{"bbox": [150, 20, 290, 60], "type": "word", "text": "wörld", "depth": 2}]'
+)
+
 
 class MockSaveThread(SaveThread):
     "Mock subclass of SaveThread for testing"
@@ -49,8 +71,9 @@ class MockSaveThread(SaveThread):
 
 @pytest.fixture
 def mock_thread_instance():
-    "Fixture for MockSaveThread"
-    return MockSaveThread()
+    "Fixture for MockSaveThread, without caching page PDFs"
+    with patch("savethread._pdf_cache_dir", return_value=None):
+        yield MockSaveThread()
 
 
 @pytest.fixture
@@ -61,11 +84,14 @@ def mock_page_instance():
     page.uuid = "uuid1"
     page.resolution = (300, 300, "PixelsPerInch")
     page.get_resolution.return_value = (300, 300, "PixelsPerInch")
+    page.width = 300
+    page.height = 600
     page.text_layer = None
     page.annotations = None
     page.write_image_for_pdf = MagicMock()
     page.write_image_for_djvu = MagicMock()
-    page.write_image_for_tiff = MagicMock()
+    page.djvused_layers.return_value = ""
+    page.tiff_frame.return_value = (Image.new("RGB", (30, 20)), (300, 300))
     page.export_text.return_value = "Page Text"
     page.export_hocr.return_value = (
         "<html><body><div class='ocr_page'>HOCR</div></body></html>"
@@ -95,10 +121,9 @@ def test_save_pdf(mock_thread_instance, mock_page_instance):
         patch("savethread.tempfile.NamedTemporaryFile"),
         patch("savethread.open", mock_open()),
         patch("savethread.img2pdf.convert", return_value=b"pdf_data") as mock_img2pdf,
-        patch("savethread.ocrmypdf.api._pdf_to_hocr") as mock_pdf_to_hocr,
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf") as mock_hocr_to_ocr_pdf,
-        patch("savethread._fix_pdf_metadata") as mock_fix_metadata,
+        patch("savethread._write_pdf") as mock_write_pdf,
         patch("savethread.os.remove"),
+        patch("savethread.os.path.getsize", return_value=1024),
         patch("savethread._set_timestamp"),
         patch("savethread._post_save_hook") as mock_post_save_hook,
         patch("savethread.pathlib.Path") as mock_path,
@@ -109,15 +134,17 @@ def test_save_pdf(mock_thread_instance, mock_page_instance):
         mock_thread_instance.do_save_pdf(request)
 
         assert mock_img2pdf.called
-        assert mock_hocr_to_ocr_pdf.called
         assert mock_page_instance.write_image_for_pdf.called
         assert mock_post_save_hook.called
-        mock_fix_metadata.assert_called_once_with("/tmp/output.pdf", True)
+        args, kwargs = mock_write_pdf.call_args
+        assert args[1:3] == ([None], "/tmp/output.pdf")
+        assert kwargs["linearize"]
+        assert not kwargs["pdfa"], "PDF/A only on request"
 
 
-def test_save_pdf_with_hocr(mock_thread_instance, mock_page_instance):
-    "Test save_pdf method with HOCR"
-    mock_page_instance.text_layer = "some text layer data"
+def test_save_pdf_with_text_layer(mock_thread_instance, mock_page_instance):
+    "Test save_pdf passes the rendered text layer to the PDF writer"
+    mock_page_instance.text_layer = TEXT_LAYER
     mock_thread_instance.mock_pages[1] = mock_page_instance
 
     options = {
@@ -134,9 +161,7 @@ def test_save_pdf_with_hocr(mock_thread_instance, mock_page_instance):
         patch("savethread.tempfile.NamedTemporaryFile"),
         patch("savethread.open", mock_open()),
         patch("savethread.img2pdf.convert", return_value=b"pdf_data"),
-        patch("savethread.ocrmypdf.api._pdf_to_hocr"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf") as mock_hocr_to_ocr_pdf,
-        patch("savethread._fix_pdf_metadata"),
+        patch("savethread._write_pdf") as mock_write_pdf,
         patch("savethread.os.remove"),
         patch("savethread._set_timestamp"),
         patch("savethread._post_save_hook"),
@@ -144,13 +169,14 @@ def test_save_pdf_with_hocr(mock_thread_instance, mock_page_instance):
     ):
         mock_thread_instance.do_save_pdf(request)
 
-        # Verify HOCR was exported/written
-        assert mock_page_instance.export_hocr.called
-        mock_hocr_to_ocr_pdf.assert_called()
+        text_layers = mock_write_pdf.call_args.args[1]
+        assert text_layers == [
+            _text_layer_content(TEXT_LAYER, (300, 300), 144)
+        ], "text layer rendered at the page height in points"
 
 
-def test_save_pdf_with_title_keeps_title(mock_thread_instance, mock_page_instance):
-    "Test save_pdf brands metadata but does not strip a provided title"
+def test_save_pdf_with_title(mock_thread_instance, mock_page_instance):
+    "Test save_pdf passes the title to the PDF writer"
     mock_thread_instance.mock_pages[1] = mock_page_instance
 
     options = {
@@ -166,71 +192,66 @@ def test_save_pdf_with_title_keeps_title(mock_thread_instance, mock_page_instanc
         patch("savethread.tempfile.TemporaryDirectory"),
         patch("savethread.tempfile.NamedTemporaryFile"),
         patch("savethread.open", mock_open()),
-        patch("savethread.img2pdf.convert", return_value=b"pdf_data"),
-        patch("savethread.ocrmypdf.api._pdf_to_hocr"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf"),
+        patch("savethread.img2pdf.convert", return_value=b"pdf_data") as mock_img2pdf,
         patch("savethread.os.remove"),
         patch("savethread._set_timestamp"),
         patch("savethread._post_save_hook"),
         patch("savethread.pathlib.Path"),
-        patch("savethread._fix_pdf_metadata") as mock_fix_metadata,
+        patch("savethread._write_pdf") as mock_write_pdf,
     ):
         mock_thread_instance.do_save_pdf(request)
 
-        mock_fix_metadata.assert_called_once_with("/tmp/output.pdf", False)
+        assert "title" not in mock_img2pdf.call_args.kwargs
+        assert mock_write_pdf.call_args.args[3]["title"] == "My Title"
 
 
-def test_save_pdf_hocr_error_fallback(mock_thread_instance, mock_page_instance):
-    "Test ocrmypdf failure falls back to saving without text layer"
-    mock_page_instance.text_layer = "some text layer data"
-    mock_thread_instance.mock_pages[1] = mock_page_instance
+def test_save_pdf_pages_in_order(mock_thread_instance):
+    "Test pages written in parallel are assembled in order"
+    for i in range(1, 6):
+        page = MagicMock(spec=Page)
+        page.get_resolution.return_value = (100 * i, 50 * i, "PixelsPerInch")
+        page.width = page.height = 100
+        mock_thread_instance.mock_pages[i] = page
 
     options = {
         "dir": "/tmp",
         "path": "/tmp/output.pdf",
-        "list_of_pages": [1],
+        "list_of_pages": [5, 3, 1, 2, 4],
         "metadata": {"datetime": datetime.datetime.now()},
         "options": {},
     }
     request = Request("save_pdf", (options,), mock_thread_instance.responses)
 
-    class _EmptyError(Exception):
-        "exception with empty str() like ocrmypdf errors"
+    written = {}
 
-        def __str__(self):
-            return ""
+    def write_pdf_page(page, page_pdf, resolution, *_args):
+        "finish the first pages last"
+        time.sleep((5 - int(page_pdf.stem[-1])) / 100)
+        written[page_pdf] = (page, resolution)
+        return page_pdf, 1, resolution
 
     with (
-        patch("savethread.tempfile.TemporaryDirectory"),
-        patch("savethread.tempfile.NamedTemporaryFile"),
-        patch("savethread.open", mock_open()),
-        patch("savethread.img2pdf.convert", return_value=b"pdf_data"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf", side_effect=_EmptyError()),
-        patch("savethread.os.remove"),
-        patch("savethread._fix_pdf_metadata") as mock_fix_metadata,
-        patch("savethread._append_pdf") as mock_append,
-        patch("savethread._post_save_hook") as mock_post_save,
-        patch("savethread.pathlib.Path"),
-        patch("savethread.shutil.copyfile") as mock_copyfile,
-        patch("savethread.logging.warning") as mock_warning,
+        patch("savethread.os.cpu_count", return_value=4),
+        patch("savethread._write_pdf_page", side_effect=write_pdf_page),
+        patch("savethread._write_pdf") as mock_write_pdf,
+        patch("savethread._set_timestamp"),
+        patch("savethread._post_save_hook"),
     ):
         mock_thread_instance.do_save_pdf(request)
 
-        # Should fall back to copying origin.pdf without error
-        mock_copyfile.assert_called_once()
-        mock_warning.assert_called_once()
-        assert "_EmptyError" in mock_warning.call_args[0][1]
-
-        # Subsequent pikepdf operations must be skipped on fallback
-        mock_fix_metadata.assert_not_called()
-        mock_append.assert_not_called()
-        mock_post_save.assert_called_once()
+        page_pdfs, text_layers = mock_write_pdf.call_args.args[:2]
+        assert [path.name for path in page_pdfs] == [
+            f"page-{i:06}.pdf" for i in range(1, 6)
+        ]
+        assert [written[path] for path in page_pdfs] == [
+            (mock_thread_instance.mock_pages[i], (100 * i, 50 * i))
+            for i in [5, 3, 1, 2, 4]
+        ]
+        assert text_layers == [(100 * i, 50 * i) for i in [5, 3, 1, 2, 4]]
 
 
-def test_save_pdf_metadata_fixup_failure_is_non_fatal(
-    mock_thread_instance, mock_page_instance
-):
-    "Test a metadata fixup failure warns but does not fail the save"
+def test_save_pdf_large_output(mock_thread_instance, mock_page_instance):
+    "Test save_pdf skips linearization for output exceeding 2 GiB"
     mock_thread_instance.mock_pages[1] = mock_page_instance
 
     options = {
@@ -243,64 +264,411 @@ def test_save_pdf_metadata_fixup_failure_is_non_fatal(
     request = Request("save_pdf", (options,), mock_thread_instance.responses)
 
     with (
-        patch("savethread.tempfile.TemporaryDirectory"),
+        patch("savethread.tempfile.TemporaryDirectory") as mock_tempdir,
         patch("savethread.tempfile.NamedTemporaryFile"),
         patch("savethread.open", mock_open()),
-        patch("savethread.img2pdf.convert", return_value=b"pdf_data"),
-        patch("savethread.ocrmypdf.api._pdf_to_hocr"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf"),
+        patch("savethread.img2pdf.convert"),
         patch("savethread.os.remove"),
+        patch("savethread._write_pdf") as mock_write_pdf,
         patch("savethread._set_timestamp"),
-        patch(
-            "savethread._fix_pdf_metadata",
-            side_effect=RuntimeError("no branding"),
-        ),
-        patch("savethread._post_save_hook") as mock_post_save,
+        patch("savethread._post_save_hook") as mock_post_save_hook,
         patch("savethread.pathlib.Path"),
-        patch("savethread.logging.warning") as mock_warning,
+        patch("savethread.os.path.getsize", return_value=_2GIB + 1),
     ):
+        mock_tempdir.return_value.__enter__.return_value = "/tmp/tempdir"
+
         mock_thread_instance.do_save_pdf(request)
 
-        mock_warning.assert_called_once()
-        assert "Could not fix PDF metadata" in str(mock_warning.call_args)
-        mock_post_save.assert_called_once()
+        assert not mock_write_pdf.call_args.kwargs["linearize"]
+        assert mock_post_save_hook.called
 
 
-def test_save_pdf_rejects_oversized_output(mock_thread_instance, mock_page_instance):
-    "Test save_pdf rejects output exceeding 2 GiB with RuntimeError"
-    mock_thread_instance.mock_pages[1] = mock_page_instance
+def test_text_layer_content():
+    "Test drawing a text layer as invisible text"
+    content = _text_layer_content(TEXT_LAYER, (72, 36), 1200)
+    assert content.decode("ascii") == (
+        "BT 3 Tr\n"
+        "60.00 /f-0-0 Tf 60.00 Tz 1 0 0 1 10.00 1100.00 Tm "
+        "<00480065006c006c006f> Tj\n"
+        "60.00 /f-0-0 Tf 166.67 Tz 1 0 0 1 100.00 1100.00 Tm <0020> Tj\n"
+        "60.00 /f-0-0 Tf 93.33 Tz 1 0 0 1 150.00 1100.00 Tm "
+        "<007700f60072006c0064> Tj\n"
+        "ET\n"
+    )
 
-    options = {
-        "dir": "/tmp",
-        "path": "/tmp/output.pdf",
-        "list_of_pages": [1],
-        "metadata": {"datetime": datetime.datetime.now()},
-        "options": {},
-    }
-    request = Request("save_pdf", (options,), mock_thread_instance.responses)
+    # text without word positions is divided between the lines of its box
+    content = _text_layer_content(
+        '[{"bbox": [0, 0, 100, 40], "type": "page", "text": "a\\nb", "depth": 0}]',
+        (72, 72),
+        40,
+    )
+    assert content.decode("ascii") == (
+        "BT 3 Tr\n"
+        "20.00 /f-0-0 Tf 1000.00 Tz 1 0 0 1 0.00 20.00 Tm <0061> Tj\n"
+        "20.00 /f-0-0 Tf 1000.00 Tz 1 0 0 1 0.00 0.00 Tm <0062> Tj\n"
+        "ET\n"
+    )
 
-    with (
-        patch("savethread.tempfile.TemporaryDirectory") as mock_tempdir,
-        patch("savethread.tempfile.NamedTemporaryFile"),
-        patch("savethread.open", mock_open()),
-        patch("savethread.img2pdf.convert", return_value=b"pdf_data"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf"),
-        patch("savethread.os.remove") as mock_remove,
-        patch("savethread._fix_pdf_metadata"),
-        patch("savethread._post_save_hook"),
-        patch("savethread.pathlib.Path"),
-        patch(
-            "savethread._estimate_page_pdf_size",
-            return_value=_2GIB + 1,
+    assert (
+        _text_layer_content('[{"bbox": [0, 0, 1, 1], "type": "page"}]', (72, 72), 1)
+        is None
+    )
+
+
+def test_write_pdf(tmp_path):
+    "Test concatenating single-page PDFs in rounds, with text layers and metadata"
+    filenames = []
+    for i, size in enumerate([10, 20, 30, 40, 50], start=1):
+        png = tmp_path / f"{i}.png"
+        Image.new("L", (size, size)).save(png)
+        filenames.append(tmp_path / f"page-{i}.pdf")
+        with open(filenames[-1], "wb") as fhd:
+            img2pdf.convert(
+                str(png), layout_fun=_layout_fun(size, size * 2), outputstream=fhd
+            )
+    text_layers = [None, b"BT 3 Tr ET\n", None, None, b"BT 3 Tr ET\n"]
+    metadata = prepare_output_metadata(
+        "PDF",
+        {
+            "datetime": datetime.datetime(2016, 2, 10, tzinfo=datetime.timezone.utc),
+            "title": "Title",
+        },
+    )
+
+    with patch("savethread._MAX_OPEN_PDFS", 2):
+        _write_pdf(filenames, text_layers, tmp_path / "output.pdf", metadata, pdfa=True)
+
+    with pikepdf.open(tmp_path / "output.pdf") as pdf:
+        assert [page.mediabox[2:] for page in pdf.pages] == [
+            [size, size * 2] for size in [10, 20, 30, 40, 50]
+        ]
+        fonts = [
+            "/Font" in page.Resources and "/f-0-0" in page.Resources.Font
+            for page in pdf.pages
+        ]
+        assert fonts == [False, True, False, False, True]
+        font = pdf.pages[1].Resources.Font["/f-0-0"]
+        assert font.Subtype == "/Type0"
+        assert "/FontFile2" in font.DescendantFonts[0].FontDescriptor
+        assert pdf.pages[4].Contents[-1].read_bytes() == b"BT 3 Tr ET\n"
+        assert str(pdf.docinfo["/Title"]) == "Title"
+        assert str(pdf.docinfo["/CreationDate"]).startswith("D:20160210000000")
+        assert str(pdf.docinfo["/Creator"]).startswith("scantpaper v")
+        assert pdf.is_linearized
+    assert_pdfa_2b(tmp_path / "output.pdf")
+    assert sorted(path.name for path in tmp_path.glob("*.pdf")) == [
+        "output.pdf",
+        *[path.name for path in filenames],
+    ], "the pages are kept and the merged files removed"
+
+    # PDF/A identification is only added on request
+    _write_pdf(filenames[:1], [None], tmp_path / "plain.pdf", metadata)
+    assert_not_pdfa(tmp_path / "plain.pdf")
+
+
+def test_write_pdf_page_cache(tmp_path):
+    "Test that unchanged pages are taken from the cache"
+
+    def stored_page(colour):
+        "return a page as it is read from the database"
+        blob = io.BytesIO()
+        Image.new("L", (100, 200), colour).save(blob, format="PNG")
+        return Page.from_bytes(blob.getvalue(), resolution=(100, 100, "PixelsPerInch"))
+
+    page = stored_page(0)
+    options = {"dir": tmp_path, "options": {}}
+    cache_dir = _pdf_cache_dir(options)
+
+    page_pdf, size, text_layer = _write_pdf_page(
+        page, tmp_path / "page-1.pdf", (100, 100), options, cache_dir
+    )
+    assert page_pdf.parent == cache_dir
+    assert size == os.path.getsize(page_pdf)
+    assert text_layer is None
+    assert not (tmp_path / "page-1.pdf").exists()
+
+    with patch("savethread.img2pdf.convert") as mock_img2pdf:
+        cached = _write_pdf_page(
+            stored_page(0), tmp_path / "page-2.pdf", (100, 100), options, cache_dir
+        )
+        mock_img2pdf.assert_not_called()
+    # ... with the same size as when the page was first written
+    assert cached == (page_pdf, size, None)
+
+    # a different page size, option or image is encoded again
+    downsample = {
+        "dir": tmp_path,
+        "options": {"downsample": True, "downsample dpi": 50},
+    }
+    other = [
+        _write_pdf_page(page, tmp_path / "page-3.pdf", (50, 50), options, cache_dir),
+        _write_pdf_page(
+            page, tmp_path / "page-4.pdf", (100, 100), downsample, cache_dir
         ),
-    ):
-        mock_tempdir.return_value.__enter__.return_value = "/tmp/tempdir"
+        _write_pdf_page(
+            stored_page(255), tmp_path / "page-5.pdf", (100, 100), options, cache_dir
+        ),
+    ]
+    assert len({page_pdf, *[result[0] for result in other]}) == 4
 
-        with pytest.raises(RuntimeError, match="2\\.0 GiB"):
-            mock_thread_instance.do_save_pdf(request)
+    _prune_pdf_cache(cache_dir, [page_pdf])
+    assert list(cache_dir.iterdir()) == [page_pdf]
 
-        # Temp files must be cleaned up before the error is raised
-        assert mock_remove.called
+
+def test_write_pdf_page_ccitt(tmp_path):
+    "Test that bilevel pages are embedded as CCITT G4"
+    blob = io.BytesIO()
+    image = Image.new("1", (200, 100), 1)
+    image.paste(0, (20, 20, 80, 60))
+    image.save(blob, format="PNG")
+    page = Page.from_bytes(blob.getvalue(), resolution=(100, 100, "PixelsPerInch"))
+
+    page_pdf, size, _text_layer = _write_pdf_page(
+        page, tmp_path / "page-1.pdf", (100, 100), {"options": {}}
+    )
+    with pikepdf.open(page_pdf) as pdf:
+        (xobject,) = pdf.pages[0].Resources.XObject.values()
+        assert xobject.Filter == [pikepdf.Name.CCITTFaxDecode]
+        assert len(xobject.read_raw_bytes()) <= size < image.width * image.height // 8
+        assert pikepdf.PdfImage(xobject).as_pil_image().tobytes() == image.tobytes()
+
+    page_pdf, _size, _text_layer = _write_pdf_page(
+        page, tmp_path / "page-2.pdf", (100, 100), {"options": {"compression": "png"}}
+    )
+    with pikepdf.open(page_pdf) as pdf:
+        (xobject,) = pdf.pages[0].Resources.XObject.values()
+        assert xobject.Filter == pikepdf.Name.FlateDecode
+
+
+def test_write_pdf_page_mrc(tmp_path):
+    "Test that colour pages are written as MRC, and bilevel pages as CCITT G4"
+    options = {"options": {"compression": "mrc", "quality": 50}}
+    image = Image.new("RGB", (300, 300), "beige")
+    image.paste((0, 0, 0), (50, 50, 55, 100))
+    page = Page(image_object=image, resolution=(300, 300, "PixelsPerInch"))
+    page.get_size()
+    page_pdf, size, _text_layer = _write_pdf_page(
+        page, tmp_path / "page-1.pdf", (300, 300), options
+    )
+    assert size == os.path.getsize(page_pdf)
+    with pikepdf.open(page_pdf) as pdf:
+        xobjects = pdf.pages[0].Resources.XObject
+        assert xobjects.Im0.Filter == pikepdf.Name.DCTDecode
+        assert xobjects.Im1.Filter == pikepdf.Name.CCITTFaxDecode
+
+    page = Page(image_object=Image.new("1", (300, 300)))
+    page.resolution = (300, 300, "PixelsPerInch")
+    page.get_size()
+    page_pdf, _size, _text_layer = _write_pdf_page(
+        page, tmp_path / "page-2.pdf", (300, 300), options
+    )
+    with pikepdf.open(page_pdf) as pdf:
+        (xobject,) = pdf.pages[0].Resources.XObject.values()
+        assert xobject.Filter == [pikepdf.Name.CCITTFaxDecode]
+
+
+def test_write_pdf_page_mrc_cache(tmp_path):
+    "Test that MRC pages are encoded again if only their text layer has changed"
+    options = {"dir": tmp_path, "options": {"compression": "mrc"}}
+    cache_dir = _pdf_cache_dir(options)
+    blob = io.BytesIO()
+    image = Image.new("RGB", (300, 300), "beige")
+    image.paste((0, 0, 0), (50, 50, 55, 100))
+    image.save(blob, format="PNG")
+
+    def write(text_layer, i):
+        page = Page.from_bytes(
+            blob.getvalue(),
+            resolution=(300, 300, "PixelsPerInch"),
+            text_layer=text_layer,
+        )
+        return _write_pdf_page(
+            page, tmp_path / f"page-{i}.pdf", (300, 300), options, cache_dir
+        )[0]
+
+    page_pdf = write(None, 1)
+    assert write(None, 2) == page_pdf
+    with patch("savethread.mrc.write_pdf_page", wraps=mrc.write_pdf_page) as mock:
+        assert write(TEXT_LAYER, 3) != page_pdf
+        mock.assert_called_once()
+
+
+def test_proxy():
+    "Test that the proxy is made of full-resolution bands spread down the page"
+    image = Image.linear_gradient("L").resize((2480, 3508))
+    proxy, fraction = _proxy(image)
+    assert proxy.width == 2480
+    assert proxy.height % 16 == 0
+    assert proxy.width * proxy.height <= 2000000
+    assert fraction == proxy.height / 3508
+    assert proxy.getpixel((0, 0)) > 0, "first band not at the top"
+    assert proxy.getpixel((0, proxy.height - 1)) < 255, "last band not at bottom"
+
+    image = Image.new("RGB", (100, 100))
+    assert _proxy(image) == (image, 1), "small images used as they are"
+
+
+def test_estimate_size(mock_thread_instance):
+    "Test estimating the size of a save from a sample of the pages"
+    image = Image.new("RGB", (2480, 3508), "white")
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(1)
+    for _i in range(5000):
+        x, y = rng.randrange(200, 2200), rng.randrange(200, 3300)
+        colour = tuple(rng.randrange(128) for _j in range(3))
+        draw.rectangle((x, y, x + rng.randrange(10, 80), y + 30), fill=colour)
+    page = Page(image_object=image, resolution=(300, 300, "PixelsPerInch"))
+    page.get_size()
+    mock_thread_instance.mock_pages = {i: page for i in range(12)}
+    options = {
+        "format": "pdf",
+        "list_of_pages": list(range(12)),
+        "options": {"compression": "jpg", "quality": 50},
+    }
+    request = Request("estimate_size", (options,), mock_thread_instance.responses)
+    with patch.object(
+        mock_thread_instance, "get_page", wraps=mock_thread_instance.get_page
+    ) as get_page:
+        size = mock_thread_instance.do_estimate_size(request)
+    assert get_page.call_count == 5, "only a sample of the pages encoded"
+
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=50)
+    assert 0.8 < size / (12 * len(buf.getvalue())) < 1.25
+
+    options["format"] = "tif"
+    options["options"] = {"compression": "g4"}
+    size = mock_thread_instance.do_estimate_size(request)
+    buf = io.BytesIO()
+    frame, _dpi = page.tiff_frame(options)
+    frame.save(buf, format="TIFF", compression="group4")
+    assert 0.8 < size / (12 * len(buf.getvalue())) < 1.25
+
+    options["format"] = "txt"
+    assert mock_thread_instance.do_estimate_size(request) is None
+    options["format"] = "pdf"
+    options["list_of_pages"] = []
+    assert mock_thread_instance.do_estimate_size(request) == 0
+
+
+def assert_pdfa_2b(path):
+    """check the parts of PDF/A-2B that the save sets up, and, if veraPDF is
+    installed, validate the PDF with it"""
+    with pikepdf.open(path) as pdf:
+        assert not pdf.is_encrypted
+        assert "/ID" in pdf.trailer
+        with pdf.open_metadata() as metadata:
+            assert metadata["pdfaid:part"] == "2"
+            assert metadata["pdfaid:conformance"] == "B"
+            assert metadata["xmp:CreatorTool"] == str(pdf.docinfo["/Creator"])
+            if "/Title" in pdf.docinfo:
+                assert metadata["dc:title"] == str(pdf.docinfo["/Title"])
+        (intent,) = pdf.Root.OutputIntents
+        assert intent.S == "/GTS_PDFA1"
+        profile = ImageCms.ImageCmsProfile(
+            io.BytesIO(intent.DestOutputProfile.read_bytes())
+        )
+        assert profile.profile.xcolor_space.strip() == "RGB"
+        assert intent.DestOutputProfile.N == 3
+        for page in pdf.pages:
+            for image in page.Resources.get("/XObject", {}).values():
+                assert image.get("/ColorSpace") != pikepdf.Name.DeviceCMYK
+                assert not image.get("/Interpolate", False)
+            for font in page.Resources.get("/Font", {}).values():
+                for descendant in font.get("/DescendantFonts", [font]):
+                    assert "/FontFile2" in descendant.FontDescriptor
+    if shutil.which("verapdf"):
+        proc = subprocess.run(
+            ["verapdf", "--flavour", "2b", str(path)],
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        assert 'isCompliant="true"' in proc.stdout, proc.stdout
+
+
+def assert_not_pdfa(path, password=""):
+    "check that the PDF does not claim to be PDF/A"
+    with pikepdf.open(path, password=password) as pdf:
+        with pdf.open_metadata() as metadata:
+            assert "pdfaid:part" not in metadata
+        assert "/OutputIntents" not in pdf.Root
+        assert str(pdf.docinfo["/Creator"]).startswith("scantpaper v")
+
+
+def test_write_pdf_cmyk(tmp_path):
+    "Test that PDFs with CMYK images are not identified as PDF/A"
+    jpeg = tmp_path / "cmyk.jpg"
+    Image.new("CMYK", (20, 20), (0, 50, 100, 0)).save(jpeg)
+    page_pdf = tmp_path / "page.pdf"
+    with open(page_pdf, "wb") as fhd:
+        img2pdf.convert(str(jpeg), layout_fun=_layout_fun(20, 20), outputstream=fhd)
+    _write_pdf([page_pdf], [None], tmp_path / "out.pdf", pdfa=True)
+    assert_not_pdfa(tmp_path / "out.pdf")
+
+
+def write_pages(tmp_path, sizes):
+    "return single-page PDFs of the given sizes"
+    filenames = []
+    for size in sizes:
+        png = tmp_path / f"{size}.png"
+        Image.new("L", (size, size)).save(png)
+        filenames.append(tmp_path / f"page-{size}.pdf")
+        with open(filenames[-1], "wb") as fhd:
+            img2pdf.convert(
+                str(png), layout_fun=_layout_fun(size, size), outputstream=fhd
+            )
+    return filenames
+
+
+def test_write_pdf_prepend_append(tmp_path):
+    "Test prepending and appending pages to an existing PDF in the same save"
+    existing = tmp_path / "existing.pdf"
+    with pikepdf.new() as pdf:
+        pdf.add_blank_page(page_size=(10, 10))
+        pdf.docinfo["/Title"] = "Existing"
+        pdf.save(existing)
+    metadata = {"title": "New"}
+
+    _write_pdf(write_pages(tmp_path, [20]), [None], existing, metadata, append=existing)
+    with pikepdf.open(existing) as pdf:
+        assert [page.mediabox[2] for page in pdf.pages] == [10, 20]
+        assert str(pdf.docinfo["/Title"]) == "Existing", "metadata of first PDF"
+
+    _write_pdf(
+        write_pages(tmp_path, [30]),
+        [None],
+        existing,
+        metadata,
+        prepend=existing,
+        pdfa=True,
+    )
+    with pikepdf.open(existing) as pdf:
+        assert [page.mediabox[2] for page in pdf.pages] == [30, 10, 20]
+        assert str(pdf.docinfo["/Title"]) == "New", "metadata of first PDF"
+    assert_not_pdfa(existing)
+    assert sorted(path.name for path in tmp_path.glob("*.pdf")) == [
+        "existing.pdf",
+        "page-20.pdf",
+        "page-30.pdf",
+    ], "no temporary files left"
+
+
+def test_write_pdf_encrypted(tmp_path):
+    "Test encrypting the PDF as it is written"
+    _write_pdf(
+        write_pages(tmp_path, [20]),
+        [None],
+        tmp_path / "out.pdf",
+        password="123",
+        pdfa=True,
+    )
+    with pytest.raises(pikepdf.PasswordError):
+        pikepdf.open(tmp_path / "out.pdf")
+    with pikepdf.open(tmp_path / "out.pdf", password="123") as pdf:
+        assert pdf.encryption.R == 6, "AES-256"
+        assert len(pdf.pages) == 1
+    assert_not_pdfa(tmp_path / "out.pdf", password="123")
 
 
 def test_save_djvu(mock_thread_instance, mock_page_instance):
@@ -317,14 +685,11 @@ def test_save_djvu(mock_thread_instance, mock_page_instance):
     request = Request("save_djvu", (options,), mock_thread_instance.responses)
 
     with (
-        patch("savethread.tempfile.NamedTemporaryFile") as mock_temp,
         patch("savethread.exec_command") as mock_exec,
-        patch("savethread.os.remove"),
         patch("savethread._set_timestamp"),
         patch("savethread._post_save_hook"),
         patch("savethread.subprocess.run") as mock_run,
     ):
-        mock_temp.return_value.__enter__.return_value.name = "/tmp/temp.djvu"
         mock_exec.return_value.returncode = 0
 
         mock_thread_instance.do_save_djvu(request)
@@ -339,6 +704,63 @@ def test_save_djvu(mock_thread_instance, mock_page_instance):
         assert "djvused" in mock_run.call_args[0][0]
 
 
+def test_save_djvu_layers(mock_thread_instance, tmp_path):
+    "Test that pages are merged in order and their layers set in one djvused run"
+    pages = []
+    for i in range(1, 6):
+        page = MagicMock(spec=Page)
+        page.djvused_layers.return_value = f"set-txt\n(page {i})\n.\n" if i % 2 else ""
+        mock_thread_instance.mock_pages[i] = page
+        pages.append(page)
+    options = {
+        "dir": str(tmp_path),
+        "path": str(tmp_path / "output.djvu"),
+        "list_of_pages": [1, 2, 3, 4, 5],
+        "options": {},
+        "pidfile": None,
+    }
+    request = Request("save_djvu", (options,), mock_thread_instance.responses)
+
+    scripts = []
+
+    def run(cmd, **_kwargs):
+        with open(cmd[cmd.index("-f") + 1], encoding="utf-8") as fhd:
+            scripts.append(fhd.read())
+
+    with (
+        patch("savethread.exec_command") as mock_exec,
+        patch("savethread._set_timestamp"),
+        patch("savethread._post_save_hook"),
+        patch("savethread.subprocess.run", side_effect=run),
+    ):
+        mock_exec.return_value.returncode = 0
+        mock_thread_instance.do_save_djvu(request)
+
+    filelist = mock_exec.call_args[0][0][3:]
+    assert [os.path.basename(name) for name in filelist] == [
+        f"page-{i:06}.djvu" for i in range(1, 6)
+    ]
+    for page, name in zip(pages, filelist):
+        page.write_image_for_djvu.assert_called_once_with(name, options)
+    assert scripts == [
+        "select 1\nset-txt\n(page 1)\n.\n"
+        "select 3\nset-txt\n(page 3)\n.\n"
+        "select 5\nset-txt\n(page 5)\n.\n"
+    ]
+
+
+def test_djvused_script():
+    "Test the metadata part of the djvused script"
+    script = _djvused_script(
+        ["", ""],
+        {"datetime": datetime.datetime(2024, 1, 2, 3, 4, 5), "title": 'a "b" \\c'},
+    )
+    assert script.startswith("select\nset-meta\n(metadata\n")
+    assert 'title "a \\"b\\" \\\\c"\n' in script
+    assert script.endswith(")\n.\n")
+    assert _djvused_script(["", ""], None) == ""
+
+
 def test_save_djvu_failure(mock_thread_instance, mock_page_instance):
     "Test save_djvu method with merging failure"
     mock_thread_instance.mock_pages[1] = mock_page_instance
@@ -353,14 +775,12 @@ def test_save_djvu_failure(mock_thread_instance, mock_page_instance):
     request = Request("save_djvu", (options,), mock_thread_instance.responses)
 
     with (
-        patch("savethread.tempfile.NamedTemporaryFile") as mock_temp,
         patch("savethread.exec_command") as mock_exec,
-        patch("savethread.os.remove"),
-        patch("savethread._set_timestamp"),
-        patch("savethread._post_save_hook"),
-        patch("savethread.subprocess.run"),
+        patch("savethread._set_timestamp") as mock_timestamp,
+        patch("savethread._post_save_hook") as mock_hook,
+        patch("savethread.subprocess.run") as mock_run,
+        patch.object(mock_thread_instance, "do_set_saved") as mock_set_saved,
     ):
-        mock_temp.return_value.__enter__.return_value.name = "/tmp/temp.djvu"
         mock_exec.return_value.returncode = 1
 
         mock_thread_instance.do_save_djvu(request)
@@ -370,42 +790,74 @@ def test_save_djvu_failure(mock_thread_instance, mock_page_instance):
         args, _ = mock_thread_instance.responses.put.call_args
         assert args[0].type.name == "ERROR"
 
+        # ... and that the save stopped there
+        mock_run.assert_not_called()
+        mock_timestamp.assert_not_called()
+        mock_hook.assert_not_called()
+        mock_set_saved.assert_not_called()
+
 
-def test_save_tiff(mock_thread_instance, mock_page_instance):
+def test_save_tiff(mock_thread_instance, mock_page_instance, tmp_path):
     "Test save_tiff method"
     mock_thread_instance.mock_pages[1] = mock_page_instance
+    page2 = MagicMock(spec=Page)
+    page2.tiff_frame.return_value = (Image.new("L", (40, 10)), (150, 100))
+    mock_thread_instance.mock_pages[2] = page2
     options = {
-        "dir": "/tmp",
-        "path": "/tmp/output.tif",
-        "list_of_pages": [1],
+        "dir": str(tmp_path),
+        "path": str(tmp_path / "output.tif"),
+        "list_of_pages": [1, 2],
         "options": {"compression": "jpeg", "quality": 75},
         "pidfile": "pidfile",
     }
     request = Request("save_tiff", (options,), mock_thread_instance.responses)
 
     with (
-        patch("savethread.tempfile.NamedTemporaryFile") as mock_temp,
         patch("savethread.subprocess.run") as mock_run,
-        patch("savethread.os.remove"),
         patch("savethread._post_save_hook"),
     ):
-        mock_temp.return_value.__enter__.return_value.name = "/tmp/temp.tif"
-
         mock_thread_instance.do_save_tiff(request)
-
-        assert mock_page_instance.write_image_for_tiff.called
-        assert mock_run.called
-        assert "tiffcp" in mock_run.call_args[0][0]
-        assert "-c" in mock_run.call_args[0][0]
-        assert "jpeg:75" in mock_run.call_args[0][0]
+        assert not mock_run.called
+
+    mock_page_instance.tiff_frame.assert_called_once_with(options)
+    with Image.open(options["path"]) as img:
+        assert img.n_frames == 2
+        assert (img.size, img.mode, img.info["compression"]) == (
+            (30, 20),
+            "RGB",
+            "jpeg",
+        )
+        assert img.info["dpi"] == (300, 300)
+        img.seek(1)
+        assert (img.size, img.mode) == ((40, 10), "L")
+        assert img.info["dpi"] == (150, 100)
+    assert os.listdir(tmp_path) == ["output.tif"], "no intermediate files"
+
+
+def test_save_tiff_cancel(mock_thread_instance, mock_page_instance, tmp_path):
+    "Test that a cancelled save_tiff leaves no partial file behind"
+    mock_thread_instance.mock_pages[1] = mock_page_instance
+    options = {
+        "path": str(tmp_path / "output.tif"),
+        "list_of_pages": [1, 1],
+        "options": {"compression": "lzw"},
+        "pidfile": "pidfile",
+    }
+    request = Request("save_tiff", (options,), mock_thread_instance.responses)
+    with patch.object(
+        mock_thread_instance, "check_cancelled", side_effect=CancelledError
+    ):
+        with pytest.raises(CancelledError):
+            mock_thread_instance.do_save_tiff(request)
+    assert not os.listdir(tmp_path)
 
 
-def test_save_tiff_ps(mock_thread_instance, mock_page_instance):
+def test_save_tiff_ps(mock_thread_instance, mock_page_instance, tmp_path):
     "Test save_tiff method to PS"
     mock_thread_instance.mock_pages[1] = mock_page_instance
     options = {
         "dir": "/tmp",
-        "path": "/tmp/output.tif",
+        "path": str(tmp_path / "output.tif"),
         "list_of_pages": [1],
         "options": {"ps": "/tmp/output.ps"},
         "pidfile": "pidfile",
@@ -413,10 +865,7 @@ def test_save_tiff_ps(mock_thread_instance, mock_page_instance):
     request = Request("save_tiff", (options,), mock_thread_instance.responses)
 
     with (
-        patch("savethread.tempfile.NamedTemporaryFile"),
-        patch("savethread.subprocess.run"),
         patch("savethread.exec_command") as mock_exec,
-        patch("savethread.os.remove"),
         patch("savethread._post_save_hook"),
     ):
         mock_exec.return_value.returncode = 0
@@ -428,12 +877,12 @@ def test_save_tiff_ps(mock_thread_instance, mock_page_instance):
         assert "tiff2ps" in mock_exec.call_args[0][0]
 
 
-def test_save_tiff_ps_failure(mock_thread_instance, mock_page_instance):
+def test_save_tiff_ps_failure(mock_thread_instance, mock_page_instance, tmp_path):
     "Test save_tiff method to PS with failure"
     mock_thread_instance.mock_pages[1] = mock_page_instance
     options = {
         "dir": "/tmp",
-        "path": "/tmp/output.tif",
+        "path": str(tmp_path / "output.tif"),
         "list_of_pages": [1],
         "options": {"ps": "/tmp/output.ps"},
         "pidfile": "pidfile",
@@ -441,10 +890,7 @@ def test_save_tiff_ps_failure(mock_thread_instance, mock_page_instance):
     request = Request("save_tiff", (options,), mock_thread_instance.responses)
 
     with (
-        patch("savethread.tempfile.NamedTemporaryFile"),
-        patch("savethread.subprocess.run"),
         patch("savethread.exec_command") as mock_exec,
-        patch("savethread.os.remove"),
         patch("savethread._post_save_hook"),
     ):
         mock_exec.return_value.returncode = 1
@@ -526,6 +972,174 @@ def test_save_hocr(mock_thread_instance, mock_page_instance):
         mock_file().write.assert_called()
 
 
+def multiple_pages(mock_thread_instance, npages):
+    "return mocked pages, counting the fetches of each"
+    fetched = []
+    pages = {}
+    for i in range(1, npages + 1):
+        page = MagicMock(spec=Page)
+        page.export_text.return_value = f"Page {i}\n"
+        page.export_hocr.return_value = (
+            f"<html><body><div class='ocr_page'>{i}</div></body></html>"
+        )
+        page.image_object = MagicMock()
+        pages[i] = page
+
+    def get_page(**kwargs):
+        fetched.append(kwargs["id"])
+        return pages[kwargs["id"]]
+
+    mock_thread_instance.get_page = get_page
+    return pages, fetched
+
+
+def test_save_multiple(mock_thread_instance, tmp_path):
+    "Test saving several formats, fetching and decoding each page once"
+    pages, fetched = multiple_pages(mock_thread_instance, 5)
+    options = {
+        "list_of_pages": [1, 2, 3, 4, 5],
+        "targets": [
+            {"format": "text", "path": str(tmp_path / "output.txt")},
+            {"format": "hocr", "path": str(tmp_path / "output.hocr")},
+            {
+                "format": "image",
+                "path": str(tmp_path / "output-%d.png"),
+                "options": {},
+            },
+        ],
+    }
+    request = Request("save_multiple", (options,), mock_thread_instance.responses)
+    with patch("savethread._post_save_hook") as mock_hook:
+        mock_thread_instance.do_save_multiple(request)
+
+    assert fetched == [1, 2, 3, 4, 5]
+    for i, page in pages.items():
+        page.image_object.load.assert_called_once_with()
+        page.image_object.save.assert_called_once_with(
+            str(tmp_path / f"output-{i}.png")
+        )
+    assert (tmp_path / "output.txt").read_text(encoding="utf-8") == "".join(
+        f"Page {i}\n" for i in range(1, 6)
+    )
+    hocr = (tmp_path / "output.hocr").read_text(encoding="utf-8")
+    assert hocr.count("<body>") == 1
+    assert hocr.index(">1<") < hocr.index(">5<")
+    mock_hook.assert_any_call(str(tmp_path / "output.txt"), None)
+    mock_hook.assert_any_call(str(tmp_path / "output-5.png"), {})
+
+    progress = [
+        call.args[0].info
+        for call in mock_thread_instance.responses.put.call_args_list
+        if isinstance(call.args[0].info, float)
+    ]
+    assert progress == sorted(progress)
+    assert progress[-1] == 1.0
+
+
+def test_save_multiple_pdfs(tmp_path):
+    """Test saving two PDFs with different options at once, only pruning the
+    page cache once both have been written"""
+    thread = MockSaveThread()
+    blob = io.BytesIO()
+    Image.new("RGB", (100, 100), "beige").save(blob, format="PNG")
+    for i in (1, 2):
+        thread.mock_pages[i] = Page.from_bytes(
+            blob.getvalue(), id=i, resolution=(100, 100, "PixelsPerInch")
+        )
+    options = {
+        "dir": str(tmp_path),
+        "list_of_pages": [1, 2],
+        "pidfile": None,
+        "targets": [
+            {
+                "format": "pdf",
+                "path": str(tmp_path / f"{name}.pdf"),
+                "options": {"compression": compression},
+            }
+            for name, compression in (("a", "png"), ("b", "jpg"))
+        ],
+    }
+    request = Request("save_multiple", (options,), thread.responses)
+
+    pruned = threading.Event()
+
+    def prune(cache_dir, page_pdfs):
+        _prune_pdf_cache(cache_dir, page_pdfs)
+        pruned.set()
+
+    def write_pdf(filenames, *args, **kwargs):
+        # give a target that finishes first the chance to prune the cache
+        if args[1].endswith("b.pdf"):
+            pruned.wait(0.5)
+        _write_pdf(filenames, *args, **kwargs)
+
+    with (
+        patch("savethread._prune_pdf_cache", side_effect=prune) as mock_prune,
+        patch("savethread._write_pdf", side_effect=write_pdf),
+        patch("savethread._post_save_hook"),
+    ):
+        thread.do_save_multiple(request)
+
+    mock_prune.assert_called_once()
+    for name in ("a", "b"):
+        with pikepdf.open(tmp_path / f"{name}.pdf") as pdf:
+            assert len(pdf.pages) == 2
+    assert len(list((tmp_path / "pdf-cache").iterdir())) == 2
+
+
+def test_save_multiple_text_only(mock_thread_instance, tmp_path):
+    "Test that the images are not decoded for text formats"
+    pages, _fetched = multiple_pages(mock_thread_instance, 2)
+    options = {
+        "list_of_pages": [1, 2],
+        "targets": [
+            {"format": "text", "path": str(tmp_path / "output.txt")},
+            {"format": "hocr", "path": str(tmp_path / "output.hocr")},
+        ],
+    }
+    request = Request("save_multiple", (options,), mock_thread_instance.responses)
+    with patch("savethread._post_save_hook"):
+        mock_thread_instance.do_save_multiple(request)
+    for page in pages.values():
+        page.image_object.load.assert_not_called()
+
+
+def test_save_multiple_writer_failure(mock_thread_instance, tmp_path):
+    "Test that a failing writer neither holds up the others nor hangs the save"
+    pages, _fetched = multiple_pages(mock_thread_instance, 5)
+    pages[1].image_object.save.side_effect = OSError("disk full")
+    options = {
+        "list_of_pages": [1, 2, 3, 4, 5],
+        "targets": [
+            {"format": "image", "path": str(tmp_path / "output-%d.png")},
+            {"format": "text", "path": str(tmp_path / "output.txt")},
+        ],
+    }
+    request = Request("save_multiple", (options,), mock_thread_instance.responses)
+    with patch("savethread._post_save_hook"), pytest.raises(OSError):
+        mock_thread_instance.do_save_multiple(request)
+    assert (tmp_path / "output.txt").read_text(encoding="utf-8").count("Page") == 5
+
+
+def test_save_multiple_cancel(mock_thread_instance, tmp_path):
+    "Test that cancelling a save of several formats stops all the writers"
+    multiple_pages(mock_thread_instance, 5)
+    options = {
+        "list_of_pages": [1, 2, 3, 4, 5],
+        "targets": [
+            {"format": "text", "path": str(tmp_path / "output.txt")},
+            {"format": "hocr", "path": str(tmp_path / "output.hocr")},
+        ],
+    }
+    request = Request("save_multiple", (options,), mock_thread_instance.responses)
+    mock_thread_instance.cancel = True
+    with patch("savethread._post_save_hook") as mock_hook:
+        with pytest.raises(CancelledError):
+            mock_thread_instance.do_save_multiple(request)
+    mock_hook.assert_not_called()
+    assert not (tmp_path / "output.txt").exists()
+
+
 def test_user_defined(mock_thread_instance, mock_page_instance):
     "Test user_defined method"
     mock_thread_instance.mock_pages[1] = mock_page_instance
@@ -645,35 +1259,6 @@ def test_post_save_hook():
         assert "/tmp/file" in mock_run.call_args[0][0]
 
 
-def test_encrypt_pdf():
-    "Test _encrypt_pdf function"
-    request = MagicMock()
-    with patch("savethread.subprocess.run") as mock_run:
-        mock_run.return_value.returncode = 0
-        options = {"path": "/tmp/output.pdf", "options": {"user-password": "password"}}
-        ret = _encrypt_pdf("/tmp/input.pdf", options, request)
-        assert ret == 0
-        assert mock_run.called
-        cmd = mock_run.call_args[0][0]
-        assert "qpdf" in cmd
-        assert "--user-password=password" in cmd
-
-
-def test_encrypt_pdf_failure():
-    "Test _encrypt_pdf function when qpdf fails"
-    request = MagicMock()
-    options = {"path": "/tmp/output.pdf", "options": {"user-password": "password"}}
-    mock_spo = MagicMock()
-    mock_spo.returncode = 1
-    mock_spo.stderr = "qpdf error"
-    with patch("savethread.subprocess.run", return_value=mock_spo):
-        ret = _encrypt_pdf("/tmp/input.pdf", options, request)
-        assert ret == 1
-        assert request.error.called
-        args, _ = request.error.call_args
-        assert "qpdf error" in args[0]
-
-
 def test_prepare_output_metadata():
     "Test prepare_output_metadata function"
     metadata = {
@@ -705,21 +1290,20 @@ def test_save_pdf_prepend(mock_thread_instance, mock_page_instance):
         patch("savethread.tempfile.NamedTemporaryFile"),
         patch("savethread.open", mock_open()),
         patch("savethread.img2pdf.convert", return_value=b"pdf"),
-        patch("savethread.ocrmypdf.api._pdf_to_hocr"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf"),
-        patch("savethread._fix_pdf_metadata"),
+        patch("savethread._write_pdf") as mock_write_pdf,
         patch("savethread.os.remove"),
-        patch("savethread.os.rename") as mock_rename,
+        patch("savethread.os.path.getsize", return_value=1000),
         patch("savethread.exec_command") as mock_exec,
         patch("savethread._post_save_hook"),
         patch("savethread.pathlib.Path"),
     ):
-        mock_exec.return_value.returncode = 0
         mock_thread_instance.do_save_pdf(request)
 
-        assert mock_rename.called
-        assert mock_exec.called
-        assert "pdfunite" in mock_exec.call_args[0][0]
+        assert not mock_exec.called, "no pdfunite"
+        args, kwargs = mock_write_pdf.call_args
+        assert args[2] == "/tmp/output.pdf", "written directly"
+        assert kwargs["prepend"] == "/tmp/existing.pdf"
+        assert kwargs["append"] is None
 
 
 def test_add_annotations_to_pdf():
@@ -764,22 +1348,21 @@ def test_save_pdf_with_password(mock_thread_instance, mock_page_instance):
         patch("savethread.tempfile.NamedTemporaryFile"),
         patch("savethread.open", mock_open()),
         patch("savethread.img2pdf.convert", return_value=b"pdf_data"),
-        patch("savethread.ocrmypdf.api._pdf_to_hocr"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf"),
-        patch("savethread._fix_pdf_metadata"),
+        patch("savethread._write_pdf") as mock_write_pdf,
         patch("savethread.os.remove"),
         patch("savethread._set_timestamp"),
         patch("savethread._post_save_hook"),
         patch("savethread.pathlib.Path"),
-        patch("savethread._encrypt_pdf", return_value=0) as mock_encrypt,
     ):
         mock_thread_instance.do_save_pdf(request)
 
-        assert mock_encrypt.called
+        args, kwargs = mock_write_pdf.call_args
+        assert args[2] == "/tmp/output.pdf", "written directly"
+        assert kwargs["password"] == "password"
 
 
-def test_save_pdf_with_password_failure(mock_thread_instance, mock_page_instance):
-    "Test save_pdf method with password protection failure"
+def test_save_pdf_append_failure(mock_thread_instance, mock_page_instance):
+    "Test save_pdf method when the PDF to append to cannot be read"
     mock_thread_instance.mock_pages[1] = mock_page_instance
 
     options = {
@@ -787,27 +1370,26 @@ def test_save_pdf_with_password_failure(mock_thread_instance, mock_page_instance
         "path": "/tmp/output.pdf",
         "list_of_pages": [1],
         "metadata": {"datetime": datetime.datetime.now()},
-        "options": {"user-password": "password"},
+        "options": {"append": "/tmp/output.pdf"},
     }
-    request = Request("save_pdf", (options,), mock_thread_instance.responses)
+    request = MagicMock()
+    request.args = (options,)
 
     with (
         patch("savethread.tempfile.TemporaryDirectory"),
         patch("savethread.tempfile.NamedTemporaryFile"),
         patch("savethread.open", mock_open()),
         patch("savethread.img2pdf.convert", return_value=b"pdf_data"),
-        patch("savethread.ocrmypdf.api._pdf_to_hocr"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf"),
-        patch("savethread._fix_pdf_metadata"),
+        patch("savethread._write_pdf", side_effect=pikepdf.PdfError("damaged")),
         patch("savethread.os.remove"),
+        patch("savethread.os.path.getsize", return_value=1000),
         patch("savethread._set_timestamp") as mock_timestamp,
         patch("savethread._post_save_hook"),
         patch("savethread.pathlib.Path"),
-        patch("savethread._encrypt_pdf", return_value=1) as mock_encrypt,
     ):
         mock_thread_instance.do_save_pdf(request)
 
-        assert mock_encrypt.called
+        request.error.assert_called_once_with(_("Error appending PDF: %s") % "damaged")
         assert not mock_timestamp.called
 
 
@@ -830,9 +1412,7 @@ def test_save_pdf_ps_failure(mock_thread_instance, mock_page_instance):
         patch("savethread.tempfile.NamedTemporaryFile"),
         patch("savethread.open", mock_open()),
         patch("savethread.img2pdf.convert", return_value=b"pdf_data"),
-        patch("savethread.ocrmypdf.api._pdf_to_hocr"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf"),
-        patch("savethread._fix_pdf_metadata"),
+        patch("savethread._write_pdf"),
         patch("savethread.os.remove"),
         patch("savethread._set_timestamp"),
         patch("savethread._post_save_hook"),
@@ -849,160 +1429,9 @@ def test_save_pdf_ps_failure(mock_thread_instance, mock_page_instance):
         assert mock_thread_instance.responses.put.called
 
 
-def test_append_pdf_rename_failure():
-    "Test _append_pdf function when os.rename raises ValueError"
-    request = MagicMock()
-    options = {"options": {"prepend": "/tmp/prepend.pdf"}, "pidfile": "pidfile"}
-    with patch("savethread.os.rename", side_effect=ValueError("Rename error")):
-        ret = _append_pdf("/tmp/temp.pdf", options, request)
-        assert ret is None
-        assert request.error.called
-
-
-def test_append_pdf_pdfunite_failure():
-    "Test _append_pdf function when pdfunite fails"
-    request = MagicMock()
-    options = {"options": {"prepend": "/tmp/prepend.pdf"}, "pidfile": "pidfile"}
-    mock_proc = MagicMock()
-    mock_proc.returncode = 1
-    mock_proc.stderr = "pdfunite error"
-    with (
-        patch("savethread.os.rename"),
-        patch("savethread.exec_command", return_value=mock_proc),
-    ):
-        ret = _append_pdf("/tmp/temp.pdf", options, request)
-        assert ret == 1
-        assert request.error.called
-
-
-def test_savethread_progressbar_basic():
-    "Test SaveThreadProgressBar basic functionality"
-    mock_request = MagicMock()
-    progressbar = SaveThreadProgressBar(
-        request=mock_request, total=10, desc="Test operation", unit="page"
-    )
-
-    assert progressbar.current == 0
-    assert progressbar.total == 10
-    assert progressbar.desc == "Test operation"
-
-    # Test update with increment
-    progressbar.update(n=5)
-    assert progressbar.current == 5
-    mock_request.data.assert_called_with("Test operation")
-
-    # Test update with completed value
-    progressbar.update(completed=8)
-    assert progressbar.current == 8
-    mock_request.data.assert_called_with("Test operation")
-
-
-def test_savethread_progressbar_context_manager():
-    "Test SaveThreadProgressBar as context manager"
-    mock_request = MagicMock()
-
-    with SaveThreadProgressBar(
-        request=mock_request, total=5, desc="Context test", unit="item"
-    ) as pbar:
-        assert pbar is not None
-        pbar.update(n=2)
-        assert pbar.current == 2
-
-
-def test_savethread_progressbar_disabled():
-    "Test SaveThreadProgressBar when disabled"
-    mock_request = MagicMock()
-    progressbar = SaveThreadProgressBar(
-        request=mock_request,
-        total=10,
-        desc="Disabled test",
-        unit="page",
-        disable=True,
-    )
-
-    progressbar.update(n=5)
-    # Should not update thread when disabled
-    mock_request.data.assert_not_called()
-
-
-def test_savethread_progressbar_no_thread():
-    "Test SaveThreadProgressBar when thread_instance is None"
-    progressbar = SaveThreadProgressBar(
-        request=None, total=10, desc="No thread test", unit="page"
-    )
-
-    # Should not raise error
-    progressbar.update(n=5)
-    assert progressbar.current == 5
-
-
-def test_get_progressbar_class_hook():
-    "Test get_progressbar_class hook implementation"
-    mock_request = MagicMock()
-
-    # Set the current request
-    _current_request_for_progress[0] = mock_request
-
-    try:
-        # Get the progress bar class factory
-        factory = get_progressbar_class()
-        assert callable(factory)
-
-        # Create a progress bar using the factory
-        pbar = factory(total=20, desc="Hook test", unit="page", disable=False)
-        assert isinstance(pbar, SaveThreadProgressBar)
-        assert pbar.request == mock_request
-        assert pbar.total == 20
-
-        # Test that it updates the thread
-        pbar.update(n=10)
-        mock_request.data.assert_called_with("Hook test")
-
-    finally:
-        _current_request_for_progress[0] = None
-
-
-def test_save_pdf_with_progress_hooks(mock_thread_instance, mock_page_instance):
-    "Test that ocrmypdf progress hooks are used during PDF save"
-    mock_page_instance.text_layer = "text layer data"
-    mock_thread_instance.mock_pages[1] = mock_page_instance
-
-    options = {
-        "dir": "/tmp",
-        "path": "/tmp/output.pdf",
-        "list_of_pages": [1],
-        "metadata": {"datetime": datetime.datetime.now()},
-        "options": {},
-    }
-    request = Request("save_pdf", (options,), mock_thread_instance.responses)
-
-    with (
-        patch("savethread.tempfile.TemporaryDirectory"),
-        patch("savethread.tempfile.NamedTemporaryFile"),
-        patch("savethread.open", mock_open()),
-        patch("savethread.img2pdf.convert", return_value=b"pdf_data"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf") as mock_hocr_to_ocr_pdf,
-        patch("savethread._fix_pdf_metadata"),
-        patch("savethread.os.remove"),
-        patch("savethread._set_timestamp"),
-        patch("savethread._post_save_hook"),
-        patch("savethread.pathlib.Path") as mock_path,
-    ):
-        mock_path.return_value.glob.return_value = []
-
-        mock_thread_instance.do_save_pdf(request)
-
-        # Verify that _hocr_to_ocr_pdf was called
-        assert mock_hocr_to_ocr_pdf.called
-
-        # Check that the request instance was set for progress reporting
-        # (it should be None after the operation completes)
-        assert _current_request_for_progress[0] is None
-
-
-def test_save_pdf_progress_updates_during_ocr(mock_thread_instance, mock_page_instance):
-    "Test that progress is updated during OCR embedding"
-    mock_page_instance.text_layer = "text layer"
+def test_save_pdf_progress_complete(mock_thread_instance, mock_page_instance):
+    "Test that progress is complete once the PDF has been written"
+    mock_page_instance.text_layer = TEXT_LAYER
     mock_thread_instance.mock_pages[1] = mock_page_instance
 
     options = {
@@ -1015,37 +1444,25 @@ def test_save_pdf_progress_updates_during_ocr(mock_thread_instance, mock_page_in
     request = Request("save_pdf", (options,), mock_thread_instance.responses)
     request.data = MagicMock()
 
-    progress_values = []
-    message_values = []
-
-    def track_progress(*args, **kwargs):
-        "Capture progress values during the call"
-        progress_values.append(mock_thread_instance.progress)
-        message_values.append(mock_thread_instance.message)
-
     with (
         patch("savethread.tempfile.TemporaryDirectory"),
         patch("savethread.tempfile.NamedTemporaryFile"),
         patch("savethread.open", mock_open()),
         patch("savethread.img2pdf.convert", return_value=b"pdf_data"),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf", side_effect=track_progress),
-        patch("savethread._fix_pdf_metadata"),
+        patch("savethread._write_pdf"),
         patch("savethread.os.remove"),
         patch("savethread._set_timestamp"),
         patch("savethread._post_save_hook"),
-        patch("savethread.pathlib.Path") as mock_path,
+        patch("savethread.pathlib.Path"),
     ):
-        mock_path.return_value.glob.return_value = []
-
         mock_thread_instance.do_save_pdf(request)
 
-        # Verify progress was updated during the operation
         request.data.assert_called_with(1.0)
 
 
 def test_save_pdf_per_page_progress(mock_thread_instance, mock_page_instance):
     "Test that per-page progress is reported during the image-write loop"
-    mock_page_instance.text_layer = "text layer data"
+    mock_page_instance.text_layer = TEXT_LAYER
     mock_thread_instance.mock_pages[1] = mock_page_instance
 
     options = {
@@ -1076,8 +1493,7 @@ def test_save_pdf_per_page_progress(mock_thread_instance, mock_page_instance):
         patch("savethread.tempfile.NamedTemporaryFile"),
         patch("savethread.open", mock_open()),
         patch("savethread.img2pdf.convert", side_effect=convert),
-        patch("savethread.ocrmypdf.api._hocr_to_ocr_pdf"),
-        patch("savethread._fix_pdf_metadata"),
+        patch("savethread._write_pdf"),
         patch("savethread.os.remove"),
         patch("savethread._set_timestamp"),
         patch("savethread._post_save_hook"),
@@ -1111,5 +1527,5 @@ def test_save_pdf_per_page_progress(mock_thread_instance, mock_page_instance):
     ]
     assert writing_pdf_indices, '"Writing PDF" message reported'
     assert (
-        writing_pdf_indices[0] < convert_index
-    ), '"Writing PDF" message reported before img2pdf.convert'
+        writing_pdf_indices[0] > convert_index
+    ), '"Writing PDF" message reported once the pages are converted'
@@ -26,6 +26,7 @@ def mock_scan_window(mocker):
         post_process_progress = None
         settings = {}
         _windows = None
+        _extra_scan_windows = []
         _scan_progress = None
         _rotate_controls = None
         _scan_udt_cmbx = None
@@ -39,6 +40,8 @@ def mock_scan_window(mocker):
         # Callbacks
         _error_callback = mocker.Mock()
         _finished_process_callback = mocker.Mock()
+        _prompt_reverse_sides = mocker.Mock()
+        _show_message_dialog = mocker.Mock()
         _process_error_callback = mocker.Mock()
 
         def get_application(self, *args, **kwargs):
@@ -69,6 +72,9 @@ def mock_scan_window(mocker):
         "scan_window_height": 100,
         "cache-device-list": False,
         "device list": [],
+        "cache options": False,
+        "cache": None,
+        "SANE version": None,
         "rotate facing": 0,
         "rotate reverse": 0,
         "unpaper on scan": False,
@@ -246,6 +252,130 @@ def test_scan_dialog_cached_device(mocker, mock_scan_window):
     assert mock_scan_window._windows.device_list[0].name == "cached"
 
 
+def test_scan_dialog_option_cache(mocker, mock_scan_window):
+    "Test scan_dialog passes the option cache when caching options"
+    mock_sane_dialog_cls = mocker.patch("scan_menu_item_mixins.SaneScanDialog")
+    mocker.patch("scan_menu_item_mixins.OCRControls")
+    mocker.patch("scan_menu_item_mixins.RotateControls")
+
+    mock_scan_window.scan_dialog(None, None)
+    assert "option_cache" not in mock_sane_dialog_cls.call_args.kwargs
+
+    mock_scan_window._windows = None
+    mock_scan_window.settings["cache options"] = True
+    mock_scan_window.settings["SANE version"] = "1.2.1"
+    mock_scan_window.scan_dialog(None, None)
+
+    kwargs = mock_sane_dialog_cls.call_args.kwargs
+    assert mock_scan_window.settings["cache"] == {}
+    assert kwargs["option_cache"] is mock_scan_window.settings["cache"]
+    assert kwargs["sane_version"] == "1.2.1"
+
+
+def test_scan_another_device_dialog(mocker, mock_scan_window):
+    "Test opening an additional scan dialog for a second device"
+    mock_sane_dialog_cls = mocker.patch("scan_menu_item_mixins.SaneScanDialog")
+    mock_progress_cls = mocker.patch("scan_menu_item_mixins.Progress")
+    mocker.patch("scan_menu_item_mixins.OCRControls")
+    mocker.patch("scan_menu_item_mixins.RotateControls")
+    mock_scan_window.builder = mocker.Mock()
+
+    primary = mocker.Mock()
+    primary.device = "dev1"
+    mock_scan_window._windows = primary
+    extra = mocker.Mock()
+    mock_sane_dialog_cls.return_value = extra
+
+    mock_scan_window.scan_another_device_dialog(None, None)
+
+    assert mock_scan_window._extra_scan_windows == [extra]
+    assert extra.progress is mock_progress_cls.return_value
+    assert mock_sane_dialog_cls.call_args.kwargs["hide_on_delete"] is False
+    extra.get_devices.assert_called_once()
+
+    # The device already open in the main scan dialog is skipped
+    device_list = [SimpleNamespace(name="dev1"), SimpleNamespace(name="dev2")]
+    mock_scan_window._changed_device_list_callback(extra, device_list)
+    assert extra.device == "dev2"
+
+    # ... and the additional dialog doesn't change the default device
+    mock_scan_window._changed_device_callback(extra, "dev2")
+    assert mock_scan_window.settings["device"] == "mock_device"
+
+    # Progress is reported on the dialog's own progress bar
+    mock_scan_window._changed_progress_callback(extra, 0.5, "halfway")
+    extra.progress.set_fraction.assert_called_with(0.5)
+    mock_scan_window._scan_progress.set_fraction.assert_not_called()
+
+    # Finishing a scan only hides the dialog's own progress bar
+    callbacks = {call.args[0]: call.args[1] for call in extra.connect.call_args_list}
+    callbacks["started-process"](extra, "scanning")
+    signal = extra.progress.connect.return_value
+    callbacks["finished-process"](extra, "scan_pages")
+    extra.progress.disconnect.assert_called_once_with(signal)
+    extra.progress.hide.assert_called_once()
+    mock_scan_window._prompt_reverse_sides.assert_called_once_with(extra, "scan_pages")
+    mock_scan_window._finished_process_callback.assert_not_called()
+    mock_scan_window._scan_progress.hide.assert_not_called()
+
+    # No devices found
+    mock_scan_window._changed_device_list_callback(extra, [])
+    assert not mock_scan_window._extra_scan_windows
+    extra.thread.quit.assert_called_once()
+    assert mock_scan_window._windows is primary
+
+
+def test_scan_another_device_dialog_no_free_device(mocker, mock_scan_window):
+    "Test that an additional scan dialog is closed if all devices are open"
+    mocker.patch("scan_menu_item_mixins.SaneScanDialog")
+    mocker.patch("scan_menu_item_mixins.Progress")
+    mocker.patch("scan_menu_item_mixins.OCRControls")
+    mocker.patch("scan_menu_item_mixins.RotateControls")
+    mock_scan_window.builder = mocker.Mock()
+    primary = mocker.Mock()
+    primary.device = "dev1"
+    mock_scan_window._windows = primary
+
+    mock_scan_window.scan_another_device_dialog(None, None)
+    (extra,) = mock_scan_window._extra_scan_windows
+    extra.device = None
+    mock_scan_window._changed_device_list_callback(
+        extra, [SimpleNamespace(name="dev1")]
+    )
+
+    assert extra.device is None
+    mock_scan_window._show_message_dialog.assert_called_once()
+    assert not mock_scan_window._extra_scan_windows
+    extra.thread.quit.assert_called_once()
+
+
+def test_new_scan_callback_dialog_settings(mock_scan_window):
+    "Test _new_scan_callback uses the post-processing settings of the dialog"
+    mock_scan_window.slist.import_scan = MagicMock()
+    widget = SimpleNamespace(
+        postprocessing_settings={
+            "rotate facing": 90,
+            "rotate reverse": 0,
+            "unpaper on scan": False,
+            "udt_on_scan": False,
+            "current_udt": None,
+            "OCR on scan": True,
+            "ocr engine": "tesseract",
+            "ocr language": "fra",
+            "threshold-before-ocr": False,
+            "threshold tool": 0,
+        }
+    )
+    mock_scan_window.settings["rotate facing"] = 0
+
+    mock_scan_window._new_scan_callback(widget, MagicMock(), None, "facing", 300, 300)
+
+    call_kwargs = mock_scan_window.slist.import_scan.call_args[1]
+    assert call_kwargs["rotate"] == 90
+    assert call_kwargs["ocr"] is True
+    assert call_kwargs["language"] == "fra"
+
+
 def test_add_postprocessing_options_clicked_cb(mocker, mock_scan_window):
     "Test add_postprocessing_options and the clicked-scan-button callback"
     mock_widget = mocker.Mock()
@@ -297,6 +427,7 @@ def test_add_postprocessing_options_clicked_cb(mocker, mock_scan_window):
     assert mock_scan_window.settings["udt_on_scan"] is True
     assert mock_scan_window.settings["current_udt"] == "my_tool"
     assert mock_scan_window.settings["OCR on scan"] is True
+    assert mock_widget.postprocessing_settings["rotate facing"] == 90
     assert mock_scan_window.settings["ocr engine"] == "tesseract"
     assert mock_scan_window.settings["ocr language"] == "deu"
     assert mock_scan_window.settings["threshold-before-ocr"] is True
@@ -525,7 +656,7 @@ def test_new_scan_callback(mock_scan_window):
 
     assert "page" not in call_kwargs
     assert call_kwargs["dir"] == "session_name"
-    assert call_kwargs["image_object"] == mock_image
+    assert call_kwargs["image_bytes"] == mock_image
     assert call_kwargs["resolution"] == (300, 300, "PixelsPerInch")
 
 
@@ -1,6 +1,7 @@
+import json
 import pytest
 from frontend import enums
-from scanner.options import Option, Options, within_tolerance
+from scanner.options import Option, Options, options_from_cache, within_tolerance
 
 
 def test_within_tolerance():
@@ -233,6 +234,48 @@ def test_can_duplex():
     assert not options.can_duplex(), "no duplex option"
 
 
+def test_option_cache_round_trip():
+    "test that to_cache() survives JSON and preserves range vs list constraints"
+    options = Options(
+        [
+            Option(0, "", "Number of options", "", enums.TYPE_INT, 0, 4, 4, None),
+            Option(
+                1,
+                "mode",
+                "Mode",
+                "Selects the scan mode.",
+                enums.TYPE_STRING,
+                enums.UNIT_NONE,
+                1,
+                5,
+                ["Gray", "Color"],
+            ),
+            Option(
+                2,
+                "br-x",
+                "Bottom-right x",
+                "Bottom-right x position of scan area.",
+                enums.TYPE_FIXED,
+                enums.UNIT_MM,
+                1,
+                5,
+                (0.0, 215.9, 0.0),
+            ),
+        ]
+    )
+    restored = options_from_cache(json.loads(json.dumps(options.to_cache())))
+    assert restored.array == options.array, "round trip"
+    assert isinstance(restored.by_name("br-x").constraint, tuple), "range"
+    assert isinstance(restored.by_name("mode").constraint, list), "list"
+    assert restored.has_same_layout(options), "same layout"
+
+    cache = options.to_cache()
+    cache[2][4] = enums.TYPE_INT
+    assert not options_from_cache(cache).has_same_layout(options), "type changed"
+    assert not options.has_same_layout(Options(options.to_cache()[:2])), "length"
+    assert not options.has_same_layout(None), "no options"
+
+
 def test_option_name_none(
     mocker, sane_scan_dialog, set_device_wait_reload, mainloop_with_timeout
 ):
@@ -384,6 +384,12 @@ def test_finished_process_callback(mocker, mock_session_window):
     mock_session_window._finished_process_callback(mock_widget, "scan_pages")
     assert mock_widget.side_to_scan == "facing"
 
+    # Additional scan dialogs only prompt, without hiding the main progress bar
+    mock_session_window._scan_progress.reset_mock()
+    mock_session_window._prompt_reverse_sides(mock_widget, "scan_pages")
+    assert mock_widget.side_to_scan == "reverse"
+    mock_session_window._scan_progress.hide.assert_not_called()
+
 
 def test_display_callback(mocker, mock_session_window):
     "Test _display_callback"
@@ -831,6 +831,7 @@ def test_email_dialog(mocker, mock_tool_window):
         "pdf compression": "auto",
         "default filename": "doc",
         "convert whitespace to underscores": True,
+        "pdfa": True,
     }
 
     mock_tool_window.session = mocker.Mock()
@@ -848,6 +849,7 @@ def test_email_dialog(mocker, mock_tool_window):
     assert call_kwargs["path"] == "session_name/doc.pdf"
     assert call_kwargs["list_of_pages"] == ["uuid1", "uuid2"]
     assert call_kwargs["options"]["user-password"] == "password"
+    assert call_kwargs["options"]["pdfa"]
 
 
 def test_email_dialog_existing(mocker, mock_tool_window):
@@ -896,6 +898,7 @@ def test_email_execution_flow(mocker, mock_tool_window):
         "pdf compression": "auto",
         "default filename": "doc",
         "convert whitespace to underscores": True,
+        "pdfa": False,
         "view files toggle": True,
     }
     mock_tool_window.session = mocker.Mock()
@@ -963,6 +966,7 @@ def test_email_default_filename(mocker, mock_tool_window):
         "pdf compression": "auto",
         "default filename": "doc",
         "convert whitespace to underscores": True,
+        "pdfa": False,
         "view files toggle": False,
     }
     mock_tool_window.session = mocker.Mock()
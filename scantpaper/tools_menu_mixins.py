@@ -752,7 +752,7 @@ class ToolsMenuMixins:
             downsample_dpi=self.settings["downsample dpi"],
             downsample=self.settings["downsample"],
             pdf_compression=self.settings["pdf compression"],
-            can_encrypt_pdf="qpdf" in self._dependencies,
+            can_encrypt_pdf=True,
         )
 
         # Frame for page range
@@ -783,6 +783,7 @@ class ToolsMenuMixins:
                 "downsample dpi": self.settings["downsample dpi"],
                 "quality": self.settings["quality"],
                 "user-password": self._windowe.pdf_user_password,
+                "pdfa": self.settings["pdfa"],
             }
             filename = expand_metadata_pattern(
                 template=self.settings["default filename"],
@@ -802,7 +803,6 @@ class ToolsMenuMixins:
             # Create the PDF
             def email_finished_callback(response):
                 self.post_process_progress.finish(response)
-                self.slist.thread.send("set_saved", uuids)
                 if (
                     "view files toggle" in self.settings
                     and self.settings["view files toggle"]